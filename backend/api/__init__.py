@@ -2,8 +2,11 @@ from .admin import admin_api
 from .profile import profile_api
 from .plugins import plugins_api
 from .users import users_api
-from .accounts import accounts_api
+from .accounts import accounts_api, write_behind_buffer
 from .status import status_api
 from .auth import auth_api
 
-from .common import mqtt_publish_changed, mqtt_publish_changed_multiple_payloads, MQTT_HOSTNAME, MQTT_PORT, MQTT_WS_HOSTNAME, MQTT_WS_PORT, CORS_DOMAINS
+from .writebehind import WRITE_BEHIND_ENABLED
+from .common import (mqtt_publish_changed, mqtt_publish_changed_multiple_payloads, mqtt_publisher, values_changes_coalescer,
+    MQTT_VALUES_COALESCE, MQTT_PUBLISH_CLOSE_TIMEOUT_S, MQTT_HOSTNAME, MQTT_PORT, MQTT_WS_HOSTNAME, MQTT_WS_PORT, CORS_DOMAINS,
+)
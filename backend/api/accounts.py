@@ -1,23 +1,33 @@
+import base64
 from datetime import timezone
 import json
 import math
+import os
 import re
+import struct
 import time
 
 from fastapi import Depends, Response, status, BackgroundTasks, HTTPException, Form, Security, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import psycopg2
 
-from .fastapiutils import APIRouter, AuthenticatedUser, validate_user_authentication, api_authorization_header
+from .fastapiutils import (APIRouter, AuthenticatedUser, validate_user_authentication, api_authorization_header,
+    MsgpackResponse, accepts_msgpack, get_content_type, iter_body, read_body)
 import validators
+import downsampling
 from datatypes import (AccessDeniedError, Account, Bot, Dashboard, Entity, Credential, Sensor, Measurement,
     Path, PathInputValue, PathFilter, Permission, Timestamp, UnfinishedPathFilter, ValidationError, Widget, Stats,
 )
-from .common import mqtt_publish_changed, mqtt_publish_changed_multiple_payloads
+from .common import mqtt_publish_changed, mqtt_publish_changed_multiple_payloads, values_changes_coalescer, MQTT_VALUES_COALESCE
+from .ratelimits import check_rate_limits, new_paths_rate_limiter
+from .writebehind import (WriteBehindBuffer, WRITE_BEHIND_ENABLED, WRITE_BEHIND_MAX_ROWS, WRITE_BEHIND_FLUSH_ROWS,
+    WRITE_BEHIND_FLUSH_INTERVAL_MS,
+)
 from const import SYSTEM_PATH_INSERTED_COUNT, SYSTEM_PATH_UPDATED_COUNT, SYSTEM_PATH_CHANGED_COUNT
 
 
 accounts_api = APIRouter()
+Stats.on_flushed = mqtt_publish_changed_multiple_payloads
 
 
 def accounts_apidoc_schemas():
@@ -85,6 +95,21 @@ def accounts_apidoc_schemas():
                 'description': "Measurements time (UNIX timestamp) - null if no results were found",
                 'example': 1234567890.123456,
             },
+            't0': {
+                'type': 'number',
+                'description': "Start of time range (UNIX timestamp) - only if t0 was requested",
+                'example': 1234566000,
+            },
+            't1': {
+                'type': 'number',
+                'description': "End of time range (UNIX timestamp) - only if t0 was requested",
+                'example': 1234569600,
+            },
+            'aggr': {
+                'type': 'string',
+                'description': "Aggregation of values within time range - only if t0 was requested",
+                'example': 'sum',
+            },
             'total': {
                 'type': ['number', 'null'],
                 'description': "Sum of values for all paths that match the path filter (useful for calculating percentages)",
@@ -111,6 +136,34 @@ def accounts_apidoc_schemas():
             },
         },
     }
+    yield "LastValuesGET", {
+        'type': 'object',
+        'properties': {
+            'paths': {
+                'type': 'object',
+                'additionalProperties': {
+                    'type': 'object',
+                    'properties': {
+                        't': {
+                            'type': 'number',
+                            'description': "Measurements time (UNIX timestamp) of the latest value",
+                            'example': 1234567890.123456,
+                        },
+                        'v': {
+                            'type': 'number',
+                            'description': "Latest measurement value",
+                            'example': 12.33,
+                        },
+                    },
+                },
+            },
+            'limit_reached': {
+                'type': 'boolean',
+                'description': "True if there are more paths matching the path filter than limit allows",
+                'example': False,
+            },
+        },
+    }
 
 
 # --------------
@@ -515,30 +568,164 @@ def account_bot_permission_delete(account_id: int, user_id: int, permission_id:
     return Response(status_code=204)
 
 
-@accounts_api.put("/api/accounts/{account_id}/values")
-async def values_put(account_id: int, request: Request, auth: AuthenticatedUser = Depends(validate_user_authentication)):
-    data = await request.json()
+# Bodies with these content types are parsed line by line as they arrive and saved in chunks, so that memory usage
+# doesn't depend on the size of payload. Line protocol has its own media type because some clients send JSON bodies
+# as text/plain:
+CONTENT_TYPE_NDJSON = 'application/x-ndjson'
+CONTENT_TYPE_LINE_PROTOCOL = 'application/x-grafolean-line-protocol'
+INGEST_CHUNK_SIZE = int(os.environ.get('INGEST_CHUNK_SIZE', 5000))
+INGEST_MAX_LINE_LENGTH = 64 * 1024
+
+
+def _parse_ndjson_line(line, line_nr, now=None):
+    try:
+        record = json.loads(line)
+    except ValueError:
+        raise ValidationError(f"Invalid JSON on line {line_nr}")
+    if now is not None:
+        try:
+            return _values_post_record(record, now)
+        except ValidationError as ex:
+            raise ValidationError(f"Invalid value on line {line_nr}: {ex.detail}")
+    if not isinstance(record, dict):
+        raise ValidationError(f"Invalid value on line {line_nr}: value must be a JSON object")
+    return record
+
+
+def _parse_line_protocol_line(line, line_nr, now=None):
+    return Measurement.parse_line_protocol(line, line_nr, now)
+
+
+LINE_PARSERS = {
+    CONTENT_TYPE_NDJSON: _parse_ndjson_line,
+    CONTENT_TYPE_LINE_PROTOCOL: _parse_line_protocol_line,
+}
+
+
+async def _iter_body_chunks(request, parse_line, now=None, rejected=None):
+    """
+        Parses the body line by line while it is being received, yields lists of (at most) INGEST_CHUNK_SIZE records,
+        together with the indexes of their lines (line number - 1). If `rejected` list is given, lines which can't be
+        parsed are appended to it as (index, reason) instead of failing the request.
+    """
+    chunk, chunk_indexes = [], []
+    line_nr = 0
+    pending = b''
+
+    def parse(line, line_nr):
+        try:
+            chunk.append(parse_line(line, line_nr, now))
+            chunk_indexes.append(line_nr - 1)
+        except HTTPException as ex:
+            if rejected is None:
+                raise
+            rejected.append((line_nr - 1, ex.detail))
+
+    async for body_part in iter_body(request):
+        pending += body_part
+        lines = pending.split(b'\n')
+        pending = lines.pop()
+        if len(pending) > INGEST_MAX_LINE_LENGTH:
+            raise ValidationError(f"Line {line_nr + len(lines) + 1} is too long")
+        for line in lines:
+            line_nr += 1
+            if not line.strip():
+                continue
+            parse(line, line_nr)
+            if len(chunk) >= INGEST_CHUNK_SIZE:
+                yield chunk_indexes, chunk
+                chunk, chunk_indexes = [], []
+    if pending.strip():
+        parse(pending, line_nr + 1)
+    if chunk:
+        yield chunk_indexes, chunk
+
+
+def _is_partial_mode(request):
+    return request.query_params.get('partial', '').lower() in ['true', 'yes', 'on', '1']
+
+
+def _save_values(account_id, data, stats_count_path, partial=False):
+    """
+        Saves the values (or queues them, in write-behind mode), updates the stats and publishes the changes via MQTT.
+        In partial mode invalid values are skipped instead of rejecting the whole batch - returns a list of rejected
+        values (index, reason).
+    """
+    check_rate_limits(account_id, len(data))
+
+    if WRITE_BEHIND_ENABLED:
+        # values are saved later, so we must make sure that they are valid now:
+        rejected = []
+        if partial:
+            valid, rejected = Measurement.validate_batch(data)
+            data = [data[i] for i, _, _, _ in valid]
+        else:
+            Measurement.validate_values(data)
+        if data and not write_behind_buffer.enqueue(account_id, data, stats_count_path):
+            raise HTTPException(status_code=503, detail="Too many values are waiting to be saved, please retry later",
+                                headers={'Retry-After': str(write_behind_buffer.retry_after_s)})
+        return rejected
+
+    if partial:
+        newly_created_paths, rejected = Measurement.save_valid_values_data_to_db(account_id, data)
+        rejected_indexes = set(i for i, _ in rejected)
+        data = [d for i, d in enumerate(data) if i not in rejected_indexes]
+        _values_saved(account_id, data, stats_count_path, newly_created_paths)
+        return rejected
 
     # let's just pretend our data is of correct form, otherwise Exception will be thrown and Flask will return error response:
     try:
         newly_created_paths = Measurement.save_values_data_to_db(account_id, data)
     except psycopg2.IntegrityError:
         raise HTTPException(status_code=400, detail="Invalid input format")
+    _values_saved(account_id, data, stats_count_path, newly_created_paths)
+    return []
+
+
+async def _save_values_from_body(account_id, request, stats_count_path, parse_line, now=None):
+    partial = _is_partial_mode(request)
+    rejected = [] if partial else None
+    n_accepted = 0
+    # note that chunks are saved as they arrive - if an error is found later in the body, previous chunks are already saved:
+    async for chunk_indexes, data in _iter_body_chunks(request, parse_line, now, rejected):
+        chunk_rejected = _save_values(account_id, data, stats_count_path, partial)
+        n_accepted += len(data) - len(chunk_rejected)
+        if partial:
+            rejected.extend((chunk_indexes[i], reason) for i, reason in chunk_rejected)
+    if partial:
+        return _partial_mode_response(n_accepted, sorted(rejected))
+    return Response(status_code=204)
+
+
+def _partial_mode_response(n_accepted, rejected):
+    return JSONResponse(content={
+        'accepted': n_accepted,
+        'rejected': [[i, reason] for i, reason in rejected],
+    }, status_code=200)
+
+
+def _values_saved(account_id, data, stats_count_path, newly_created_paths):
+    if newly_created_paths:
+        new_paths_rate_limiter.charge(account_id, len(newly_created_paths))
 
     # save the stats:
     minute = math.floor(time.time() / 60) * 60
     stats_updates = {
-        SYSTEM_PATH_UPDATED_COUNT: { 'v': len(data), 't': minute },
+        stats_count_path: { 'v': len(data), 't': minute },
         SYSTEM_PATH_CHANGED_COUNT: { 'v': len(data), 't': minute },
     }
-    topics_with_payloads_stats = Stats.update_account_stats(account_id, stats_updates)
+    # stats are saved (and their changes published) periodically, see Stats.flush():
+    Stats.update_account_stats(account_id, stats_updates)
 
     # publish the changes over MQTT:
-    topics_with_payloads = [(
-        f"accounts/{account_id}/values/{d['p']}",
-        { 'v': d['v'], 't': d['t'] },
-    ) for d in data]
-    topics_with_payloads.extend(topics_with_payloads_stats)
+    if MQTT_VALUES_COALESCE:
+        values_changes_coalescer.add(account_id, data)
+        topics_with_payloads = []
+    else:
+        topics_with_payloads = [(
+            f"accounts/{account_id}/values/{d['p']}",
+            { 'v': d['v'], 't': d['t'] },
+        ) for d in data]
     if newly_created_paths:
         topics_with_payloads.append(
             (
@@ -547,27 +734,79 @@ async def values_put(account_id: int, request: Request, auth: AuthenticatedUser
             ),
         )
 
-    mqtt_publish_changed_multiple_payloads(topics_with_payloads)
+    if topics_with_payloads:
+        mqtt_publish_changed_multiple_payloads(topics_with_payloads)
+
+
+write_behind_buffer = WriteBehindBuffer(WRITE_BEHIND_MAX_ROWS, WRITE_BEHIND_FLUSH_ROWS, WRITE_BEHIND_FLUSH_INTERVAL_MS, on_flushed=_values_saved)
+
+
+def _values_post_record(record, now):
+    if not isinstance(record, dict):
+        raise ValidationError("value must be a JSON object")
+    if 'p' not in record or 'v' not in record:
+        raise ValidationError("value must have fields 'p' and 'v'")
+    if record.get('t'):
+        raise ValidationError("Parameter 't' shouldn't be specified with POST")
+    return {
+        'p': record['p'],
+        'v': record['v'],
+        't': now,
+    }
+
+
+def _values_post_data(json_data, now, rejected=None):
+    """
+        Adds current timestamp to the values. Returns the values together with their indexes in `json_data`. If
+        `rejected` list is given, malformed values are appended to it as (index, reason) instead of failing the request.
+    """
+    if not isinstance(json_data, list):
+        raise ValidationError("Values must be sent as a JSON array")
+    indexes, data = [], []
+    for i, x in enumerate(json_data):
+        try:
+            data.append(_values_post_record(x, now))
+            indexes.append(i)
+        except ValidationError as ex:
+            if rejected is None:
+                raise ValidationError(f"Invalid value at index {i}: {ex.detail}")
+            rejected.append((i, ex.detail))
+    return indexes, data
+
+
+@accounts_api.put("/api/accounts/{account_id}/values")
+async def values_put(account_id: int, request: Request, auth: AuthenticatedUser = Depends(validate_user_authentication)):
+    # reject the request early (before we even read it) if account is over its limits:
+    check_rate_limits(account_id, 0)
+    parse_line = LINE_PARSERS.get(get_content_type(request))
+    if parse_line:
+        return await _save_values_from_body(account_id, request, SYSTEM_PATH_UPDATED_COUNT, parse_line)
+
+    data = await read_body(request)
+    if _is_partial_mode(request):
+        rejected = _save_values(account_id, data, SYSTEM_PATH_UPDATED_COUNT, partial=True)
+        return _partial_mode_response(len(data) - len(rejected), rejected)
+    _save_values(account_id, data, SYSTEM_PATH_UPDATED_COUNT)
     return Response(status_code=204)
 
 
 @accounts_api.post("/api/accounts/{account_id}/values")
 async def values_post(account_id: int, request: Request, auth: AuthenticatedUser = Depends(validate_user_authentication)):
+    check_rate_limits(account_id, 0)
     # data comes from two sources, query params and JSON body. We use both and append timestamp to each
     # piece, then we use the same function as for PUT:
     data = []
     now = time.time()
-    json_data = await request.json()
+    parse_line = LINE_PARSERS.get(get_content_type(request))
+    if parse_line:
+        return await _save_values_from_body(account_id, request, SYSTEM_PATH_INSERTED_COUNT, parse_line, now)
+
+    json_data = await read_body(request)
     query_params_p = request.query_params.get('p')
+    partial = _is_partial_mode(request)
+    rejected = []
     if json_data:
-        for x in json_data:
-            if x.get('t'):
-                raise HTTPException(status_code=400, detail="Parameter 't' shouldn't be specified with POST")
-        data = [{
-                'p': x['p'],
-                'v': x['v'],
-                't': now,
-                } for x in json_data]
+        indexes, data = _values_post_data(json_data, now, rejected if partial else None)
     elif query_params_p:
         if request.query_params.get('t'):
             raise HTTPException(status_code=400, detail="Query parameter 't' shouldn't be specified with POST")
@@ -576,38 +815,16 @@ async def values_post(account_id: int, request: Request, auth: AuthenticatedUser
             'v': request.query_params.get('v'),
             't': now,
         })
+        indexes = [0]
     else:
         raise HTTPException(status_code=400, detail="Missing data")
 
-    # let's just pretend our data is of correct form, otherwise Exception will be thrown and Flask will return error response:
-    try:
-        newly_created_paths = Measurement.save_values_data_to_db(account_id, data)
-    except psycopg2.IntegrityError:
-        raise HTTPException(status_code=400, detail="Invalid input format")
-
-    # update stats:
-    minute = math.floor(time.time() / 60) * 60
-    stats_updates = {
-        SYSTEM_PATH_INSERTED_COUNT: { 'v': len(data), 't': minute },
-        SYSTEM_PATH_CHANGED_COUNT: { 'v': len(data), 't': minute },
-    }
-    topics_with_payloads_stats = Stats.update_account_stats(account_id, stats_updates)
-
-    # publish the changes over MQTT:
-    topics_with_payloads = [(
-        f"accounts/{account_id}/values/{d['p']}",
-        { 'v': d['v'], 't': d['t'] },
-    ) for d in data]
-    topics_with_payloads.extend(topics_with_payloads_stats)
-    if newly_created_paths:
-        topics_with_payloads.append(
-            (
-                f"accounts/{account_id}/paths",
-                [{"p": p.path, "id": p.force_id} for p in newly_created_paths],
-            ),
-        )
-
-    mqtt_publish_changed_multiple_payloads(topics_with_payloads)
+    if partial:
+        save_rejected = _save_values(account_id, data, SYSTEM_PATH_INSERTED_COUNT, partial=True) if data else []
+        # indexes of saved values must be translated back to indexes in the request:
+        rejected.extend((indexes[i], reason) for i, reason in save_rejected)
+        return _partial_mode_response(len(data) - len(save_rejected), sorted(rejected))
+    _save_values(account_id, data, SYSTEM_PATH_INSERTED_COUNT)
     return Response(status_code=204)
 
 
@@ -661,6 +878,45 @@ def values_get(account_id: int, path: str, request: Request, auth: Authenticated
                 type: integer
                 minimum: 1
                 maximum: 100000
+            - name: format
+              in: query
+              description: "Response format (default rows); columnar returns parallel arrays of timestamps and values for each path"
+              required: false
+              schema:
+                type: string
+                enum: [rows, columnar]
+            - name: precision
+              in: query
+              description: "Number of decimals values are rounded to (only with columnar format)"
+              required: false
+              schema:
+                type: integer
+            - name: binary
+              in: query
+              description: "Encode columns as little-endian float64 arrays in base64 (only with columnar format)"
+              required: false
+              schema:
+                type: boolean
+            - name: meta
+              in: query
+              description: "Include first / last timestamp and estimated number of values of each path in response (under `meta`)"
+              required: false
+              schema:
+                type: boolean
+            - name: max_points
+              in: query
+              description: "Downsample raw values of each path to at most this many points (after limit is applied)"
+              required: false
+              schema:
+                type: integer
+                minimum: 3
+            - name: downsample
+              in: query
+              description: "Downsampling algorithm used with max_points (default lttb - Largest-Triangle-Three-Buckets); minmax keeps minimum and maximum of each bucket"
+              required: false
+              schema:
+                type: string
+                enum: [lttb, minmax]
           responses:
             200:
               content:
@@ -672,7 +928,7 @@ def values_get(account_id: int, path: str, request: Request, auth: Authenticated
     if "," in path:
         raise HTTPException(status_code=400, detail="Only a single path is allowed")
     paths_input = path
-    return _values_get(account_id, paths_input, None, args)
+    return _values_get(account_id, paths_input, None, args, accepts_msgpack(request))
 
 
 @accounts_api.post("/api/accounts/{account_id}/getvalues")
@@ -680,14 +936,14 @@ async def values_get_with_post(account_id: int, request: Request, auth: Authenti
     # when we request data for too many paths at once, we run in trouble with URLs being too long. Using
     # POST is not ideal, but it works... We do however keep the interface as close to GET as possible, so
     # we use the same arguments:
-    args = await request.json()
+    args = await read_body(request)
     paths_input = args.get('p')
-    return _values_get(account_id, paths_input, None, args)
+    return _values_get(account_id, paths_input, None, args, accepts_msgpack(request))
 
 
 @accounts_api.post("/api/accounts/{account_id}/getaggrvalues")
 async def aggrvalues_get_with_post(account_id: int, request: Request, auth: AuthenticatedUser = Depends(validate_user_authentication)):
-    args = await request.json()
+    args = await read_body(request)
     paths_input = args.get('p')
 
     try:
@@ -697,10 +953,10 @@ async def aggrvalues_get_with_post(account_id: int, request: Request, auth: Auth
     if not (0 <= aggr_level <= 6):
         raise HTTPException(status_code=400, detail="Invalid parameter a (should be a number in range from 0 to 6).")
 
-    return _values_get(account_id, paths_input, aggr_level, args)
+    return _values_get(account_id, paths_input, aggr_level, args, accepts_msgpack(request))
 
 
-def _values_get(account_id, paths_input, aggr_level, args):
+def _values_get(account_id, paths_input, aggr_level, args, use_msgpack=False):
     if paths_input is None:
         raise HTTPException(status_code=400, detail="Path(s) not specified")
     try:
@@ -708,7 +964,9 @@ def _values_get(account_id, paths_input, aggr_level, args):
     except:
         raise HTTPException(status_code=400, detail="Path(s) not specified correctly")
 
+    include_meta = str(args.get('meta', '')).lower() in ['true', 'yes', 'on', '1']
     t_from_input = args.get('t0')
+    paths_meta = Measurement.get_paths_meta(account_id, paths) if (include_meta or not t_from_input) else None
     if t_from_input:
         try:
             t_froms = [Timestamp(t) for t in str(t_from_input).split(',')]
@@ -721,9 +979,7 @@ def _values_get(account_id, paths_input, aggr_level, args):
         except:
             raise HTTPException(status_code=400, detail="Error parsing t0")
     else:
-        t_from = Measurement.get_oldest_measurement_time(account_id, paths)
-        if not t_from:
-            t_from = Timestamp(time.time())
+        t_from = Timestamp(Measurement.get_oldest_measurement_time(account_id, paths, paths_meta) or time.time())
         t_froms = [t_from for _ in paths]
 
     t_to_input = args.get('t1')
@@ -747,9 +1003,141 @@ def _values_get(account_id, paths_input, aggr_level, args):
     except:
         raise HTTPException(status_code=400, detail="Invalid parameter: limit")
 
+    response_format = str(args.get('format', 'rows'))
+    if response_format not in ['rows', 'columnar']:
+        raise HTTPException(status_code=400, detail="Invalid parameter: format (should be 'rows' or 'columnar')")
+    try:
+        precision = int(args['precision']) if args.get('precision') is not None else None
+    except:
+        raise HTTPException(status_code=400, detail="Invalid parameter: precision")
+    binary = str(args.get('binary', '')).lower() in ['true', 'yes', 'on', '1']
+
+    try:
+        max_points = int(args['max_points']) if args.get('max_points') is not None else None
+    except:
+        raise HTTPException(status_code=400, detail="Invalid parameter: max_points")
+    if max_points is not None and max_points < 3:
+        raise HTTPException(status_code=400, detail="Invalid parameter: max_points (min. value is 3)")
+    downsample_algorithm = str(args.get('downsample', 'lttb'))
+    if downsample_algorithm not in downsampling.ALGORITHMS:
+        raise HTTPException(status_code=400, detail="Invalid parameter: downsample (should be one of: {})".format(", ".join(downsampling.ALGORITHMS)))
+    if max_points is not None and aggr_level is not None:
+        raise HTTPException(status_code=400, detail="Invalid parameter: max_points (only raw values can be downsampled)")
+
     # finally, return the data:
-    paths_data = Measurement.fetch_data(account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records)
-    return JSONResponse(content={'paths': paths_data}, status_code=200)
+    paths_data = None
+    if max_points is not None:
+        paths_data = Measurement.fetch_data(account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records)
+        paths_data = _downsample_paths_data(paths_data, downsample_algorithm, max_points)
+    elif response_format == 'columnar' or use_msgpack:
+        paths_data = Measurement.fetch_data(account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records)
+
+    if response_format == 'columnar':
+        # with MessagePack, binary columns can be sent as they are (no need for base64):
+        content = {'paths': _values_to_columnar(paths_data, precision, binary, as_bytes=use_msgpack)}
+        if include_meta:
+            content['meta'] = paths_meta
+        if use_msgpack:
+            return MsgpackResponse(content=content, status_code=200)
+        return JSONResponse(content=content, status_code=200)
+    if paths_data is not None:
+        content = {'paths': paths_data}
+        if include_meta:
+            content['meta'] = paths_meta
+        if use_msgpack:
+            return MsgpackResponse(content=content, status_code=200)
+        return JSONResponse(content=content, status_code=200)
+    # JSON response is streamed while the data is being read from DB, so that we don't need to keep it all in memory:
+    str_paths, data_chunks = Measurement.fetch_data_chunks(account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records)
+    return StreamingResponse(_iter_values_json(str_paths, data_chunks, paths_meta if include_meta else None), status_code=200, media_type='application/json')
+
+
+def _downsample_paths_data(paths_data, algorithm, max_points):
+    """ Reduces the data of each path (as returned by Measurement.fetch_data()) to at most `max_points` values. """
+    ret = {}
+    for str_p, path_data in paths_data.items():
+        data = path_data['data']
+        indexes = downsampling.downsample(algorithm, [d['t'] for d in data], [d['v'] for d in data], max_points)
+        ret[str_p] = {
+            'next_data_point': path_data['next_data_point'],
+            'data': [data[i] for i in indexes],
+        }
+    return ret
+
+
+def _values_to_columnar(paths_data, precision=None, binary=False, as_bytes=False):
+    """
+        Converts the data (as returned by Measurement.fetch_data()) to columnar form - for each path, timestamps and values
+        (and minimums and maximums for aggregated data) are returned as parallel arrays:
+          - if timestamps are evenly spaced, they are replaced by `t_start` and `t_step`
+          - if `precision` is set, values are rounded to this many decimals
+          - if `binary` is set, arrays are encoded as little-endian float64, in base64 (or raw bytes, if `as_bytes` is set)
+    """
+    def encode(column):
+        if not binary:
+            return column
+        packed = struct.pack(f'<{len(column)}d', *column)
+        return packed if as_bytes else base64.b64encode(packed).decode('ascii')
+
+    ret = {}
+    for str_p, path_data in paths_data.items():
+        data = path_data['data']
+        columnar = {'next_data_point': path_data['next_data_point']}
+
+        timestamps = [d['t'] for d in data]
+        steps = set(round(t1 - t0, 6) for t0, t1 in zip(timestamps, timestamps[1:]))
+        if len(steps) == 1:
+            columnar['t_start'] = timestamps[0]
+            columnar['t_step'] = steps.pop()
+            columnar['n'] = len(timestamps)
+        else:
+            columnar['t'] = encode(timestamps)
+
+        value_keys = ['v', 'minv', 'maxv'] if data and 'minv' in data[0] else ['v']
+        for k in value_keys:
+            column = [d[k] for d in data]
+            if precision is not None:
+                column = [round(v, precision) for v in column]
+            columnar[k] = encode(column)
+        ret[str_p] = columnar
+    return ret
+
+
+def _iter_values_json(str_paths, data_chunks, paths_meta=None):
+    """
+        Encodes data chunks (as returned by Measurement.fetch_data_chunks()) to JSON in the same form as fetch_data() would.
+        If `paths_meta` is set, it is added to the response under `meta`.
+    """
+    def dumps(x):
+        return json.dumps(x, ensure_ascii=False, allow_nan=False, separators=(',', ':'))
+
+    yield '{"paths":{'
+    written_paths = set()
+    current_path, next_data_point, has_data = None, None, False
+    for str_p, chunk, chunk_next_data_point in data_chunks:
+        if str_p != current_path:
+            if current_path is not None:
+                yield '],"next_data_point":' + dumps(next_data_point) + '},'
+            yield dumps(str_p) + ':{"data":['
+            written_paths.add(str_p)
+            current_path, next_data_point, has_data = str_p, None, False
+        if chunk:
+            yield (',' if has_data else '') + dumps(chunk)[1:-1]
+            has_data = True
+        if chunk_next_data_point is not None:
+            next_data_point = chunk_next_data_point
+    if current_path is not None:
+        yield '],"next_data_point":' + dumps(next_data_point) + '}'
+
+    # paths without data:
+    for str_p in str_paths:
+        if str_p not in written_paths:
+            yield (',' if written_paths else '') + dumps(str_p) + ':{"data":[],"next_data_point":null}'
+            written_paths.add(str_p)
+    if paths_meta is None:
+        yield '}}'
+    else:
+        yield '},"meta":' + dumps(paths_meta) + '}'
 
 
 @accounts_api.get("/api/accounts/{account_id}/topvalues")
@@ -791,6 +1179,25 @@ def topvalues_get(account_id: int, request: Request, auth: AuthenticatedUser = D
               required: false
               schema:
                 type: number
+            - name: t0
+              in: query
+              description: "If set, paths are ranked by values aggregated over the time range [t0, t1) instead (range is extended to whole hours)"
+              required: false
+              schema:
+                type: number
+            - name: t1
+              in: query
+              description: "End of time range (only with t0, default: current timestamp)"
+              required: false
+              schema:
+                type: number
+            - name: aggr
+              in: query
+              description: "Aggregation of values within the time range (only with t0, default sum): sum or average of all values within the range, or the maximum value"
+              required: false
+              schema:
+                type: string
+                enum: [sum, avg, max]
           responses:
             200:
               content:
@@ -809,6 +1216,9 @@ def topvalues_get(account_id: int, request: Request, auth: AuthenticatedUser = D
     except ValidationError:
         raise ValidationError("Invalid path filter")
 
+    if request.query_params.get('t0') is not None:
+        return _topvalues_range_get(account_id, pf, request.query_params, max_results)
+
     ts_to_input = request.query_params.get('t', time.time())
     try:
         ts_to = Timestamp(ts_to_input)
@@ -824,6 +1234,118 @@ def topvalues_get(account_id: int, request: Request, auth: AuthenticatedUser = D
 
 
 
+def _topvalues_range_get(account_id, pf, args, max_results):
+    try:
+        t_from = Timestamp(args.get('t0'))
+    except ValidationError:
+        raise ValidationError("Invalid parameter t0")
+    try:
+        t_to = Timestamp(args.get('t1', time.time()))
+    except ValidationError:
+        raise ValidationError("Invalid parameter t1")
+    if not t_from < t_to:
+        raise ValidationError("Invalid parameters t0, t1 (t0 must be lower than t1)")
+    aggr = args.get('aggr', 'sum')
+    if aggr not in Measurement.TOPN_RANGE_AGGR_FUNCTIONS:
+        raise ValidationError("Invalid parameter aggr (should be one of: {})".format(", ".join(Measurement.TOPN_RANGE_AGGR_FUNCTIONS.keys())))
+
+    t_from, t_to, total, topn = Measurement.fetch_topn_range(account_id, pf, t_from, t_to, aggr, max_results)
+    return JSONResponse(content={
+        't0': t_from,
+        't1': t_to,
+        'aggr': aggr,
+        'total': float(total),
+        'list': topn,
+    }, status_code=200)
+
+@accounts_api.get("/api/accounts/{account_id}/lastvalues")
+def lastvalues_get(account_id: int, request: Request, auth: AuthenticatedUser = Depends(validate_user_authentication)):
+    """
+        ---
+        get:
+          summary: Get the latest value of each of the paths
+          tags:
+            - Accounts
+          description:
+            Returns the latest value of each of the specified paths (or of the paths which match the path filter). Paths without values are
+            omitted. Use POST /accounts/<account_id>/getlastvalues/ with the same parameters (in JSON body) if the list of paths is too long.
+          parameters:
+            - name: account_id
+              in: path
+              description: "Account id"
+              required: true
+              schema:
+                type: integer
+            - name: p
+              in: query
+              description: "Comma separated list of paths (either this or `f` must be specified)"
+              required: false
+              schema:
+                type: string
+            - name: f
+              in: query
+              description: "Path filter (either this or `p` must be specified)"
+              required: false
+              schema:
+                type: string
+            - name: limit
+              in: query
+              description: "Max. number of paths matching the path filter (default 1000, max 100000)"
+              required: false
+              schema:
+                type: integer
+                minimum: 1
+                maximum: 100000
+          responses:
+            200:
+              content:
+                application/json:
+                  schema:
+                    "$ref": '#/definitions/LastValuesGET'
+    """
+    return _lastvalues_get(account_id, request.query_params)
+
+
+@accounts_api.post("/api/accounts/{account_id}/getlastvalues")
+async def lastvalues_get_with_post(account_id: int, request: Request, auth: AuthenticatedUser = Depends(validate_user_authentication)):
+    args = await read_body(request)
+    return _lastvalues_get(account_id, args)
+
+
+def _lastvalues_get(account_id, args):
+    paths_input = args.get('p')
+    path_filter_input = args.get('f')
+    if (paths_input is None) == (path_filter_input is None):
+        raise HTTPException(status_code=400, detail="Either paths (p) or path filter (f) must be specified")
+
+    if paths_input is not None:
+        try:
+            paths = [Path(p, account_id).path for p in str(paths_input).split(',')]
+        except:
+            raise HTTPException(status_code=400, detail="Path(s) not specified correctly")
+        return JSONResponse(content={
+            'paths': Measurement.fetch_last_values(account_id, paths),
+            'limit_reached': False,
+        }, status_code=200)
+
+    try:
+        pf = str(PathFilter(path_filter_input))
+    except ValidationError:
+        raise ValidationError("Invalid path filter")
+    try:
+        limit = int(args.get('limit', 1000))
+    except:
+        raise HTTPException(status_code=400, detail="Invalid parameter: limit")
+    if not (1 <= limit <= Measurement.MAX_DATAPOINTS_RETURNED):
+        raise HTTPException(status_code=400, detail="Invalid parameter: limit (should be between 1 and {})".format(Measurement.MAX_DATAPOINTS_RETURNED))
+    last_values, limit_reached = Measurement.fetch_last_values_for_filter(account_id, pf, limit)
+    return JSONResponse(content={
+        'paths': last_values,
+        'limit_reached': limit_reached,
+    }, status_code=200)
+
+
+
 @accounts_api.get("/api/accounts/{account_id}/paths")
 def paths_get(account_id: int, request: Request, auth: AuthenticatedUser = Depends(validate_user_authentication)):
     max_results_input = request.query_params.get('limit')
@@ -864,6 +1386,30 @@ def paths_get(account_id: int, request: Request, auth: AuthenticatedUser = Depen
     return JSONResponse(content=ret, status_code=200)
 
 
+# must be registered before '/paths/{path_id}':
+@accounts_api.get("/api/accounts/{account_id}/paths/children")
+def paths_children_get(account_id: int, request: Request, auth: AuthenticatedUser = Depends(validate_user_authentication)):
+    prefix = request.query_params.get('prefix', '')
+    if prefix:
+        try:
+            prefix = str(PathInputValue(prefix))
+        except ValidationError:
+            raise ValidationError("Invalid path prefix")
+    try:
+        limit = int(request.query_params.get('limit', 1000))
+    except:
+        raise HTTPException(status_code=400, detail="Invalid parameter: limit")
+    if not (1 <= limit <= Measurement.MAX_DATAPOINTS_RETURNED):
+        raise HTTPException(status_code=400, detail="Invalid parameter: limit (should be between 1 and {})".format(Measurement.MAX_DATAPOINTS_RETURNED))
+
+    children, limit_reached = Path.find_children(account_id, prefix, limit)
+    return JSONResponse(content={
+        'prefix': prefix,
+        'children': children,
+        'limit_reached': limit_reached,
+    }, status_code=200)
+
+
 @accounts_api.get('/api/accounts/{account_id}/paths/{path_id}')
 def account_path_crud_get(account_id: int, path_id: int, auth: AuthenticatedUser = Depends(validate_user_authentication)):
     rec = Path.get(path_id, account_id)
@@ -7,6 +7,7 @@ from fastapi.responses import JSONResponse
 from .fastapiutils import APIRouter, AuthenticatedUser, validate_user_authentication, api_authorization_header
 from .objschemas import ReqPersonPOST, ResId, ReqAccountsPOST
 from .common import mqtt_publish_changed
+from .ratelimits import get_rate_limits_usage
 from datatypes import Account, Permission, Person, Bot
 from auth import Auth, JWT, AuthFailedException
 import dbutils
@@ -312,3 +313,46 @@ def accounts_crud_post(account: ReqAccountsPOST, auth: AuthenticatedUser = Depen
     account_record = Account.forge_from_input(account.dict())
     account_id = account_record.insert()
     return JSONResponse(content={'name': account_record.name, 'id': account_id}, status_code=201)
+
+
+@admin_api.get('/api/admin/ratelimits')
+def admin_ratelimits_get(auth: AuthenticatedUser = Depends(validate_user_authentication)):
+    """
+        ---
+        get:
+          summary: Get usage of ingestion rate limits
+          tags:
+            - Admin
+          description:
+            Returns the state of per-account token buckets which limit ingestion of values (bucket "values") and creation of
+            new paths (bucket "new_paths"). Only enabled limits are listed. Note that workers take small leases of tokens, so
+            the number of tokens is approximate.
+          responses:
+            200:
+              content:
+                application/json:
+                  schema:
+                    type: object
+                    properties:
+                      list:
+                        type: array
+                        items:
+                          type: object
+                          properties:
+                            account:
+                              type: integer
+                              description: "Account id"
+                            bucket:
+                              type: string
+                              description: "Name of the bucket (values / new_paths)"
+                            tokens:
+                              type: number
+                              description: "Tokens left in the bucket (negative if account is over the limit)"
+                            capacity:
+                              type: number
+                              description: "Bucket capacity (burst)"
+                            rate_per_s:
+                              type: number
+                              description: "Refill rate (tokens per second)"
+    """
+    return JSONResponse(content={'list': get_rate_limits_usage()}, status_code=200)
@@ -1,9 +1,11 @@
 import json
 import os
+import queue
+import threading
 import time
-import traceback
+import uuid
 
-import paho.mqtt.publish as mqtt_publish
+import paho.mqtt.client as paho
 
 from auth import JWT
 from utils import log, telemetry_send
@@ -13,6 +15,12 @@ MQTT_HOSTNAME = os.environ.get('MQTT_HOSTNAME')
 MQTT_PORT = int(os.environ.get('MQTT_PORT', 1883))
 MQTT_WS_HOSTNAME = os.environ.get('MQTT_WS_HOSTNAME', '')
 MQTT_WS_PORT = os.environ.get('MQTT_WS_PORT', '')
+MQTT_PUBLISH_QUEUE_SIZE = int(os.environ.get('MQTT_PUBLISH_QUEUE_SIZE', 100000))
+MQTT_PUBLISH_CLOSE_TIMEOUT_S = float(os.environ.get('MQTT_PUBLISH_CLOSE_TIMEOUT_S', 5))
+# Instead of a message per value, values changes can be coalesced and published in batches (see ValuesChangesCoalescer):
+MQTT_VALUES_COALESCE = os.environ.get('MQTT_VALUES_COALESCE', 'false').lower() in ['true', 'yes', 'on', '1']
+MQTT_VALUES_COALESCE_WINDOW_MS = int(os.environ.get('MQTT_VALUES_COALESCE_WINDOW_MS', 1000))
+MQTT_VALUES_COALESCE_PREFIX_LEVELS = int(os.environ.get('MQTT_VALUES_COALESCE_PREFIX_LEVELS', 0))
 
 
 CORS_DOMAINS = list(filter(len, os.environ.get('GRAFOLEAN_CORS_DOMAINS', '').lower().split(",")))
@@ -52,6 +60,216 @@ class SuperuserJWTToken(object):
         cls.valid_until = {}
 
 
+class MqttPublisher(object):
+    """
+        Long-lived MQTT connection (one per worker) which is used for publishing notifications. Messages are put in a
+        bounded queue and sent by a background thread, so request handlers never wait for the broker. Connecting (and
+        authenticating, which makes Mosquitto call back to our mqtt-auth-plug endpoints) only happens when the connection
+        is lost or when superuser token is refreshed.
+
+        If the queue is full (because broker is unreachable), new messages are dropped - they are only notifications.
+        Before the worker exits, `close()` should be called so that the messages which are still waiting are sent.
+    """
+    SUPERUSER_IDENTIFIER = 'backend_changed_notif'
+    CONNECT_TIMEOUT_S = 10
+    RECONNECT_BACKOFF_MAX_S = 30
+
+    def __init__(self, max_queue_size):
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._client = None
+        self._client_token = None
+        self._connected = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._n_dropped = 0
+        self._closing = False
+        self._in_flight = []  # MQTTMessageInfo of the messages which were not acknowledged yet
+
+    def publish_multiple(self, msgs):
+        """ Queues messages (tuples topic, payload) for publishing, never blocks. """
+        if self._closing:
+            log.warning(f"MQTT publishing: publisher is closed, {len(msgs)} messages dropped")
+            return
+        self._ensure_started()
+        n_dropped = 0
+        for msg in msgs:
+            try:
+                self._queue.put_nowait(msg)
+            except queue.Full:
+                n_dropped += 1
+        if n_dropped:
+            self._n_dropped += n_dropped
+            log.warning(f"MQTT publishing: queue is full, {n_dropped} messages dropped ({self._n_dropped} so far)")
+
+    def _ensure_started(self):
+        # threads do not survive fork, so we start the sender lazily in every (worker) process:
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._client = None
+            self._in_flight = []
+            self._thread = threading.Thread(target=self._run, name='mqtt-publisher', daemon=True)
+            self._thread.start()
+
+    def close(self, timeout):
+        """
+            Stops accepting new messages, sends the ones which are still waiting in the queue, waits (at most `timeout`
+            seconds in total) until the broker acknowledges them, and disconnects.
+        """
+        self._closing = True
+        if self._thread is None or self._pid != os.getpid():
+            return  # nothing was published by this process
+        deadline = time.monotonic() + timeout
+        try:
+            # sender thread exits when it gets to this sentinel, after all the messages before it were published:
+            self._queue.put(None, timeout=timeout)
+            self._thread.join(timeout=max(0, deadline - time.monotonic()))
+            if self._thread.is_alive():
+                log.warning(f"MQTT publishing: closing timed out, {self._queue.qsize()} messages not sent")
+            for info in list(self._in_flight):
+                info.wait_for_publish(timeout=max(0, deadline - time.monotonic()))
+                if not info.is_published():
+                    log.warning("MQTT publishing: closing timed out, some messages were not acknowledged")
+                    break
+        except queue.Full:
+            log.warning(f"MQTT publishing: closing timed out, {self._queue.qsize()} messages not sent")
+        finally:
+            self._disconnect()
+
+    def _run(self):
+        backoff = 1
+        while True:
+            msg = self._queue.get()
+            if msg is None:
+                return
+            topic, payload = msg
+            while True:
+                try:
+                    self._ensure_connected()
+                    info = self._client.publish(topic, payload, qos=1, retain=False)
+                    if info.rc != paho.MQTT_ERR_SUCCESS:
+                        raise Exception(f"publish failed: {paho.error_string(info.rc)}")
+                    self._in_flight = [i for i in self._in_flight if not i.is_published()]
+                    self._in_flight.append(info)
+                    backoff = 1
+                    break
+                except Exception as ex:
+                    log.error(f"MQTT publishing: {str(ex)}, reconnecting in {backoff}s")
+                    self._disconnect()
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, self.RECONNECT_BACKOFF_MAX_S)
+
+    def _ensure_connected(self):
+        # Mosquitto checks our permissions with the token we have connected with, so we must reconnect when it is refreshed:
+        token = SuperuserJWTToken.get_valid_token(self.SUPERUSER_IDENTIFIER)
+        if self._client is not None and self._connected.is_set() and token == self._client_token:
+            return
+        self._disconnect()
+
+        def on_connect(client, userdata, flags, rc):
+            if rc == 0:
+                self._connected.set()
+            else:
+                log.error(f"MQTT publishing: connection refused: {paho.connack_string(rc)}")
+
+        def on_disconnect(client, userdata, rc):
+            self._connected.clear()
+
+        self._client = paho.Client(f"grafolean-backend-{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        self._client.username_pw_set(token, "not.used")
+        self._client.on_connect = on_connect
+        self._client.on_disconnect = on_disconnect
+        self._client_token = token
+        self._client.connect(MQTT_HOSTNAME, MQTT_PORT, keepalive=60)
+        self._client.loop_start()
+        if not self._connected.wait(timeout=self.CONNECT_TIMEOUT_S):
+            raise Exception("could not connect to broker")
+
+    def _disconnect(self):
+        self._connected.clear()
+        if self._client is None:
+            return
+        try:
+            self._client.disconnect()
+            self._client.loop_stop()
+        except Exception:
+            pass
+        self._client = None
+        self._in_flight = []
+
+
+mqtt_publisher = MqttPublisher(MQTT_PUBLISH_QUEUE_SIZE)
+
+
+class ValuesChangesCoalescer(object):
+    """
+        Collects changed values and publishes them in batches, every `window_ms`, instead of publishing one message per
+        value on `changed/accounts/<account_id>/values/<path>`. Only the latest value (by timestamp) of each path is kept.
+
+        Batches are published on `changed/accounts/<account_id>/valuesbatch` (or on `.../valuesbatch/<prefix>` if
+        `prefix_levels` is set, where prefix is made of the first `prefix_levels` segments of the path), with payload
+        `{"<path>": {"v": <value>, "t": <timestamp>}, ...}`, split into messages of at most MAX_PATHS_PER_MESSAGE paths.
+    """
+    MAX_PATHS_PER_MESSAGE = 1000
+
+    def __init__(self, window_ms, prefix_levels):
+        self.window_s = window_ms / 1000.
+        self.prefix_levels = prefix_levels
+        self._pending = {}  # topic -> { path -> { 'v': ..., 't': ... } }
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def add(self, account_id, data):
+        self._ensure_started()
+        with self._lock:
+            for d in data:
+                path = d['p']
+                topic = f'accounts/{account_id}/valuesbatch'
+                if self.prefix_levels > 0:
+                    topic += '/' + '.'.join(path.split('.')[:self.prefix_levels])
+                changes = self._pending.setdefault(topic, {})
+                existing = changes.get(path)
+                if existing is None or float(d['t']) >= float(existing['t']):
+                    changes[path] = { 'v': d['v'], 't': d['t'] }
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        topics_with_payloads = []
+        for topic, changes in pending.items():
+            paths = list(changes.keys())
+            for i in range(0, len(paths), self.MAX_PATHS_PER_MESSAGE):
+                topics_with_payloads.append((topic, {p: changes[p] for p in paths[i:i + self.MAX_PATHS_PER_MESSAGE]}))
+        if topics_with_payloads:
+            mqtt_publish_changed_multiple_payloads(topics_with_payloads)
+
+    def _ensure_started(self):
+        # threads do not survive fork, so we start the flusher lazily in every (worker) process:
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._pending = {}
+            threading.Thread(target=self._run, name='mqtt-values-coalescer', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.window_s)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("MQTT publishing: flushing coalesced values changes failed")
+
+
+values_changes_coalescer = ValuesChangesCoalescer(MQTT_VALUES_COALESCE_WINDOW_MS, MQTT_VALUES_COALESCE_PREFIX_LEVELS)
+
+
 # This function publishes notifications via MQTT when the content of some GET endpoint might have changed. For example,
 # when adding a dashboard this function is called with 'accounts/{}/dashboards' so that anyone interested in dashboards
 # can re-issue GET to the same endpoint URL.
@@ -64,11 +282,4 @@ def mqtt_publish_changed_multiple_payloads(topics_with_payloads):
     if not MQTT_HOSTNAME:
         log.warn("MQTT not connected, not publishing change")
         return
-    superuserJwtToken = SuperuserJWTToken.get_valid_token('backend_changed_notif')
-
-    # https://www.eclipse.org/paho/clients/python/docs/#id2
-    try:
-        msgs = [('changed/{}'.format(t), json.dumps(p), 1, False) for t, p, in topics_with_payloads]
-        mqtt_publish.multiple(msgs, hostname=MQTT_HOSTNAME, port=MQTT_PORT, auth={"username": superuserJwtToken, "password": "not.used"})
-    except Exception as ex:
-        log.error(f"MQTT publishing: exception {''.join(traceback.format_exception(None, ex, ex.__traceback__))}")
+    mqtt_publisher.publish_multiple([('changed/{}'.format(t), json.dumps(p)) for t, p, in topics_with_payloads])
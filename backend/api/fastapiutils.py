@@ -1,10 +1,15 @@
+import json
+import os
 import re
-from typing import Any, Callable
+from typing import Any, AsyncIterator, Callable
+import zlib
 
-from fastapi import APIRouter as FastAPIRouter, Security, Request, HTTPException
+from fastapi import APIRouter as FastAPIRouter, Security, Request, HTTPException, Response
 from fastapi.types import DecoratedCallable
 from fastapi.security.api_key import APIKeyHeader, APIKeyQuery, Request
+import msgpack
 from pydantic import BaseModel
+import zstandard
 
 from datatypes import Bot, Permission
 from auth import JWT, AuthFailedException
@@ -40,6 +45,118 @@ class APIRouter(FastAPIRouter):
         return decorator
 
 
+CONTENT_TYPE_MSGPACK = 'application/msgpack'
+CONTENT_TYPES_MSGPACK = [CONTENT_TYPE_MSGPACK, 'application/x-msgpack']
+
+
+class MsgpackResponse(Response):
+    media_type = CONTENT_TYPE_MSGPACK
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content, use_bin_type=True)
+
+
+def get_content_type(request: Request) -> str:
+    return request.headers.get('content-type', '').split(';')[0].strip().lower()
+
+
+def accepts_msgpack(request: Request) -> bool:
+    """ Returns True if client prefers MessagePack to JSON. """
+    accepted = [a.split(';')[0].strip().lower() for a in request.headers.get('accept', '').split(',')]
+    return any(a in CONTENT_TYPES_MSGPACK for a in accepted)
+
+
+# Compressed bodies are decompressed while they are being received. To protect against decompression bombs, decompressed
+# size is limited, and compressed data is decompressed in small steps so that a tiny input can't produce huge output at once:
+MAX_DECOMPRESSED_BODY_SIZE = int(os.environ.get('MAX_DECOMPRESSED_BODY_SIZE', 100 * 1024 * 1024))
+DECOMPRESS_STEP_SIZE = 64 * 1024
+
+
+class _GzipDecoder(object):
+    errors = (zlib.error,)
+
+    def __init__(self):
+        self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        while data:
+            yield self._d.decompress(data, DECOMPRESS_STEP_SIZE)
+            data = self._d.unconsumed_tail
+            if self._d.eof and self._d.unused_data:
+                # multiple gzip members are allowed - they should be decompressed as if they were concatenated:
+                data = self._d.unused_data
+                self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def is_finished(self):
+        return self._d.eof
+
+
+class _ZstdDecoder(object):
+    # zstd decompressor doesn't allow limiting the output size, and a block of 128kB could be encoded in a few bytes, so we
+    # must feed it with small parts of input instead:
+    INPUT_STEP_SIZE = 256
+
+    def __init__(self):
+        self.errors = (zstandard.ZstdError,)
+        self._d = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        for i in range(0, len(data), self.INPUT_STEP_SIZE):
+            yield self._d.decompress(data[i:i + self.INPUT_STEP_SIZE])
+
+    def is_finished(self):
+        return self._d.eof
+
+
+def _get_body_decoder(request: Request):
+    content_encoding = request.headers.get('content-encoding', 'identity').strip().lower()
+    if content_encoding == 'identity':
+        return None
+    if content_encoding in ['gzip', 'x-gzip']:
+        return _GzipDecoder()
+    if content_encoding == 'zstd':
+        return _ZstdDecoder()
+    raise HTTPException(status_code=415, detail=f"Unsupported Content-Encoding: {content_encoding}")
+
+
+async def iter_body(request: Request) -> AsyncIterator[bytes]:
+    """ Yields parts of request body as they are received, decompressing them if needed (Content-Encoding gzip or zstd). """
+    decoder = _get_body_decoder(request)
+    if decoder is None:
+        async for body_part in request.stream():
+            yield body_part
+        return
+
+    size = 0
+    async for body_part in request.stream():
+        decompressed_parts = decoder.decompress(body_part)
+        while True:
+            try:
+                decompressed = next(decompressed_parts, None)
+            except decoder.errors:
+                raise HTTPException(status_code=400, detail="Invalid compressed body")
+            if decompressed is None:
+                break
+            size += len(decompressed)
+            if size > MAX_DECOMPRESSED_BODY_SIZE:
+                raise HTTPException(status_code=413, detail=f"Decompressed body is too large (max. {MAX_DECOMPRESSED_BODY_SIZE} bytes)")
+            if decompressed:
+                yield decompressed
+    if not decoder.is_finished():
+        raise HTTPException(status_code=400, detail="Compressed body is incomplete")
+
+
+async def read_body(request: Request) -> Any:
+    """ Decodes the request body, either JSON or (if Content-Type says so) MessagePack. """
+    body = b''.join([body_part async for body_part in iter_body(request)])
+    if get_content_type(request) in CONTENT_TYPES_MSGPACK:
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except (ValueError, msgpack.UnpackException):
+            raise HTTPException(status_code=400, detail="Invalid MessagePack body")
+    return json.loads(body)
+
+
 class AuthenticatedUser(BaseModel):
     user_id: int
     user_is_bot: bool
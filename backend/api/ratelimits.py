@@ -0,0 +1,111 @@
+import math
+import os
+import threading
+import time
+
+from fastapi import HTTPException
+
+from datatypes import RateLimitBucket
+
+
+# Limits apply to each account separately; 0 means no limit:
+RATE_LIMIT_VALUES_PER_S = float(os.environ.get('RATE_LIMIT_VALUES_PER_S', 0))
+RATE_LIMIT_VALUES_BURST = float(os.environ.get('RATE_LIMIT_VALUES_BURST', RATE_LIMIT_VALUES_PER_S * 10))
+RATE_LIMIT_NEW_PATHS_PER_MIN = float(os.environ.get('RATE_LIMIT_NEW_PATHS_PER_MIN', 0))
+RATE_LIMIT_NEW_PATHS_BURST = float(os.environ.get('RATE_LIMIT_NEW_PATHS_BURST', RATE_LIMIT_NEW_PATHS_PER_MIN))
+
+
+class RateLimiter(object):
+    """
+        Per-account token bucket limiter. Buckets are kept in DB (see RateLimitBucket) so that the limits are shared by all
+        workers, but to avoid a DB roundtrip on every request, each worker takes a lease of tokens (a fraction of bucket
+        capacity) and spends it locally. When the shared bucket is empty (or in debt), the worker remembers when it will
+        have tokens again, and until then it rejects the requests without touching the DB.
+    """
+    LEASE_FRACTION = 0.1
+
+    def __init__(self, bucket, rate_per_s, capacity):
+        self.bucket = bucket
+        self.rate_per_s = rate_per_s
+        self.capacity = capacity
+        self.lease_size = max(1., capacity * self.LEASE_FRACTION)
+        self._leased = {}  # account_id -> tokens which were taken from the shared bucket, but not spent yet
+        self._blocked_until = {}  # account_id -> time when the shared bucket will have tokens again
+        self._account_locks = {}  # account_id -> lock which is held while spending account's tokens
+        self._lock = threading.Lock()  # guards _account_locks only, never held during DB access
+
+    @property
+    def enabled(self):
+        return self.rate_per_s > 0
+
+    def blocked_for_s(self, account_id):
+        """ Returns number of seconds until the account can spend tokens again (0 if it can spend them now). """
+        if not self.enabled:
+            return 0.
+        return max(0., self._blocked_until.get(account_id, 0.) - time.time())
+
+    def consume(self, account_id, n):
+        """
+            Spends `n` tokens, unless the bucket is empty - returns False in this case. Note that the bucket can go into
+            debt (if `n` is larger than the number of tokens left), which blocks the next requests for a while.
+        """
+        return self._spend(account_id, n, force=False)
+
+    def charge(self, account_id, n):
+        """ Spends `n` tokens for something that was already done, even if the bucket is empty. """
+        self._spend(account_id, n, force=True)
+
+    def _account_lock(self, account_id):
+        with self._lock:
+            return self._account_locks.setdefault(account_id, threading.Lock())
+
+    def _spend(self, account_id, n, force):
+        if not self.enabled:
+            return True
+        with self._account_lock(account_id):
+            if n <= 0:
+                return force or self.blocked_for_s(account_id) <= 0
+            leased = self._leased.get(account_id, 0.)
+            if leased >= n:
+                self._leased[account_id] = leased - n
+                return True
+            if not force and self.blocked_for_s(account_id) > 0:
+                return False
+
+            # take what we need from the shared bucket (and a new lease, unless we are paying off a debt):
+            needed = n - leased if force else n - leased + self.lease_size
+            taken, tokens_left = RateLimitBucket.take(account_id, self.bucket, needed, self.rate_per_s, self.capacity, force)
+            if taken:
+                leased += taken - n
+                if tokens_left < 0 and leased > 0:
+                    # we went into debt - give the rest of the lease back instead of spending it while others are blocked:
+                    _, tokens_left = RateLimitBucket.take(account_id, self.bucket, -leased, self.rate_per_s, self.capacity, force=True)
+                    leased = 0.
+                self._leased[account_id] = leased
+            if tokens_left < 1:
+                self._blocked_until[account_id] = time.time() + (1 - tokens_left) / self.rate_per_s
+            return bool(taken)
+
+
+values_rate_limiter = RateLimiter('values', RATE_LIMIT_VALUES_PER_S, RATE_LIMIT_VALUES_BURST)
+new_paths_rate_limiter = RateLimiter('new_paths', RATE_LIMIT_NEW_PATHS_PER_MIN / 60., RATE_LIMIT_NEW_PATHS_BURST)
+
+
+def check_rate_limits(account_id, n_values):
+    """
+        Raises HTTPException (429) if account is over its limits, otherwise spends `n_values` tokens. If `n_values` is 0,
+        only local state is checked (DB is never accessed), which allows rejecting requests before even reading them.
+    """
+    # new paths are charged after they are created, here we just check if the account is still paying off its debt:
+    for limiter, n in [(new_paths_rate_limiter, 0), (values_rate_limiter, n_values)]:
+        if not limiter.consume(account_id, n):
+            retry_after_s = max(1, math.ceil(limiter.blocked_for_s(account_id)))
+            raise HTTPException(status_code=429, detail=f"Rate limit exceeded ({limiter.bucket}), please retry later",
+                                headers={'Retry-After': str(retry_after_s)})
+
+
+def get_rate_limits_usage():
+    limiters = [l for l in [values_rate_limiter, new_paths_rate_limiter] if l.enabled]
+    if not limiters:
+        return []
+    return RateLimitBucket.get_all({l.bucket: (l.rate_per_s, l.capacity) for l in limiters})
@@ -0,0 +1,155 @@
+import math
+import os
+import threading
+
+from datatypes import Measurement
+from utils import log
+
+
+WRITE_BEHIND_ENABLED = os.environ.get('WRITE_BEHIND', 'false').lower() in ['true', 'yes', 'on', '1']
+WRITE_BEHIND_MAX_ROWS = int(os.environ.get('WRITE_BEHIND_MAX_ROWS', 200000))
+WRITE_BEHIND_FLUSH_ROWS = int(os.environ.get('WRITE_BEHIND_FLUSH_ROWS', 20000))
+WRITE_BEHIND_FLUSH_INTERVAL_MS = int(os.environ.get('WRITE_BEHIND_FLUSH_INTERVAL_MS', 1000))
+WRITE_BEHIND_MAX_RETRIES = int(os.environ.get('WRITE_BEHIND_MAX_RETRIES', 3))
+
+
+class WriteBehindBuffer(object):
+    """
+        Bounded in-process queue of values which were accepted, but not saved yet. A background thread flushes the values
+        of all the waiting requests (of all accounts) together, every `flush_interval_ms` or as soon as `flush_rows` values
+        are waiting. This turns many small transactions into a few large upserts.
+
+        When values are saved, `on_flushed(account_id, data, stats_count_path, newly_created_paths)` is called for each
+        account (and type of request), so that stats can be updated and changes published.
+
+        If saving the values fails, they are put back in the buffer (if there is room for them) and retried with the next
+        flush, at most `max_retries` times. Paths which were created by a failed attempt are remembered with the values, so
+        that they are still reported as newly created when the values are finally saved.
+    """
+
+    def __init__(self, max_rows, flush_rows, flush_interval_ms, on_flushed, max_retries=WRITE_BEHIND_MAX_RETRIES):
+        self.max_rows = max_rows
+        self.flush_rows = flush_rows
+        self.flush_interval_s = flush_interval_ms / 1000.
+        self.on_flushed = on_flushed
+        self.max_retries = max_retries
+        self._entries = []  # list of (account_id, data, stats_count_path, n_retries, newly_created_paths)
+        self._n_rows = 0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+
+    @property
+    def retry_after_s(self):
+        return max(1, math.ceil(self.flush_interval_s))
+
+    def enqueue(self, account_id, data, stats_count_path):
+        """ Returns False if there is no room in the buffer - the client should retry later. """
+        self._ensure_started()
+        with self._cond:
+            if self._n_rows + len(data) > self.max_rows:
+                return False
+            self._entries.append((account_id, data, stats_count_path, 0, []))
+            self._n_rows += len(data)
+            if self._n_rows >= self.flush_rows:
+                self._cond.notify()
+        return True
+
+    def shutdown(self):
+        """ Stops the flusher thread and saves whatever is still waiting. """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=30)
+        self.flush()
+
+    def _ensure_started(self):
+        # threads do not survive fork, so we start the flusher lazily in every (worker) process:
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._entries, self._n_rows = [], 0
+            self._thread = threading.Thread(target=self._run, name='write-behind-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._n_rows >= self.flush_rows or self._stopping, timeout=self.flush_interval_s)
+                if self._stopping:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Write-behind: flushing failed")
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                entries, self._entries, self._n_rows = self._entries, [], 0
+            if not entries:
+                return
+
+            # merge the values of the same account and type of request, so that their paths are resolved together:
+            grouped = {}
+            n_retries = {}
+            new_paths = {}  # paths are created even if saving the values fails, so we collect them over all attempts
+            for account_id, data, stats_count_path, entry_n_retries, newly_created_paths in entries:
+                key = (account_id, stats_count_path)
+                grouped.setdefault(key, []).extend(data)
+                n_retries[key] = max(n_retries.get(key, 0), entry_n_retries)
+                new_paths.setdefault(key, []).extend(newly_created_paths)
+            groups = [(account_id, stats_count_path, data) for (account_id, stats_count_path), data in grouped.items()]
+
+            try:
+                flushed = self._save(groups, new_paths)
+            except Exception:
+                # one bad group shouldn't cause the values of everyone else to be lost:
+                log.exception("Write-behind: saving merged values failed, saving them separately")
+                flushed = []
+                for group in groups:
+                    try:
+                        flushed.extend(self._save([group], new_paths))
+                    except Exception:
+                        log.exception(f"Write-behind: saving {len(group[2])} values of account {group[0]} failed")
+                        self._requeue(group, n_retries[(group[0], group[1])] + 1, new_paths[(group[0], group[1])])
+
+            for account_id, stats_count_path, data in flushed:
+                try:
+                    self.on_flushed(account_id, data, stats_count_path, new_paths[(account_id, stats_count_path)])
+                except Exception:
+                    log.exception("Write-behind: post-processing of saved values failed")
+
+    def _requeue(self, group, n_retries, newly_created_paths):
+        """ Puts the values back in front of the buffer (they are older than the waiting ones), unless they were retried
+            too many times already or there is no room for them. """
+        account_id, stats_count_path, data = group
+        with self._cond:
+            if n_retries > self.max_retries:
+                log.error(f"Write-behind: dropping {len(data)} values of account {account_id} after {self.max_retries} retries")
+                return
+            if self._n_rows + len(data) > self.max_rows:
+                log.error(f"Write-behind: dropping {len(data)} values of account {account_id}, buffer is full")
+                return
+            self._entries.insert(0, (account_id, data, stats_count_path, n_retries, newly_created_paths))
+            self._n_rows += len(data)
+
+    @staticmethod
+    def _save(groups, new_paths):
+        """ Saves the values of all groups in a single upsert. Newly created paths are added to `new_paths` (per group)
+            as soon as they are created, so that they are not lost if the upsert fails. """
+        rows = {}
+        flushed = []
+        for account_id, stats_count_path, data in groups:
+            account_rows, newly_created_paths = Measurement.prepare_rows(account_id, data)
+            rows.update(account_rows)
+            new_paths[(account_id, stats_count_path)].extend(newly_created_paths)
+            flushed.append((account_id, stats_count_path, data))
+        Measurement.upsert_rows(rows)
+        return flushed
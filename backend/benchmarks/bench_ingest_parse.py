@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+    Compares the cost of parsing values payloads: JSON (as used by PUT /values with application/json) vs. line
+    protocol (application/x-grafolean-line-protocol). Usage:
+
+        $ cd backend/
+        $ python benchmarks/bench_ingest_parse.py [n_values]
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datatypes import Measurement
+
+
+def build_payloads(n_values):
+    values = [{'p': f'netflow.1m.ingress.entity.123.if.4.top.s.ip.10-0-0-{i % 250}', 'v': i * 1.5, 't': 1234567890.123 + i} for i in range(n_values)]
+    body_json = json.dumps(values).encode('utf-8')
+    body_line_protocol = ''.join(f"{x['p']} {x['v']} {x['t']}\n" for x in values).encode('utf-8')
+    return body_json, body_line_protocol
+
+
+def parse_json(body):
+    return json.loads(body)
+
+
+def parse_line_protocol(body):
+    return [Measurement.parse_line_protocol(line, line_nr, None) for line_nr, line in enumerate(body.split(b'\n'), 1) if line]
+
+
+def main():
+    n_values = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    n_runs = 20
+    body_json, body_line_protocol = build_payloads(n_values)
+    assert len(parse_json(body_json)) == len(parse_line_protocol(body_line_protocol)) == n_values
+
+    print(f"{n_values} values, best of {n_runs} runs:")
+    for label, func, body in [
+        ('JSON', parse_json, body_json),
+        ('line protocol', parse_line_protocol, body_line_protocol),
+    ]:
+        t = min(timeit.repeat(lambda: func(body), number=1, repeat=n_runs))
+        print(f"  {label:<15} {len(body):>10} bytes {t * 1000:>9.2f} ms {t * 1e9 / n_values:>9.0f} ns/value")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+    Compares the cost of validating values payloads: per-value (PathInputValue, Timestamp, MeasuredValue and a datetime
+    for every value) vs. batch validation (Measurement.validate_batch). Usage:
+
+        $ cd backend/
+        $ python benchmarks/bench_ingest_validate.py [n_values]
+"""
+from datetime import datetime
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datatypes import Measurement, MeasuredValue, PathInputValue, Timestamp
+
+
+def build_payloads(n_values):
+    numeric = [{'p': f'netflow.1m.ingress.entity.123.if.4.top.s.ip.10-0-0-{i % 250}', 'v': i * 1.5, 't': 1234567890.123 + i} for i in range(n_values)]
+    # line protocol (and some bots) send timestamps and values as strings:
+    strings = [{'p': x['p'], 'v': str(x['v']), 't': str(x['t'])} for x in numeric]
+    return numeric, strings
+
+
+def validate_per_value(put_data):
+    rows = []
+    for x in put_data:
+        PathInputValue(x['p'])
+        rows.append((x['p'], datetime.utcfromtimestamp(float(Timestamp(x['t']))), str(MeasuredValue(x['v']))))
+    return rows
+
+
+def validate_batch(put_data):
+    valid, errors = Measurement.validate_batch(put_data)
+    return valid
+
+
+def main():
+    n_values = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    n_runs = 20
+    numeric, strings = build_payloads(n_values)
+
+    print(f"{n_values} values, best of {n_runs} runs:")
+    for label, put_data in [('numeric', numeric), ('strings', strings)]:
+        for method, func in [('per-value', validate_per_value), ('batch', validate_batch)]:
+            assert len(func(put_data)) == n_values
+            t = min(timeit.repeat(lambda: func(put_data), number=1, repeat=n_runs))
+            print(f"  {label:<8} {method:<10} {t * 1000:>9.2f} ms {t * 1e9 / n_values:>9.0f} ns/value")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 import calendar
 import dns
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime, timezone, timedelta
 from functools import lru_cache
 import io
@@ -9,6 +9,7 @@ import math
 import os
 import re
 import tarfile
+import threading
 import time
 
 from fastapi import HTTPException
@@ -18,7 +19,8 @@ import psycopg2.extras
 import requests
 from slugify import slugify
 
-from dbutils import db
+from dbutils import db, db_notify, DBListener
+from pathtrie import PathTrie
 from utils import log
 from validators import (
     DashboardInputs, WidgetSchemaInputs, WidgetsPositionsSchemaInputs, PersonSchemaInputsPOST,
@@ -35,9 +37,10 @@ from const import SYSTEM_PATH_PREFIX, SYSTEM_PATH_INSERTED_COUNT
 def clear_all_lru_cache():
     # when testing, it is important to clear memoization cache in between runs, or the results will be... interesting.
     # Dashboard.get_id.cache_clear()
-    # Path._get_path_id_from_db.cache_clear()
+    PathIdCache.clear()
+    PathTrieIndex.clear()
+    AggrTileCache.clear()
     # PathFilter._find_matching_paths_for_filter.cache_clear()
-    pass
 
 
 class ValidationError(HTTPException):
@@ -72,6 +75,324 @@ class _RegexValidatedInputValue(object):
 class PathInputValue(_RegexValidatedInputValue):
     _regex = re.compile(r'^([a-zA-Z0-9_-]|([%](2e|3a)))+([.]([a-zA-Z0-9_-]|([%](2e|3a)))+)*$')
 
+# Changes of paths are published on this channel. A single listener (per process) is shared by all the caches which
+# depend on paths:
+PATHS_NOTIFY_CHANNEL = 'grafolean_paths'
+paths_listener = DBListener(PATHS_NOTIFY_CHANNEL)
+
+
+class PathIdCache(object):
+    """
+        Per-worker LRU cache of path ids, keyed by (account_id, path). Every change of paths is published on a Postgres
+        notification channel and all workers (including this one) evict the affected entries when they receive it.
+
+        Notifications might get lost while we are not connected to DB, so the cache is only used while we are listening,
+        and it is cleared every time we (re)connect.
+    """
+    NOTIFY_CHANNEL = PATHS_NOTIFY_CHANNEL
+    NOTIFY_MAX_IDS = 500  # payload of NOTIFY is limited to 8000 bytes
+    MAX_SIZE = int(os.environ.get('PATH_ID_CACHE_SIZE', 100000))
+
+    _entries = OrderedDict()  # (account_id, path) -> path_id, in LRU order
+    _keys_by_id = {}  # path_id -> (account_id, path)
+    _generation = 0  # incremented on every eviction, so that we don't cache a value that was read before it
+    _lock = threading.Lock()
+
+    @classmethod
+    def is_enabled(cls):
+        if cls.MAX_SIZE <= 0:
+            return False
+        paths_listener.ensure_started()
+        return paths_listener.is_listening
+
+    @classmethod
+    def get_generation(cls):
+        return cls._generation
+
+    @classmethod
+    def get(cls, account_id, path):
+        if not cls.is_enabled():
+            return None
+        key = (account_id, path)
+        with cls._lock:
+            path_id = cls._entries.get(key)
+            if path_id is not None:
+                cls._entries.move_to_end(key)
+            return path_id
+
+    @classmethod
+    def put(cls, account_id, path_ids, generation):
+        """ Remembers ids of paths (path_ids is a dict path -> id) - unless something was evicted since `generation`. """
+        if not cls.is_enabled():
+            return
+        with cls._lock:
+            if generation != cls._generation:
+                return
+            for path, path_id in path_ids.items():
+                key = (account_id, path)
+                cls._entries[key] = path_id
+                cls._entries.move_to_end(key)
+                cls._keys_by_id[path_id] = key
+            while len(cls._entries) > cls.MAX_SIZE:
+                _, evicted_path_id = cls._entries.popitem(last=False)
+                cls._keys_by_id.pop(evicted_path_id, None)
+
+    @classmethod
+    def evict(cls, path_ids):
+        with cls._lock:
+            cls._generation += 1
+            for path_id in path_ids:
+                key = cls._keys_by_id.pop(path_id, None)
+                if key is not None:
+                    cls._entries.pop(key, None)
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._generation += 1
+            cls._entries.clear()
+            cls._keys_by_id.clear()
+
+    @classmethod
+    def notify(cls, db_cursor, operation, account_id, path_ids):
+        """ Lets all workers know that paths were inserted, updated or deleted. """
+        path_ids = list(path_ids)
+        if operation != 'insert':
+            cls.evict(path_ids)  # no need to wait for the notification to come back to us
+        for i in range(0, len(path_ids), cls.NOTIFY_MAX_IDS):
+            payload = json.dumps({'op': operation, 'account': account_id, 'ids': path_ids[i:i + cls.NOTIFY_MAX_IDS]})
+            db_notify(db_cursor, cls.NOTIFY_CHANNEL, payload)
+
+    @classmethod
+    def _on_notify(cls, payload):
+        try:
+            notification = json.loads(payload)
+        except ValueError:
+            log.warning(f"Invalid path change notification: {payload}")
+            return
+        # new paths can't invalidate anything because we don't cache misses:
+        if notification['op'] != 'insert':
+            cls.evict(notification['ids'])
+
+
+class PathTrieIndex(object):
+    """
+        Per-worker index of paths (PathTrie) of recently used accounts, so that path filters can be matched without
+        asking DB. The index of an account is built when its paths are searched for the first time, and is then kept up
+        to date by applying the changes of paths - local changes immediately, and changes made by other workers when
+        notifications (the same as for PathIdCache) are received. Same as PathIdCache, the index is only used while we
+        are listening for notifications.
+    """
+    # total for all indexed accounts of a worker; each path takes ~400 bytes, so the default limit can take up to ~40MB
+    # per worker:
+    MAX_PATHS = int(os.environ.get('PATH_TRIE_MAX_PATHS', 100000))
+
+    _tries = OrderedDict()  # account_id -> PathTrie, in LRU order
+    _too_large = set()  # accounts which have more than MAX_PATHS paths
+    _building = set()  # accounts whose tries are being built (by some thread)
+    _generations = defaultdict(int)  # account_id -> incremented on every change, so that we don't keep a stale trie
+    _lock = threading.Lock()
+
+    @classmethod
+    def is_enabled(cls):
+        if cls.MAX_PATHS <= 0:
+            return False
+        paths_listener.ensure_started()
+        return paths_listener.is_listening
+
+    @classmethod
+    def find_matching_paths(cls, account_id, path_filter, limit, allow_trailing_chars=False):
+        """ Same as PathFilter.find_matching_paths(), but returns None if account's paths are not (and can't be) indexed. """
+        if not cls.is_enabled():
+            return None
+        with cls._lock:
+            trie = cls._tries.get(account_id)
+            if trie is not None:
+                cls._tries.move_to_end(account_id)
+                return trie.find(path_filter, limit, allow_trailing_chars)
+            # only one thread builds the trie of an account, the others use DB in the meantime:
+            if account_id in cls._too_large or account_id in cls._building:
+                return None
+            cls._building.add(account_id)
+            generation = cls._generations[account_id]
+
+        try:
+            trie = cls._build(account_id)
+        finally:
+            with cls._lock:
+                cls._building.discard(account_id)
+        if trie is None:
+            return None
+
+        with cls._lock:
+            # if paths were changed in the meantime, the trie might be stale - use it only this time:
+            if generation == cls._generations[account_id]:
+                cls._tries[account_id] = trie
+                while sum(len(t) for t in cls._tries.values()) > cls.MAX_PATHS:
+                    cls._tries.popitem(last=False)
+            return trie.find(path_filter, limit, allow_trailing_chars)
+
+    @classmethod
+    def _build(cls, account_id):
+        with db.cursor() as c:
+            c.execute('SELECT id, path FROM paths WHERE account = %s LIMIT %s;', (account_id, cls.MAX_PATHS + 1,))
+            res = c.fetchall()
+        if len(res) > cls.MAX_PATHS:
+            with cls._lock:
+                cls._too_large.add(account_id)
+            return None
+        trie = PathTrie()
+        for path_id, path in res:
+            trie.add(path_id, path)
+        return trie
+
+    @classmethod
+    def update(cls, account_id, paths_by_id):
+        """ Adds or renames paths (paths_by_id is a dict path_id -> path; path None means that it was removed). """
+        with cls._lock:
+            cls._generations[account_id] += 1
+            trie = cls._tries.get(account_id)
+            if trie is None:
+                return
+            for path_id, path in paths_by_id.items():
+                if path is None:
+                    trie.remove(path_id)
+                else:
+                    trie.add(path_id, path)
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            for account_id in cls._tries:
+                cls._generations[account_id] += 1
+            cls._tries.clear()
+            cls._too_large.clear()
+
+    @classmethod
+    def _on_notify(cls, payload):
+        try:
+            notification = json.loads(payload)
+        except ValueError:
+            log.warning(f"Invalid path change notification: {payload}")
+            return
+        account_id, path_ids = notification['account'], notification['ids']
+        with cls._lock:
+            trie = cls._tries.get(account_id)
+            if trie is None:
+                cls._generations[account_id] += 1
+                return
+            if notification['op'] == 'insert':
+                # our own inserts were already applied:
+                path_ids = [path_id for path_id in path_ids if path_id not in trie]
+        if notification['op'] == 'delete':
+            cls.update(account_id, {path_id: None for path_id in path_ids})
+            return
+        if not path_ids:
+            return
+        with db.cursor() as c:
+            c.execute('SELECT id, path FROM paths WHERE account = %s AND id = ANY(%s);', (account_id, path_ids,))
+            paths_by_id = {path_id: None for path_id in path_ids}  # the paths which are not found were removed meanwhile
+            paths_by_id.update(dict(c.fetchall()))
+        cls.update(account_id, paths_by_id)
+
+
+class AggrTileCache(object):
+    """
+        Per-worker LRU cache of aggregated data. Data of each path and aggregation level is split into tiles of
+        TILE_BUCKETS consecutive aggregation intervals (aligned to TimescaleDB epoch), and only the tiles which are
+        closed (which end at least REFRESH_LAG_BUCKETS intervals before now) are cached - the data in them doesn't
+        change anymore, except if values are backfilled. Because continuous aggregates are refreshed in background
+        anyway, backfilled data is not expected to be visible immediately; cached tiles simply expire after TTL
+        seconds.
+
+        Tiles of paths which are deleted or changed are evicted when path change notifications (the same as for
+        PathIdCache) are received, so (same as PathIdCache) the cache is only used while we are listening for them.
+    """
+    TILE_BUCKETS = 100
+    MAX_SIZE = int(os.environ.get('AGGR_TILE_CACHE_SIZE', 2000))
+    MAX_TILES_PER_REQUEST = int(os.environ.get('AGGR_TILE_CACHE_MAX_TILES_PER_REQUEST', 100))
+    REFRESH_LAG_BUCKETS = int(os.environ.get('AGGR_TILE_CACHE_REFRESH_LAG_BUCKETS', 2))
+    TTL = int(os.environ.get('AGGR_TILE_CACHE_TTL', 3600))
+
+    _entries = OrderedDict()  # (path_id, aggr_level, tile_start) -> (expires_at, rows), in LRU order
+    _lock = threading.Lock()
+
+    @classmethod
+    def is_enabled(cls):
+        if cls.MAX_SIZE <= 0:
+            return False
+        paths_listener.ensure_started()
+        return paths_listener.is_listening
+
+    @classmethod
+    def tile_length(cls, aggr_level):
+        return (Measurement.AGGR_FACTOR ** aggr_level) * 3600 * cls.TILE_BUCKETS
+
+    @classmethod
+    def get_closed_tile_starts(cls, aggr_level, t_from, t_to, now):
+        """ Returns the starts of closed tiles which overlap [t_from, t_to], and the time until which the tiles are closed. """
+        tile_length = cls.tile_length(aggr_level)
+        aggr_interval = tile_length // cls.TILE_BUCKETS
+        closed_until = now - cls.REFRESH_LAG_BUCKETS * aggr_interval
+        epoch = Measurement.TIMESCALEDB_EPOCH
+        closed_until = epoch + int((closed_until - epoch) // tile_length) * tile_length
+        tile_start = epoch + int((t_from - epoch) // tile_length) * tile_length
+        tile_starts = []
+        while tile_start < closed_until and tile_start <= t_to:
+            tile_starts.append(tile_start)
+            tile_start += tile_length
+        return tile_starts, closed_until
+
+    @classmethod
+    def get(cls, key, now):
+        with cls._lock:
+            entry = cls._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, rows = entry
+            if expires_at <= now:
+                del cls._entries[key]
+                return None
+            cls._entries.move_to_end(key)
+            return rows
+
+    @classmethod
+    def put(cls, key, rows, now):
+        with cls._lock:
+            cls._entries[key] = (now + cls.TTL, rows)
+            cls._entries.move_to_end(key)
+            while len(cls._entries) > cls.MAX_SIZE:
+                cls._entries.popitem(last=False)
+
+    @classmethod
+    def evict_paths(cls, path_ids):
+        path_ids = set(path_ids)
+        with cls._lock:
+            for key in [key for key in cls._entries if key[0] in path_ids]:
+                del cls._entries[key]
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._entries.clear()
+
+    @classmethod
+    def _on_notify(cls, payload):
+        try:
+            notification = json.loads(payload)
+        except ValueError:
+            log.warning(f"Invalid path change notification: {payload}")
+            return
+        # new paths don't have any cached tiles:
+        if notification['op'] != 'insert':
+            cls.evict_paths(notification['ids'])
+
+
+paths_listener.subscribe(on_notify=PathIdCache._on_notify, on_reconnect=PathIdCache.clear)
+paths_listener.subscribe(on_notify=PathTrieIndex._on_notify, on_reconnect=PathTrieIndex.clear)
+paths_listener.subscribe(on_notify=AggrTileCache._on_notify, on_reconnect=AggrTileCache.clear)
+
+
 class Path(object):
 
     def __init__(self, path, account_id, force_id=None, newly_created=False):
@@ -96,6 +417,30 @@ class Path(object):
             path_id = Path._insert_path_to_db(account_id, path)
             return cls(path, account_id, path_id, newly_created=True)
 
+    @classmethod
+    def forge_from_paths(cls, paths, account_id, allow_system=False):
+        """
+            Batch version of forge_from_path() (with ensure_in_db=True). All distinct paths are looked up in a single query,
+            missing ones are inserted in a single statement. Returns a dict which maps each distinct path to its Path object.
+        """
+        distinct_paths = set(paths)
+        for path in distinct_paths:
+            if not allow_system and path.startswith(SYSTEM_PATH_PREFIX):
+                raise ValidationError("Invalid path - should not start with 'system.'!")
+            PathInputValue(path)  # validate before we hit the DB
+
+        path_ids = Path._get_path_ids_from_db(account_id, distinct_paths)
+        missing_paths = distinct_paths - path_ids.keys()
+        new_path_ids = Path._insert_paths_to_db(account_id, missing_paths) if missing_paths else {}
+        # if some other request has inserted the same paths in the meantime, ON CONFLICT skipped them, so we must fetch their ids:
+        concurrently_inserted_paths = missing_paths - new_path_ids.keys()
+        if concurrently_inserted_paths:
+            path_ids.update(Path._get_path_ids_from_db(account_id, concurrently_inserted_paths))
+
+        ret = {p: cls(p, account_id, path_id) for p, path_id in path_ids.items()}
+        ret.update({p: cls(p, account_id, path_id, newly_created=True) for p, path_id in new_path_ids.items()})
+        return ret
+
     @classmethod
     def forge_from_input(cls, json_data, account_id, force_id=None):
         jsonschema.validate(json_data, PathSchemaInputs)
@@ -104,32 +449,71 @@ class Path(object):
         return cls(path, account_id, force_id=force_id)
 
     @staticmethod
-    # The problem with lru_cache: when do we clear it? Any change should invalidate cache, but in multi-worker
-    # setup this means clearing lru_cache in another process. For this reason we disable cache until a better
-    # solution is found.
-    #@lru_cache(maxsize=None)
     def _get_path_id_from_db(account_id, path):
+        # Path ids are cached in PathIdCache, which is invalidated across workers via Postgres notifications:
+        path_cleaned = path.strip()
+        path_id = PathIdCache.get(account_id, path_cleaned)
+        if path_id is not None:
+            return path_id
+
+        generation = PathIdCache.get_generation()
         with db.cursor() as c:
-            path_cleaned = path.strip()
             c.execute('SELECT id FROM paths WHERE account = %s AND path=%s;', (account_id, path_cleaned,))
             res = c.fetchone()
             if not res:
-                # If path record doesn't exist (yet), we avoid lru_cache by throwing an exception. This works
-                # as of Python 3.6 but is not documented behaviour. The tests will warn us if it ever
-                # starts failing.
                 raise PathNotInDBError()
 
             path_id = res[0]
-            return path_id
+        PathIdCache.put(account_id, {path_cleaned: path_id}, generation)
+        return path_id
 
     @staticmethod
     def _insert_path_to_db(account_id, path):
+        generation = PathIdCache.get_generation()
         with db.cursor() as c:
             path_cleaned = path.strip()
             c.execute('INSERT INTO paths (account, path) VALUES (%s, %s) RETURNING id;', (account_id, path_cleaned,))
             res = c.fetchone()
             path_id = res[0]
-            return path_id
+            PathIdCache.notify(c, 'insert', account_id, [path_id])
+        PathIdCache.put(account_id, {path_cleaned: path_id}, generation)
+        PathTrieIndex.update(account_id, {path_id: path_cleaned})
+        return path_id
+
+    @staticmethod
+    def _get_path_ids_from_db(account_id, paths):
+        """ Returns a dict path -> id for those of the paths that exist in DB. """
+        ret = {}
+        for p in paths:
+            path_id = PathIdCache.get(account_id, p)
+            if path_id is not None:
+                ret[p] = path_id
+        paths_to_fetch = [p for p in paths if p not in ret]
+        if not paths_to_fetch:
+            return ret
+
+        generation = PathIdCache.get_generation()
+        with db.cursor() as c:
+            c.execute('SELECT path, id FROM paths WHERE account = %s AND path = ANY(%s);', (account_id, paths_to_fetch,))
+            fetched = dict(c.fetchall())
+        PathIdCache.put(account_id, fetched, generation)
+        ret.update(fetched)
+        return ret
+
+    @staticmethod
+    def _insert_paths_to_db(account_id, paths):
+        """ Inserts paths which do not exist yet, returns a dict path -> id for those which were actually inserted. """
+        generation = PathIdCache.get_generation()
+        with db.cursor() as c:
+            res = psycopg2.extras.execute_values(c, "INSERT INTO paths (account, path) VALUES %s ON CONFLICT (account, path) DO NOTHING RETURNING path, id;",
+                                                 [(account_id, p,) for p in sorted(paths)], page_size=1000, fetch=True)
+            inserted = dict(res)
+            if inserted:
+                PathIdCache.notify(c, 'insert', account_id, inserted.values())
+        PathIdCache.put(account_id, inserted, generation)
+        if inserted:
+            PathTrieIndex.update(account_id, {path_id: p for p, path_id in inserted.items()})
+        return inserted
 
     @staticmethod
     def get(path_id, account_id):
@@ -149,8 +533,10 @@ class Path(object):
             return 0
         with db.cursor() as c:
             c.execute("UPDATE paths SET path = %s WHERE id = %s AND account = %s;", (self.path, self.force_id, self.account_id,))
-            # if c.rowcount:
-            #     Path._get_path_id_from_db.cache_clear()
+            if c.rowcount:
+                PathIdCache.notify(c, 'update', self.account_id, [self.force_id])
+                PathTrieIndex.update(self.account_id, {self.force_id: self.path})
+                AggrTileCache.evict_paths([self.force_id])
             return c.rowcount
 
     @staticmethod
@@ -158,19 +544,40 @@ class Path(object):
         with db.cursor() as c:
             # delete just the path, "ON DELETE CASCADE" takes care of removing values:
             c.execute("DELETE FROM paths WHERE id = %s AND account = %s;", (path_id, account_id,))
-            # if c.rowcount:
-            #     Path._get_path_id_from_db.cache_clear()
+            if c.rowcount:
+                PathIdCache.notify(c, 'delete', account_id, [path_id])
+                PathTrieIndex.update(account_id, {path_id: None})
+                AggrTileCache.evict_paths([path_id])
             return c.rowcount
 
+    @staticmethod
+    def find_children(account_id, prefix, limit=1000):
+        """
+            Returns (sorted) distinct segments which follow the path prefix, with the number of distinct segments which
+            follow each of them and whether it is a path itself, so that paths can be browsed level by level. Also
+            returns True if limit was reached. Prefix should be validated (empty prefix means top level).
+
+            Segments are kept in `path_segments` table (maintained by triggers on paths), so only the returned rows are read.
+        """
+        with db.cursor() as c:
+            c.execute('SELECT segment, n_children, is_path FROM path_segments WHERE account = %s AND parent = %s ORDER BY segment LIMIT %s;', (account_id, prefix, limit + 1,))
+            res = c.fetchall()
+        found = [{'segment': segment, 'children': n_children, 'is_path': is_path} for segment, n_children, is_path in res[:limit]]
+        return found, len(res) > limit
+
 
 class PathFilter(_RegexValidatedInputValue):
     _regex = re.compile(r'^([a-zA-Z0-9_-]+|[*?])([.]([a-zA-Z0-9_-]+|[*?]))*$')
 
     @staticmethod
     def find_matching_paths(account_id, path_filter, limit=200, allow_trailing_chars=False):
-        pf_regex = PathFilter._regex_from_filter(path_filter, allow_trailing_chars)
+        found = PathTrieIndex.find_matching_paths(account_id, path_filter, limit, allow_trailing_chars)
+        if found is not None:
+            return found
+        pf_sql, pf_params = PathFilter._sql_from_filter(path_filter, allow_trailing_chars)
         with db.cursor() as c:
-            c.execute('SELECT id, path FROM paths WHERE account = %s AND path ~ %s ORDER BY path LIMIT %s;', (account_id, pf_regex, limit + 1,))
+            # same order as PathTrieIndex (by code points, regardless of DB collation), so that pages are the same:
+            c.execute(f'SELECT id, path FROM paths WHERE account = %s AND {pf_sql} ORDER BY path COLLATE "C" LIMIT %s;', (account_id, *pf_params, limit + 1,))
             found_paths = [{
                 "id": r[0],
                 "path": r[1],
@@ -195,6 +602,37 @@ class PathFilter(_RegexValidatedInputValue):
         path_filter_str = "^{}$".format(path_filter_str)
         return path_filter_str
 
+    @staticmethod
+    def _sql_from_filter(path_filter_str, allow_trailing_chars=False, column='path'):
+        """
+            Prepares SQL condition (and its parameters) which matches `column` against the path filter. Regex alone can't
+            use a btree index, so the literal leading segments are also matched with LIKE (which uses the index on
+            `path text_pattern_ops`), and regex only needs to check the paths with this prefix. If there are no wildcards,
+            path is simply compared for equality.
+        """
+        segments = path_filter_str.split('.')
+        n_literal = 0
+        while n_literal < len(segments) and segments[n_literal] not in ('*', '?'):
+            n_literal += 1
+
+        if n_literal == len(segments):
+            if not allow_trailing_chars:
+                return f"{column} = %s", [path_filter_str]
+            # unfinished filter without wildcards is just a prefix - LIKE is equivalent to the regex:
+            prefix, regex = path_filter_str, None
+        else:
+            prefix = ''.join(s + '.' for s in segments[:n_literal])
+            regex = PathFilter._regex_from_filter(path_filter_str, allow_trailing_chars)
+
+        if not prefix:
+            if regex is None:
+                return "TRUE", []
+            return f"{column} ~ %s", [regex]
+        like = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        if regex is None:
+            return f"{column} LIKE %s", [like]
+        return f"{column} LIKE %s AND {column} ~ %s", [like, regex]
+
 
 # when user is entering a path filter, it is not finished yet - but we must validate it to display the matches:
 class UnfinishedPathFilter(PathFilter):
@@ -291,30 +729,268 @@ class EmailAddress(object):
 class Measurement(object):
     AGGR_FACTOR = 3
     MAX_AGGR_LEVEL = 6  # 0 == one point per 1h; 1 == 1 point per 3h; ...; 6 == one point per ~month
+    TIMESCALEDB_EPOCH = 946857600  # 2000-01-03T00:00:00Z, time_bucket() aligns buckets to it
     MAX_DATAPOINTS_RETURNED = 100000
+    FETCH_CHUNK_SIZE = 5000  # number of data points in each of the chunks which are yielded by fetch_data_chunks()
+    # data of paths is fetched in batches of (at most) this many rows, and DB connection is released between them:
+    FETCH_BATCH_ROWS = int(os.environ.get('FETCH_BATCH_ROWS', 100000))
+    # batches with at least this many values are saved using COPY instead of multi-row INSERTs:
+    BULK_COPY_MIN_ROWS = int(os.environ.get('BULK_COPY_MIN_ROWS', 1000))
 
     @classmethod
     def save_values_data_to_db(cls, account_id, put_data):
+        rows, newly_created_paths = cls.prepare_rows(account_id, put_data)
+        cls.upsert_rows(rows)
+        return newly_created_paths
+
+    @classmethod
+    def save_valid_values_data_to_db(cls, account_id, put_data):
+        """
+            Similar to save_values_data_to_db(), but instead of rejecting the whole batch it saves the valid values and
+            skips the others. Returns a list of newly created paths and a list of rejected values (index, reason).
+        """
+        valid, rejected = cls.validate_batch(put_data)
+        rows, newly_created_paths, row_indexes = cls._prepare_valid_rows(account_id, valid)
+        try:
+            cls.upsert_rows(rows)
+        except psycopg2.DataError:
+            # some value passed validation, but DB refused it (for example 'inf'); find it by saving the values one by one:
+            saved_rows = []
+            for (path_id, ts), v in rows.items():
+                try:
+                    cls._upsert_measurements([(path_id, ts, v)])
+                    saved_rows.append((path_id, ts, v))
+                except psycopg2.DataError:
+                    rejected.append((row_indexes[(path_id, ts)], "Invalid MeasuredValue format: {}".format(v)))
+            cls._update_paths_meta(saved_rows)
+            cls._update_latest_values(saved_rows)
+            rejected.sort()
+        return newly_created_paths, rejected
 
-        paths = [Path.forge_from_path(x['p'], account_id, ensure_in_db=True, allow_system=False) for x in put_data]
+    @classmethod
+    def validate_values(cls, put_data, allow_system=False):
+        """ Checks the values without touching the DB (paths are not resolved) - raises ValidationError if they are invalid. """
+        _, errors = cls.validate_batch(put_data, allow_system)
+        if errors:
+            raise ValidationError(errors[0][1])
 
-        # to use execute_values, we need an iterator which will feed our data:
-        def _get_data(put_data, paths):
-            for x, path in zip(put_data, paths):
-                yield (
-                    path.force_id,
-                    datetime.utcfromtimestamp(float(Timestamp(x['t']))),
-                    str(MeasuredValue(x['v'])),
+    @classmethod
+    def validate_batch(cls, put_data, allow_system=False):
+        """
+            Validates the whole batch at once, column by column, instead of creating PathInputValue, Timestamp and
+            MeasuredValue for every value - distinct paths are validated only once, and timestamps and values are
+            converted in bulk (falling back to checking them one by one only if bulk conversion fails).
+
+            Returns a tuple:
+              - list of valid rows (index, path, ts, value), where ts is a float (epoch seconds) and value a string
+              - list of errors (index, reason), sorted by index
+        """
+        errors = {}
+        try:
+            paths = [x['p'] for x in put_data]
+            timestamps = [x['t'] for x in put_data]
+            values = [x['v'] for x in put_data]
+        except (KeyError, TypeError):
+            paths, timestamps, values = [], [], []
+            for i, x in enumerate(put_data):
+                try:
+                    p, t, v = x['p'], x['t'], x['v']
+                except (KeyError, TypeError):
+                    errors[i] = "Each value must have fields 'p', 't' and 'v'"
+                    p, t, v = None, None, None
+                paths.append(p)
+                timestamps.append(t)
+                values.append(v)
+
+        invalid_paths = {}
+        for path in set(p for p in paths if isinstance(p, str)):
+            if not PathInputValue.is_valid(path):
+                invalid_paths[path] = "Invalid PathInputValue format: {}".format(path)
+            elif not allow_system and path.startswith(SYSTEM_PATH_PREFIX):
+                invalid_paths[path] = "Invalid path - should not start with 'system.'!"
+        for i, path in enumerate(paths):
+            if i in errors:
+                continue
+            if not isinstance(path, str):
+                errors[i] = "Invalid PathInputValue format: {}".format(path)
+            elif path in invalid_paths:
+                errors[i] = invalid_paths[path]
+
+        # numeric timestamps are allowed as they are, strings must match the Timestamp format:
+        ts_regex = Timestamp._regex
+        ts_floats = None
+        if all(type(t) in (int, float) for t in timestamps):
+            ts_floats = list(map(float, timestamps))
+        if ts_floats is None:
+            ts_floats = []
+            for i, t in enumerate(timestamps):
+                if type(t) in (int, float) or (isinstance(t, str) and ts_regex.match(t)):
+                    ts_floats.append(float(t))
+                else:
+                    ts_floats.append(None)
+                    if i not in errors:
+                        errors[i] = "Invalid Timestamp format: {}".format(t)
+
+        # float() accepts everything that MeasuredValue accepts; map() converts the whole column in a single call:
+        try:
+            for _ in map(float, values):
+                pass
+        except (TypeError, ValueError):
+            for i, v in enumerate(values):
+                if i not in errors and not MeasuredValue.is_valid(v):
+                    errors[i] = "Invalid MeasuredValue format: {}".format(v)
+
+        valid = [(i, p, t, str(v)) for i, (p, t, v) in enumerate(zip(paths, ts_floats, values)) if i not in errors]
+        return valid, sorted(errors.items())
+
+    @classmethod
+    def prepare_rows(cls, account_id, put_data):
+        """
+            Resolves paths (creating the missing ones) and converts values to rows, ready to be saved with upsert_rows().
+            Returns a dict (path_id, ts) -> value (ts being epoch seconds) and a list of newly created paths.
+        """
+        valid, errors = cls.validate_batch(put_data)
+        if errors:
+            raise ValidationError(errors[0][1])
+        rows, newly_created_paths, _ = cls._prepare_valid_rows(account_id, valid)
+        return rows, newly_created_paths
+
+    @classmethod
+    def _prepare_valid_rows(cls, account_id, valid):
+        """ Same as prepare_rows(), but for rows returned by validate_batch(). Also returns index of each row in input. """
+        paths = Path.forge_from_paths([p for _, p, _, _ in valid], account_id, allow_system=False)
+
+        # Postgres refuses to update the same row twice within a single INSERT ... ON CONFLICT, so we must merge
+        # duplicate (path, ts) pairs first. The last value wins, the same as if the values were sent one by one:
+        rows = {}
+        row_indexes = {}
+        for i, p, ts, v in valid:
+            key = (paths[p].force_id, ts)
+            rows[key] = v
+            row_indexes[key] = i
+
+        newly_created_paths = [p for p in paths.values() if p.newly_created]
+        return rows, newly_created_paths, row_indexes
+
+    @classmethod
+    def upsert_rows(cls, rows):
+        """ Saves rows as returned by prepare_rows(). Rows of multiple accounts can be merged and saved together. """
+        rows = [(path_id, ts, v) for (path_id, ts), v in rows.items()]
+        if len(rows) >= cls.BULK_COPY_MIN_ROWS:
+            cls._upsert_measurements_via_copy(rows)
+        else:
+            cls._upsert_measurements(rows)
+        cls._update_paths_meta(rows)
+        cls._update_latest_values(rows)
+
+    @staticmethod
+    def _update_paths_meta(rows):
+        """
+            Updates first / last timestamp and estimated number of values of paths. The number of values is an estimate
+            because overwritten values are counted again.
+        """
+        paths_meta = {}  # path_id -> [first_ts, last_ts, n]
+        for path_id, ts, _ in rows:
+            meta = paths_meta.get(path_id)
+            if meta is None:
+                paths_meta[path_id] = [ts, ts, 1]
+                continue
+            if ts < meta[0]:
+                meta[0] = ts
+            elif ts > meta[1]:
+                meta[1] = ts
+            meta[2] += 1
+        if not paths_meta:
+            return
+
+        with db.cursor() as c:
+            # paths are locked in order of ids, so concurrent updates can't deadlock:
+            c.execute("""
+                WITH s AS (
+                    SELECT * FROM UNNEST(%s::INTEGER[], %s::DOUBLE PRECISION[], %s::DOUBLE PRECISION[], %s::INTEGER[]) AS s(id, first_ts, last_ts, n)
+                ), locked AS (
+                    SELECT id FROM paths WHERE id IN (SELECT id FROM s) ORDER BY id FOR UPDATE
                 )
+                UPDATE paths p
+                SET
+                    first_ts = LEAST(p.first_ts, to_timestamp(s.first_ts) AT TIME ZONE 'UTC'),
+                    last_ts = GREATEST(p.last_ts, to_timestamp(s.last_ts) AT TIME ZONE 'UTC'),
+                    row_count_estimate = p.row_count_estimate + s.n
+                FROM s, locked
+                WHERE p.id = s.id AND locked.id = s.id;
+            """, (list(paths_meta.keys()), *(list(column) for column in zip(*paths_meta.values()))))
 
-        data_iterator = _get_data(put_data, paths)
+    @staticmethod
+    def _update_latest_values(rows):
+        """ Remembers the newest value of each path - unless a newer value is already saved. """
+        latest = {}  # path_id -> (ts, value)
+        for path_id, ts, v in rows:
+            if path_id not in latest or ts >= latest[path_id][0]:
+                latest[path_id] = (ts, v)
+        if not latest:
+            return
 
+        path_ids = sorted(latest.keys())  # rows are locked in order of ids, so concurrent updates can't deadlock
+        with db.cursor() as c:
+            c.execute("""
+                INSERT INTO latest_values (path, ts, value)
+                SELECT path, to_timestamp(ts) AT TIME ZONE 'UTC', value
+                FROM UNNEST(%s::INTEGER[], %s::DOUBLE PRECISION[], %s::NUMERIC[]) AS s(path, ts, value)
+                ORDER BY path
+                ON CONFLICT (path) DO UPDATE SET ts = excluded.ts, value = excluded.value WHERE latest_values.ts <= excluded.ts;
+            """, (path_ids, [latest[path_id][0] for path_id in path_ids], [latest[path_id][1].strip() for path_id in path_ids]))
+
+    @staticmethod
+    def parse_line_protocol(line, line_nr, now=None):
+        """
+            Parses a single line (bytes) of line protocol: `<path> <value> <timestamp>`, separated by whitespace. If `now` is
+            set (POST), timestamp must be omitted and `now` is used instead. Returns a dict in the same form as JSON input.
+        """
+        # this is called for every value, so we keep it tight - a single decode and split per line:
+        try:
+            if now is None:
+                p, v, t = line.decode('ascii').split()
+                return {'p': p, 'v': v, 't': t}
+            p, v = line.decode('ascii').split()
+            return {'p': p, 'v': v, 't': now}
+        except (UnicodeDecodeError, ValueError):
+            pass
+        raise ValidationError(f"Invalid line protocol format on line {line_nr} (expected: '<path> <value>{'' if now else ' <timestamp>'}')")
+
+    @staticmethod
+    def _upsert_measurements(rows):
         with db.cursor() as c:
             # https://stackoverflow.com/a/34529505/593487
-            psycopg2.extras.execute_values(c, "INSERT INTO measurements (path, ts, value) VALUES %s ON CONFLICT (path, ts) DO UPDATE SET value=excluded.value", data_iterator, "(%s, %s, %s)", page_size=100)
+            # timestamps are epoch seconds - Postgres converts them, so we don't need to create datetime objects:
+            psycopg2.extras.execute_values(c, "INSERT INTO measurements (path, ts, value) VALUES %s ON CONFLICT (path, ts) DO UPDATE SET value=excluded.value",
+                                           rows, "(%s, to_timestamp(%s) AT TIME ZONE 'UTC', %s)", page_size=100)
 
-        newly_created_paths = [p for p in paths if p.newly_created]
-        return newly_created_paths
+    @staticmethod
+    def _upsert_measurements_via_copy(rows):
+        """
+            Streams rows into a temporary staging table with COPY and merges them into measurements with a single
+            INSERT ... SELECT. Much faster than execute_values() for large batches. Rows must not contain duplicate
+            (path, ts) pairs.
+        """
+        # Text format is used instead of binary because binary NUMERIC encoding is non-trivial and going through
+        # float8 would lose precision. Values are validated by MeasuredValue (float() accepts them), so after
+        # stripping whitespace they can't contain tabs, newlines or backslashes.
+        buf = io.StringIO()
+        for path_id, ts, v in rows:
+            buf.write(f'{path_id}\t{ts!r}\t{v.strip()}\n')
+        buf.seek(0)
+
+        with db.cursor() as c:
+            # connections are in autocommit mode, but staging table must live (only) until the end of transaction:
+            c.execute('BEGIN;')
+            try:
+                c.execute('CREATE TEMPORARY TABLE IF NOT EXISTS measurements_staging_epoch (path INTEGER NOT NULL, ts DOUBLE PRECISION NOT NULL, value NUMERIC NOT NULL) ON COMMIT DELETE ROWS;')
+                c.copy_expert('COPY measurements_staging_epoch (path, ts, value) FROM STDIN;', buf)
+                c.execute("INSERT INTO measurements (path, ts, value) SELECT path, to_timestamp(ts) AT TIME ZONE 'UTC', value FROM measurements_staging_epoch ON CONFLICT (path, ts) DO UPDATE SET value=excluded.value;")
+                c.execute('COMMIT;')
+            except:
+                c.execute('ROLLBACK;')
+                raise
 
     @classmethod
     def get_suggested_aggr_level(cls, t_from, t_to, max_points=100):
@@ -333,62 +1009,318 @@ class Measurement(object):
 
     @classmethod
     def fetch_data(cls, account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records):
+        str_paths, data_chunks = cls.fetch_data_chunks(account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records)
+        paths_data = {str_p: {'next_data_point': None, 'data': []} for str_p in str_paths}
+        for str_p, chunk, next_data_point in data_chunks:
+            paths_data[str_p]['data'].extend(chunk)
+            if next_data_point is not None:
+                paths_data[str_p]['next_data_point'] = next_data_point
+        return paths_data
+
+    @classmethod
+    def fetch_data_chunks(cls, account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records):
+        """
+            Returns a list of (distinct) paths and a generator which yields their data in chunks, as tuples (path, list of
+            data points, next_data_point). Chunks of the same path are yielded one after another, and next_data_point is
+            only set (on the last chunk of the path) if there is more data than `max_records`. Paths without any data
+            might not be yielded at all.
+
+            Path ids are resolved immediately, while the data is fetched only when the generator is consumed, in batches
+            of paths (of at most FETCH_BATCH_ROWS rows), so memory usage doesn't depend on the number of paths. DB
+            connection is only held while a batch is being read, not while the data is being consumed.
+        """
         # t_froms: an array of t_from, one for each path (because the subsequent fetchings usually request a different t_from for each path)
-        paths_data = {}
-        sort_order = 'ASC' if should_sort_asc else 'DESC'  # PgSQL doesn't allow sort order to be parametrized
+        t_froms_by_path = {str(p): datetime.utcfromtimestamp(float(t_from)) for p, t_from in zip(paths, t_froms)}
+        path_ids = Path._get_path_ids_from_db(account_id, list(t_froms_by_path.keys()))
         t_to_timestamp = datetime.utcfromtimestamp(float(t_to))
-        with db.cursor() as c:
-            for p, t_from in zip(paths, t_froms):
-                str_p = str(p)
-                path_data = []
-                path_id = Path._get_path_id_from_db(account_id, str_p)
-                t_from_timestamp = datetime.utcfromtimestamp(float(t_from))
-
-                # trick: fetch one result more than is allowed (by MAX_DATAPOINTS_RETURNED) so that we know that the result set is not complete and where the client should continue from
-                if aggr_level is None:  # fetch raw data
-                    c.execute('SELECT ts, value FROM measurements WHERE path = %s AND ts >= %s AND ts <= %s ORDER BY ts ' + sort_order + ' LIMIT %s;', (path_id, t_from_timestamp, t_to_timestamp, max_records + 1,))
-                    for ts, value in c.fetchall():
-                        path_data.append({'t': ts.replace(tzinfo=timezone.utc).timestamp(), 'v': float(value)})
-                else:  # fetch aggregated data
-                    aggr_interval_h = cls.AGGR_FACTOR ** aggr_level
-                    # TimescaleDB quirk: while we could change the offset to `TIMESTAMP '1970-01-01'` for normal SQL queries, we would not be able to create an index for
-                    # such time_bucket, so we must align our buckets with TIMESCALEDB_EPOCH (2000-01-03).
-                    c.execute(f"""
-                        SELECT
-                            period,
-                            average,
-                            minimum,
-                            maximum
-                        FROM
-                            measurements_aggr_{aggr_level}
-                        WHERE
-                            path = %s AND
-                            period >= %s AND
-                            period <= %s
-                        ORDER BY
-                            period {sort_order}
-                    """, (path_id, t_from_timestamp, t_to_timestamp,))
-                    move_ts_to_middle_of_interval = aggr_interval_h * 1800
-                    for ts, vavg, vmin, vmax in c.fetchall():
-                        path_data.append({'t': ts.replace(tzinfo=timezone.utc).timestamp() + move_ts_to_middle_of_interval, 'v': float(vavg), 'minv': float(vmin), 'maxv': float(vmax)})
-
-                # if we have one result too many, eliminate it and set "next_data_point" field:
-                if len(path_data) > max_records:
-                    paths_data[str_p] = {
-                        'next_data_point': path_data[max_records]['t'],
-                        'data': path_data[:max_records],
-                    }
-                else:
-                    paths_data[str_p] = {
-                        'next_data_point': None,
-                        'data': path_data,
-                    }
+        if aggr_level is not None and AggrTileCache.is_enabled():
+            return list(t_froms_by_path.keys()), cls._iter_aggr_data_chunks_cached(path_ids, t_froms_by_path, aggr_level, t_to_timestamp, should_sort_asc, max_records)
+        return list(t_froms_by_path.keys()), cls._iter_data_chunks(path_ids, t_froms_by_path, aggr_level, t_to_timestamp, should_sort_asc, max_records)
 
-        return paths_data
+    @classmethod
+    def _iter_aggr_data_chunks_cached(cls, path_ids, t_froms_by_path, aggr_level, t_to_timestamp, should_sort_asc, max_records):
+        """
+            Same as _iter_data_chunks() for aggregated data, but closed tiles are taken from AggrTileCache when possible.
+            The tiles (and the open tail) of each path are walked in the requested sort order until `max_records + 1`
+            rows are found. Missing tiles are fetched from DB (whole, so that they can be cached) in rounds, with a single
+            query per round, each time only as many of them as are needed to get enough rows (if they are full).
+
+            If the range is covered by more than AggrTileCache.MAX_TILES_PER_REQUEST tiles, the cache is not used at all
+            (the data would be loaded into memory whole, and other tiles would be pushed out of the cache).
+        """
+        if not path_ids:
+            return
+        now = time.time()
+        t_to = t_to_timestamp.replace(tzinfo=timezone.utc).timestamp()
+        tile_length = AggrTileCache.tile_length(aggr_level)
+        pieces_by_path = {}  # path -> list of (tile_start or None for the tail, t_from, t_to), in requested sort order
+        n_tiles = 0
+        for p in path_ids:
+            t_from = t_froms_by_path[p].replace(tzinfo=timezone.utc).timestamp()
+            tile_starts, closed_until = AggrTileCache.get_closed_tile_starts(aggr_level, t_from, t_to, now)
+            n_tiles += len(tile_starts)
+            pieces = [(tile_start, tile_start, tile_start + tile_length) for tile_start in tile_starts]
+            if t_to >= closed_until:
+                # timestamps in DB have microsecond precision, so `period <= t_to` is the same as `period < t_to + 1us`:
+                pieces.append((None, max(t_from, closed_until), t_to + 0.000001))
+            if not should_sort_asc:
+                pieces.reverse()
+            pieces_by_path[p] = pieces
+        if n_tiles > AggrTileCache.MAX_TILES_PER_REQUEST:
+            yield from cls._iter_data_chunks(path_ids, t_froms_by_path, aggr_level, t_to_timestamp, should_sort_asc, max_records)
+            return
+
+        rows_by_path = {p: [] for p in path_ids}  # rows in requested sort order
+        next_piece = {p: 0 for p in path_ids}
+        fetched = {}  # (path_id, tile_start) -> rows which were fetched from DB (and not used yet)
+        pending = list(path_ids.keys())  # paths which need more rows
+        while pending:
+            query_pieces = []  # (path_id, tile_start or None for the tail, t_from, t_to)
+            for p in pending:
+                path_id, pieces, rows = path_ids[p], pieces_by_path[p], rows_by_path[p]
+                t_from = t_froms_by_path[p].replace(tzinfo=timezone.utc).timestamp()
+                while next_piece[p] < len(pieces) and len(rows) <= max_records:
+                    tile_start = pieces[next_piece[p]][0]
+                    piece_rows = fetched.pop((path_id, tile_start), None)
+                    if piece_rows is None and tile_start is not None:
+                        piece_rows = AggrTileCache.get((path_id, aggr_level, tile_start), now)
+                    if piece_rows is None:
+                        break
+                    piece_rows = [row for row in piece_rows if t_from <= row[0] <= t_to]
+                    rows.extend(piece_rows if should_sort_asc else reversed(piece_rows))
+                    next_piece[p] += 1
+                if len(rows) > max_records or next_piece[p] == len(pieces):
+                    continue
+                # every tile has at most TILE_BUCKETS rows, so we need at least this many of the next pieces (the first
+                # of them is missing, the others might be cached):
+                n_pieces = int(math.ceil((max_records + 1 - len(rows)) / AggrTileCache.TILE_BUCKETS))
+                for i, (tile_start, piece_from, piece_to) in enumerate(pieces[next_piece[p]:next_piece[p] + n_pieces]):
+                    if i == 0 or tile_start is None or AggrTileCache.get((path_id, aggr_level, tile_start), now) is None:
+                        query_pieces.append((path_id, tile_start, piece_from, piece_to))
+            if not query_pieces:
+                break
+            queried_path_ids = set(path_id for path_id, _, _, _ in query_pieces)
+            pending = [p for p in pending if path_ids[p] in queried_path_ids]
+
+            for path_id, tile_start, _, _ in query_pieces:
+                fetched[(path_id, tile_start)] = []
+            with db.cursor() as c:
+                c.execute(f"""
+                    SELECT q.path, q.tile_start, a.period, a.average, a.minimum, a.maximum
+                    FROM UNNEST(%s::INTEGER[], %s::DOUBLE PRECISION[], %s::DOUBLE PRECISION[], %s::DOUBLE PRECISION[]) AS q(path, tile_start, t_from, t_to)
+                    CROSS JOIN LATERAL (
+                        SELECT period, average, minimum, maximum FROM measurements_aggr_{aggr_level}
+                        WHERE path = q.path AND period >= to_timestamp(q.t_from) AT TIME ZONE 'UTC' AND period < to_timestamp(q.t_to) AT TIME ZONE 'UTC'
+                    ) a
+                    ORDER BY q.path, a.period;
+                """, tuple(list(column) for column in zip(*query_pieces)))
+                for path_id, tile_start, period, average, minimum, maximum in c:
+                    row = (period.replace(tzinfo=timezone.utc).timestamp(), float(average), float(minimum), float(maximum))
+                    fetched[(path_id, None if tile_start is None else int(tile_start))].append(row)
+            for path_id, tile_start, _, _ in query_pieces:
+                if tile_start is not None:
+                    AggrTileCache.put((path_id, aggr_level, tile_start), fetched[(path_id, tile_start)], now)
+
+        move_ts_to_middle_of_interval = (cls.AGGR_FACTOR ** aggr_level) * 1800
+        for p, rows in rows_by_path.items():
+            next_data_point = rows[max_records][0] if len(rows) > max_records else None
+            rows = rows[:max_records]
+            for i in range(0, max(len(rows), 1), cls.FETCH_CHUNK_SIZE):
+                chunk = [{'t': t + move_ts_to_middle_of_interval, 'v': v, 'minv': minv, 'maxv': maxv} for t, v, minv, maxv in rows[i:i + cls.FETCH_CHUNK_SIZE]]
+                is_last = i + cls.FETCH_CHUNK_SIZE >= len(rows)
+                if chunk or next_data_point is not None:
+                    yield p, chunk, next_data_point if is_last else None
+
+    @classmethod
+    def _iter_data_chunks(cls, path_ids, t_froms_by_path, aggr_level, t_to_timestamp, should_sort_asc, max_records):
+        if not path_ids:
+            return
+        sort_order = 'ASC' if should_sort_asc else 'DESC'  # PgSQL doesn't allow sort order to be parametrized
+        paths_by_id = {path_id: p for p, path_id in path_ids.items()}
+
+        # Data for a batch of paths is fetched with a single query. LIMIT is applied to each of the paths separately, and
+        # each path has its own t_from. Rows are sorted by the position of the path in the array - the function scan
+        # (WITH ORDINALITY) already returns the paths in this order, so each path's index scan can be streamed without
+        # sorting all of the rows first.
+        # trick: fetch one result more than is allowed (by MAX_DATAPOINTS_RETURNED) so that we know that the result set is not complete and where the client should continue from
+        if aggr_level is None:  # fetch raw data
+            query = f"""
+                SELECT q.path, m.ts, m.value
+                FROM UNNEST(%s::INTEGER[], %s::TIMESTAMP[]) WITH ORDINALITY AS q(path, t_from, ord)
+                CROSS JOIN LATERAL (
+                    SELECT ts, value FROM measurements WHERE path = q.path AND ts >= q.t_from AND ts <= %s ORDER BY ts {sort_order} LIMIT %s
+                ) m
+                ORDER BY q.ord, m.ts {sort_order};
+            """
+            move_ts_to_middle_of_interval = 0
+        else:  # fetch aggregated data
+            aggr_interval_h = cls.AGGR_FACTOR ** aggr_level
+            # TimescaleDB quirk: while we could change the offset to `TIMESTAMP '1970-01-01'` for normal SQL queries, we would not be able to create an index for
+            # such time_bucket, so we must align our buckets with TIMESCALEDB_EPOCH (2000-01-03).
+            query = f"""
+                SELECT q.path, a.period, a.average, a.minimum, a.maximum
+                FROM UNNEST(%s::INTEGER[], %s::TIMESTAMP[]) WITH ORDINALITY AS q(path, t_from, ord)
+                CROSS JOIN LATERAL (
+                    SELECT period, average, minimum, maximum FROM measurements_aggr_{aggr_level} WHERE path = q.path AND period >= q.t_from AND period <= %s ORDER BY period {sort_order} LIMIT %s
+                ) a
+                ORDER BY q.ord, a.period {sort_order};
+            """
+            move_ts_to_middle_of_interval = aggr_interval_h * 1800
+
+        # each path can return up to max_records + 1 rows; a batch has at least one path:
+        path_ids_items = list(path_ids.items())
+        batch_size = max(1, cls.FETCH_BATCH_ROWS // (max_records + 1))
+        for i in range(0, len(path_ids_items), batch_size):
+            batch = path_ids_items[i:i + batch_size]
+            query_params = ([path_id for _, path_id in batch], [t_froms_by_path[p] for p, _ in batch], t_to_timestamp, max_records + 1,)
+            # rows are read whole, so that the connection is returned to the pool before they are consumed (which can be
+            # slow if they are sent to a slow client):
+            with db.cursor() as c:
+                c.execute(query, query_params)
+                rows = c.fetchall()
+
+            current_path, chunk, n_points = None, [], 0
+            for row in rows:
+                str_p = paths_by_id[row[0]]
+                if str_p != current_path:
+                    if chunk:
+                        yield current_path, chunk, None
+                    current_path, chunk, n_points = str_p, [], 0
+
+                t = row[1].replace(tzinfo=timezone.utc).timestamp() + move_ts_to_middle_of_interval
+                n_points += 1
+                if n_points > max_records:
+                    # if we have one result too many, don't return it, but set "next_data_point" field (for aggregated data,
+                    # this is the start of the interval, so that it can be used as t0 in the next request):
+                    yield current_path, chunk, t - move_ts_to_middle_of_interval
+                    chunk = []
+                    continue
+
+                if aggr_level is None:
+                    chunk.append({'t': t, 'v': float(row[2])})
+                else:
+                    chunk.append({'t': t, 'v': float(row[2]), 'minv': float(row[3]), 'maxv': float(row[4])})
+                if len(chunk) >= cls.FETCH_CHUNK_SIZE:
+                    yield current_path, chunk, None
+                    chunk = []
+            if chunk:
+                yield current_path, chunk, None
+            del rows  # so that two batches are never in memory at the same time
 
     @classmethod
     def fetch_topn(cls, account_id, path_filter, ts_to, max_results):
-        pf_regex = PathFilter._regex_from_filter(path_filter, allow_trailing_chars=False)
+        """
+            Finds the latest timestamp (not newer than ts_to and at most an hour older) of the values of matching paths,
+            and returns this timestamp, the sum of all the values at it, and the highest `max_results` of these values.
+
+            The latest value of each path is kept in `latest_values`, so the hypertable is only searched if ts_to is in
+            the past and some of the matching paths have newer values.
+        """
+        pf_sql, pf_params = PathFilter._sql_from_filter(path_filter, column='p.path')
+        ts_to_timestamp = datetime.utcfromtimestamp(float(ts_to))
+        with db.cursor() as c:
+            c.execute(f"""
+                SELECT
+                    MAX(lv.ts) FILTER (WHERE lv.ts <= %s AND lv.ts > %s - INTERVAL '1 hour'),
+                    COALESCE(BOOL_OR(lv.ts > %s), FALSE)
+                FROM paths p, latest_values lv
+                WHERE p.account = %s AND {pf_sql} AND lv.path = p.id;
+            """, (ts_to_timestamp, ts_to_timestamp, ts_to_timestamp, account_id, *pf_params,))
+            found_ts, has_newer_values = c.fetchone()
+            if has_newer_values:
+                return cls._fetch_topn_from_measurements(account_id, path_filter, ts_to, max_results)
+            if not found_ts:
+                return ts_to_timestamp, 0, []
+
+            # index on (ts, value) allows reading the top values in order:
+            c.execute(f"""
+                SELECT p.path, lv.value
+                FROM latest_values lv, paths p
+                WHERE lv.ts = %s AND lv.path = p.id AND p.account = %s AND {pf_sql}
+                ORDER BY lv.value DESC
+                LIMIT %s;
+            """, (found_ts, account_id, *pf_params, max_results,))
+            topn = [{'p': path, 'v': float(value)} for path, value in c.fetchall()]
+
+            c.execute(f"SELECT SUM(lv.value) FROM latest_values lv, paths p WHERE lv.ts = %s AND lv.path = p.id AND p.account = %s AND {pf_sql};", (found_ts, account_id, *pf_params,))
+            total, = c.fetchone()
+            return found_ts, total, topn
+
+    TOPN_RANGE_AGGR_FUNCTIONS = {
+        # continuous aggregates keep the sum and the number of values, so the result doesn't depend on the aggregation
+        # levels used or on how the values are spread within the range:
+        'sum': 'SUM(a.total)',
+        'avg': 'SUM(a.total) / SUM(a.n_values)',
+        'max': 'MAX(a.maximum)',
+    }
+
+    @classmethod
+    def get_aggr_ranges(cls, t_from, t_to):
+        """
+            Covers [t_from, t_to) (which must be aligned to whole hours) with as few aggregation intervals as possible,
+            using the coarsest aggregation level possible at each point. Returns a list of (aggr_level, start, end),
+            where consecutive intervals of the same level are merged.
+        """
+        ranges = []
+        t = t_from
+        while t < t_to:
+            for aggr_level in range(cls.MAX_AGGR_LEVEL, -1, -1):
+                interval = (cls.AGGR_FACTOR ** aggr_level) * 3600
+                if (t - cls.TIMESCALEDB_EPOCH) % interval == 0 and t + interval <= t_to:
+                    break
+            if ranges and ranges[-1][0] == aggr_level and ranges[-1][2] == t:
+                ranges[-1] = (aggr_level, ranges[-1][1], t + interval)
+            else:
+                ranges.append((aggr_level, t, t + interval))
+            t += interval
+        return ranges
+
+    @classmethod
+    def fetch_topn_range(cls, account_id, path_filter, t_from, t_to, aggr, max_results):
+        """
+            Ranks the paths matching the filter by the aggregated (`aggr`: sum, avg or max) values within the time range,
+            using continuous aggregates. The range is extended to whole hours (the finest aggregation level). Ranking is
+            done in DB (ORDER BY with LIMIT uses top-N heapsort), so only `max_results` rows are returned from it.
+
+            Returns the range used, the sum of aggregated values of all the matching paths, and the top paths.
+        """
+        pf_sql, pf_params = PathFilter._sql_from_filter(path_filter)
+        t_from = int(math.floor(float(t_from) / 3600.)) * 3600
+        t_to = int(math.ceil(float(t_to) / 3600.)) * 3600
+        aggr_ranges = cls.get_aggr_ranges(t_from, t_to)
+
+        subqueries, subquery_params = [], []
+        for aggr_level in sorted(set(l for l, _, _ in aggr_ranges)):
+            periods = [(datetime.utcfromtimestamp(start), datetime.utcfromtimestamp(end)) for l, start, end in aggr_ranges if l == aggr_level]
+            subqueries.append(f"""
+                SELECT path, total, n_values, maximum
+                FROM measurements_aggr_{aggr_level}
+                WHERE path IN (SELECT id FROM p) AND ({' OR '.join(['(period >= %s AND period < %s)'] * len(periods))})
+            """)
+            subquery_params.extend(t for period in periods for t in period)
+        if not subqueries:
+            return t_from, t_to, 0, []
+
+        aggr_function = cls.TOPN_RANGE_AGGR_FUNCTIONS[aggr]
+        with db.cursor() as c:
+            c.execute(f"""
+                WITH p AS (
+                    SELECT id, path FROM paths WHERE account = %s AND {pf_sql}
+                )
+                SELECT p.path, {aggr_function} AS v, SUM({aggr_function}) OVER () AS total
+                FROM ({' UNION ALL '.join(subqueries)}) a, p
+                WHERE a.path = p.id
+                GROUP BY p.path
+                ORDER BY v DESC, p.path
+                LIMIT %s;
+            """, (account_id, *pf_params, *subquery_params, max_results,))
+            res = c.fetchall()
+        total = float(res[0][2]) if res else 0
+        return t_from, t_to, total, [{'p': path, 'v': float(v)} for path, v, _ in res]
+
+    @classmethod
+    def _fetch_topn_from_measurements(cls, account_id, path_filter, ts_to, max_results):
+        pf_sql, pf_params = PathFilter._sql_from_filter(path_filter, column='p.path')
         with db.cursor() as c, db.cursor() as c2:
             # Correct, but slow:
             # """
@@ -425,18 +1357,19 @@ class Measurement(object):
                 if not timestamps:
                     continue
 
-                c.execute("""
+                c.execute(f"""
                         SELECT
                             m.ts, p.path, m.value
                         FROM
                             paths p, measurements m
                         WHERE
-                            p.path ~ %s AND
+                            p.account = %s AND
+                            {pf_sql} AND
                             p.id = m.path AND
                             m.ts IN %s
                         ORDER BY m.ts desc, m.value DESC
                         LIMIT %s
-                    """, (pf_regex, timestamps, max_results,)
+                    """, (account_id, *pf_params, timestamps, max_results,)
                 )
 
                 found_ts = None
@@ -455,45 +1388,226 @@ class Measurement(object):
                 return datetime.utcfromtimestamp(float(ts_to)), 0, []
 
             # find the sum of all values at that timestamp so we can display percentages:
-            c.execute("SELECT SUM(m.value) FROM paths p, measurements m WHERE p.path ~ %s AND p.id = m.path AND m.ts = %s", (pf_regex, found_ts,))
+            c.execute(f"SELECT SUM(m.value) FROM paths p, measurements m WHERE p.account = %s AND {pf_sql} AND p.id = m.path AND m.ts = %s", (account_id, *pf_params, found_ts,))
             total, = c.fetchone()
             return found_ts, total, topn
 
 
     @classmethod
-    def get_oldest_measurement_time(cls, account_id, paths):
-        path_ids = tuple(Path._get_path_id_from_db(account_id, str(p)) for p in paths)
+    def get_oldest_measurement_time(cls, account_id, paths, paths_meta=None):
+        if paths_meta is None:
+            paths_meta = cls.get_paths_meta(account_id, paths)
+        first_timestamps = [meta['first_ts'] for meta in paths_meta.values() if meta['first_ts'] is not None]
+        # first_ts might be missing even if path has values (if they were saved without updating it), so we check those
+        # paths in measurements (if they really don't have values, this is a quick index lookup):
+        unknown_path_ids = list(Path._get_path_ids_from_db(account_id, [p for p, meta in paths_meta.items() if meta['first_ts'] is None]).values())
+        if unknown_path_ids:
+            with db.cursor() as c:
+                c.execute('SELECT MIN(ts) FROM measurements WHERE path = ANY(%s);', (unknown_path_ids,))
+                ts, = c.fetchone()
+                if ts is not None:
+                    first_timestamps.append(ts.replace(tzinfo=timezone.utc).timestamp())
+        return min(first_timestamps) if first_timestamps else None
+
+    @staticmethod
+    def get_paths_meta(account_id, paths):
+        """
+            Returns a dict path -> {first_ts, last_ts, row_count_estimate} for those of the paths that exist in DB. These
+            are maintained when values are saved, so (unlike MIN(ts) on measurements) they don't require scanning chunks.
+        """
+        path_ids = Path._get_path_ids_from_db(account_id, [str(p) for p in paths])
+        if not path_ids:
+            return {}
+        paths_by_id = {path_id: p for p, path_id in path_ids.items()}
         with db.cursor() as c:
-            c.execute('SELECT MIN(ts) FROM measurements WHERE path IN %s;', (path_ids,))
-            res = c.fetchone()
-            if not res:
-                return None
-            ts = res[0]
-            return ts.replace(tzinfo=timezone.utc).timestamp()
+            c.execute('SELECT id, first_ts, last_ts, row_count_estimate FROM paths WHERE id = ANY(%s);', (list(paths_by_id.keys()),))
+            return {
+                paths_by_id[path_id]: {
+                    'first_ts': first_ts.replace(tzinfo=timezone.utc).timestamp() if first_ts else None,
+                    'last_ts': last_ts.replace(tzinfo=timezone.utc).timestamp() if last_ts else None,
+                    'row_count_estimate': row_count_estimate,
+                }
+                for path_id, first_ts, last_ts, row_count_estimate in c.fetchall()
+            }
+
+    @staticmethod
+    def fetch_last_values(account_id, paths):
+        """ Returns a dict path -> {t, v} with the latest value of each of the paths (that has any values). """
+        path_ids = Path._get_path_ids_from_db(account_id, [str(p) for p in paths])
+        if not path_ids:
+            return {}
+        paths_by_id = {path_id: p for p, path_id in path_ids.items()}
+        with db.cursor() as c:
+            c.execute('SELECT path, ts, value FROM latest_values WHERE path = ANY(%s);', (list(paths_by_id.keys()),))
+            return {
+                paths_by_id[path_id]: {'t': ts.replace(tzinfo=timezone.utc).timestamp(), 'v': float(value)}
+                for path_id, ts, value in c.fetchall()
+            }
+
+    @staticmethod
+    def fetch_last_values_for_filter(account_id, path_filter, limit):
+        """ Same as fetch_last_values(), but for paths matching the filter (sorted, at most `limit`). Also returns True if limit was reached. """
+        pf_sql, pf_params = PathFilter._sql_from_filter(path_filter, column='p.path')
+        with db.cursor() as c:
+            c.execute(f"""
+                SELECT p.path, lv.ts, lv.value
+                FROM paths p, latest_values lv
+                WHERE p.account = %s AND {pf_sql} AND lv.path = p.id
+                ORDER BY p.path
+                LIMIT %s;
+            """, (account_id, *pf_params, limit + 1,))
+            res = c.fetchall()
+        ret = {path: {'t': ts.replace(tzinfo=timezone.utc).timestamp(), 'v': float(value)} for path, ts, value in res[:limit]}
+        return ret, len(res) > limit
 
 
 class Stats(object):
+    """
+        Stats counters (system.stats.*) are updated by every ingestion request, and all of these updates hit the same row
+        (per account, path and minute). To avoid contention on that row, we accumulate the updates in memory and save them
+        periodically (every STATS_FLUSH_INTERVAL_S seconds) in a single upsert. After each save, new values are passed to
+        `on_flushed` (in a form which is ready for mqtt_publish_changed_multiple_payloads function).
+    """
+    FLUSH_INTERVAL_S = float(os.environ.get('STATS_FLUSH_INTERVAL_S', 10))  # 0 - save immediately
+    on_flushed = None
+
+    _pending = defaultdict(float)  # (account_id, path, t) -> accumulated value
+    _lock = threading.Lock()
+    _flush_lock = threading.Lock()
+    _pid = None
+
     @classmethod
     def update_account_stats(cls, account_id, stats_updates):
-        with db.cursor() as c:
-            topics_with_payloads = []
+        with cls._lock:
             for k in stats_updates:
-                path = Path.forge_from_path(k, account_id, allow_system=True)
                 t = stats_updates[k]['t']
                 v = stats_updates[k]['v']
-                c.execute("INSERT INTO measurements (path, ts, value) VALUES (%s, %s, %s) ON CONFLICT (path, ts) DO UPDATE SET value = measurements.value + excluded.value RETURNING value;",
-                (
-                    path.force_id,
-                    datetime.utcfromtimestamp(t),
-                    str(MeasuredValue(v)),
-                ))
-                new_value = float(c.fetchone()[0])
-                topics_with_payloads.append((
-                    f'accounts/{account_id}/values/{k}',
-                    { 'v': new_value, 't': t },
-                ))
-            # returns new values in a form which is ready for mqtt_publish_changed_multiple_payloads function:
-            return topics_with_payloads
+                cls._pending[(account_id, k, t)] += float(str(MeasuredValue(v)))
+        if cls.FLUSH_INTERVAL_S <= 0:
+            cls.flush()
+        else:
+            cls._ensure_flusher_started()
+
+    @classmethod
+    def _ensure_flusher_started(cls):
+        # threads do not survive fork, so we start the flusher lazily in every (worker) process:
+        if cls._pid == os.getpid():
+            return
+        with cls._lock:
+            if cls._pid == os.getpid():
+                return
+            cls._pid = os.getpid()
+            threading.Thread(target=cls._run_flusher, name='stats-flusher', daemon=True).start()
+
+    @classmethod
+    def _run_flusher(cls):
+        while True:
+            time.sleep(cls.FLUSH_INTERVAL_S)
+            try:
+                cls.flush()
+            except Exception:
+                log.exception("Saving stats failed")
+
+    @classmethod
+    def flush(cls):
+        with cls._flush_lock:
+            with cls._lock:
+                pending, cls._pending = cls._pending, defaultdict(float)
+            if not pending:
+                return
+
+            pending_by_account = defaultdict(dict)
+            for (account_id, k, t), v in pending.items():
+                pending_by_account[account_id][(k, t)] = v
+
+            # Each account is saved separately, so that a failure (for example because the account was removed in the
+            # meantime) doesn't affect the others. Note that the counts of the failed account are lost - we could retry,
+            # but if the failure is not transient, all of its future stats would be lost instead.
+            topics_with_payloads = []
+            for account_id, account_pending in pending_by_account.items():
+                try:
+                    topics_with_payloads.extend(cls._save(account_id, account_pending))
+                except Exception:
+                    log.exception(f"Saving stats for account {account_id} failed")
+
+        if cls.on_flushed and topics_with_payloads:
+            cls.on_flushed(topics_with_payloads)
+
+    @staticmethod
+    def _save(account_id, pending):
+        """ Saves accumulated stats of a single account; `pending` is a dict: (path, t) -> value. """
+        path_ids = {k: path.force_id for k, path in Path.forge_from_paths(set(k for k, _ in pending), account_id, allow_system=True).items()}
+
+        keys_by_row = {(path_ids[k], datetime.utcfromtimestamp(t)): (k, t) for k, t in pending}
+        with db.cursor() as c:
+            res = psycopg2.extras.execute_values(c, "INSERT INTO measurements (path, ts, value) VALUES %s ON CONFLICT (path, ts) DO UPDATE SET value = measurements.value + excluded.value RETURNING path, ts, value;",
+                                                 [(path_id, ts, str(pending[key])) for (path_id, ts), key in keys_by_row.items()], "(%s, %s, %s)", page_size=1000, fetch=True)
+        # values are saved directly (not via upsert_rows()), so paths metadata and latest values must be updated too:
+        saved_rows = [(path_id, keys_by_row[(path_id, ts)][1], str(new_value)) for path_id, ts, new_value in res]
+        Measurement._update_paths_meta(saved_rows)
+        Measurement._update_latest_values(saved_rows)
+
+        topics_with_payloads = []
+        for path_id, ts, new_value in res:
+            k, t = keys_by_row[(path_id, ts)]
+            topics_with_payloads.append((
+                f'accounts/{account_id}/values/{k}',
+                { 'v': float(new_value), 't': t },
+            ))
+        return topics_with_payloads
+
+
+class RateLimitBucket(object):
+    """
+        Token buckets (per account) which are shared by all workers. Tokens are refilled lazily, whenever the bucket is
+        accessed. Bucket is allowed to go into debt (negative tokens), but nothing is taken from it while it is empty.
+    """
+
+    @staticmethod
+    def take(account_id, bucket, n, rate_per_s, capacity, force=False):
+        """
+            Takes `n` tokens from the bucket if it is not empty (or in any case, if `force` is set). Returns a tuple (number
+            of tokens taken - either `n` or 0, tokens left in the bucket).
+        """
+        with db.cursor() as c:
+            c.execute('BEGIN;')
+            try:
+                # refill the bucket (new buckets are full) - this also locks the row until the end of transaction:
+                c.execute("""
+                    INSERT INTO rate_limit_buckets AS b (account, bucket, tokens, updated_at) VALUES (%(account)s, %(bucket)s, %(capacity)s, clock_timestamp())
+                    ON CONFLICT (account, bucket) DO UPDATE SET
+                        tokens = LEAST(%(capacity)s, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * %(rate)s),
+                        updated_at = clock_timestamp()
+                    RETURNING tokens;
+                """, {'account': account_id, 'bucket': bucket, 'capacity': capacity, 'rate': rate_per_s})
+                tokens, = c.fetchone()
+                taken = n if (force or tokens > 0) else 0
+                if taken:
+                    c.execute('UPDATE rate_limit_buckets SET tokens = tokens - %s WHERE account = %s AND bucket = %s;', (taken, account_id, bucket,))
+                c.execute('COMMIT;')
+            except:
+                c.execute('ROLLBACK;')
+                raise
+        return taken, tokens - taken
+
+    @staticmethod
+    def get_all(rates_and_capacities):
+        """ Returns the state of all buckets; `rates_and_capacities` is a dict: bucket -> (rate_per_s, capacity). """
+        ret = []
+        with db.cursor() as c:
+            c.execute("SELECT account, bucket, tokens, EXTRACT(EPOCH FROM clock_timestamp() - updated_at) FROM rate_limit_buckets ORDER BY account, bucket;")
+            for account_id, bucket, tokens, elapsed_s in c:
+                if bucket not in rates_and_capacities:
+                    continue
+                rate_per_s, capacity = rates_and_capacities[bucket]
+                ret.append({
+                    'account': account_id,
+                    'bucket': bucket,
+                    'tokens': min(capacity, tokens + float(elapsed_s) * rate_per_s),
+                    'capacity': capacity,
+                    'rate_per_s': rate_per_s,
+                })
+        return ret
 
 
 class Widget(object):
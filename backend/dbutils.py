@@ -1,8 +1,11 @@
 from contextlib import contextmanager
 import os
+import select
 import sys
 import copy
 import json
+import threading
+import time
 import psycopg2
 from psycopg2.pool import ThreadedConnectionPool
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
@@ -80,24 +83,23 @@ class InvalidDBCursor(object):
         raise DBConnectionError()
 
 
+def _get_db_connection_params():
+    return dict(
+        host=os.environ.get('DB_HOST', 'localhost'),
+        database=os.environ.get('DB_DATABASE', 'grafolean'),
+        user=os.environ.get('DB_USERNAME', 'admin'),
+        password=os.environ.get('DB_PASSWORD', 'admin'),
+        port=5432,
+        connect_timeout=int(os.environ.get('DB_CONNECT_TIMEOUT', '10')),
+    )
+
+
 def db_connect():
     global db_pool
-    host, dbname, user, password, connect_timeout = (
-        os.environ.get('DB_HOST', 'localhost'),
-        os.environ.get('DB_DATABASE', 'grafolean'),
-        os.environ.get('DB_USERNAME', 'admin'),
-        os.environ.get('DB_PASSWORD', 'admin'),
-        int(os.environ.get('DB_CONNECT_TIMEOUT', '10'))
-    )
+    params = _get_db_connection_params()
     try:
-        log.info("Connecting to database, host: [{}], db: [{}], user: [{}]".format(host, dbname, user))
-        db_pool = ThreadedConnectionPool(1, 20,
-                              database=dbname,
-                              user=user,
-                              password=password,
-                              host=host,
-                              port=5432,
-                              connect_timeout=connect_timeout)
+        log.info("Connecting to database, host: [{}], db: [{}], user: [{}]".format(params['host'], params['database'], params['user']))
+        db_pool = ThreadedConnectionPool(1, 20, **params)
     except:
         db_pool = None
         log.error("DB connection failed")
@@ -112,6 +114,79 @@ def db_disconnect():
     log.info("DB connection is closed")
 
 
+class DBListener(object):
+    """
+        Listens for Postgres notifications (LISTEN / NOTIFY) on a single channel and calls `on_notify(payload)` of
+        every subscriber for each of them. Listening is done in a daemon thread on a dedicated connection (not from
+        the pool), which is started lazily and re-started in a forked process (gunicorn workers). There should be a
+        single listener per channel, shared by all of its subscribers, so that each process only needs one connection.
+
+        Notifications which arrive while we are disconnected are lost, so `on_reconnect()` of every subscriber is called
+        each time the connection is (re-)established - subscribers should drop any state that depends on notifications
+        there.
+    """
+    RECONNECT_BACKOFF_MAX_S = 30
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.is_listening = False
+        self._subscribers = []  # list of (on_notify, on_reconnect)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def subscribe(self, on_notify, on_reconnect):
+        with self._lock:
+            self._subscribers.append((on_notify, on_reconnect))
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.is_listening = False
+            threading.Thread(target=self._run, name=f'db-listen-{self.channel}', daemon=True).start()
+
+    def _run(self):
+        backoff = 1
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                # if we were connected before the failure, start with a short backoff again:
+                if self.is_listening:
+                    backoff = 1
+                log.exception(f"DB listener on channel '{self.channel}' failed, reconnecting in {backoff}s")
+            self.is_listening = False
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.RECONNECT_BACKOFF_MAX_S)
+
+    def _listen(self):
+        conn = psycopg2.connect(**_get_db_connection_params())
+        try:
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as c:
+                c.execute(f'LISTEN {self.channel};')
+            for _, on_reconnect in self._subscribers:
+                on_reconnect()
+            self.is_listening = True
+            while True:
+                if select.select([conn], [], [], 5.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notification = conn.notifies.pop(0)
+                    for on_notify, _ in self._subscribers:
+                        on_notify(notification.payload)
+        finally:
+            conn.close()
+
+
+def db_notify(cursor, channel, payload):
+    cursor.execute('SELECT pg_notify(%s, %s);', (channel, payload,))
+
+
 # This class is only needed until we replace all db.cursor() calls with get_db_cursor()
 class ThinDBWrapper(object):
     @staticmethod
@@ -607,3 +682,177 @@ def migration_step_30():
     """ Persons should be able to select their timezone. """
     with db.cursor() as c:
         c.execute("ALTER TABLE persons ADD COLUMN timezone VARCHAR(64) NOT NULL DEFAULT 'UTC';")
+
+def migration_step_31():
+    """ Per-account token buckets for rate limiting of ingestion (shared by all workers). State is transient, so the table is unlogged. """
+    with db.cursor() as c:
+        c.execute("""
+            CREATE UNLOGGED TABLE rate_limit_buckets (
+                account INTEGER NOT NULL REFERENCES accounts(id) ON DELETE CASCADE,
+                bucket VARCHAR(20) NOT NULL,
+                tokens DOUBLE PRECISION NOT NULL,
+                updated_at TIMESTAMP WITH TIME ZONE NOT NULL,
+                PRIMARY KEY (account, bucket)
+            );
+        """)
+
+def migration_step_32():
+    """ Per-path metadata (first and last timestamp, estimated number of values), so that we don't need to scan measurements for it. """
+    with db.cursor() as c:
+        c.execute("ALTER TABLE paths ADD COLUMN first_ts TIMESTAMP NULL, ADD COLUMN last_ts TIMESTAMP NULL, ADD COLUMN row_count_estimate BIGINT NOT NULL DEFAULT 0;")
+        c.execute("""
+            UPDATE paths p
+            SET first_ts = m.first_ts, last_ts = m.last_ts, row_count_estimate = m.n
+            FROM (SELECT path, MIN(ts) AS first_ts, MAX(ts) AS last_ts, COUNT(*) AS n FROM measurements GROUP BY path) m
+            WHERE p.id = m.path;
+        """)
+
+def migration_step_33():
+    """ The latest value of each path, so that we don't need to search measurements for it. """
+    with db.cursor() as c:
+        c.execute("""
+            CREATE TABLE latest_values (
+                path INTEGER NOT NULL PRIMARY KEY REFERENCES paths(id) ON DELETE CASCADE,
+                ts TIMESTAMP NOT NULL,
+                value NUMERIC NOT NULL
+            );
+        """)
+        c.execute("CREATE INDEX latest_values_ts_value ON latest_values (ts DESC, value DESC);")
+        c.execute("INSERT INTO latest_values (path, ts, value) SELECT DISTINCT ON (path) path, ts, value FROM measurements ORDER BY path, ts DESC;")
+
+def migration_step_34():
+    """ Index which can be used by LIKE 'prefix%' (unlike the unique index on paths, which uses the default collation). """
+    with db.cursor() as c:
+        c.execute("CREATE INDEX paths_account_path_pattern ON paths (account, path text_pattern_ops);")
+
+def migration_step_35():
+    """
+        Index of path segments, for browsing paths level by level: a row for every distinct prefix of paths (split into
+        parent prefix and its last segment), with the number of distinct segments which follow it and whether it is a
+        path itself. It is maintained by triggers on paths, so it is up to date however paths are inserted, renamed or
+        deleted.
+    """
+    with db.cursor() as c:
+        # "C" collation sorts by code points (same as path filter matching) and allows ORDER BY segment to use the index:
+        c.execute("""
+            CREATE TABLE path_segments (
+                account INTEGER NOT NULL REFERENCES accounts(id) ON DELETE CASCADE,
+                parent TEXT COLLATE "C" NOT NULL,
+                segment TEXT COLLATE "C" NOT NULL,
+                n_children INTEGER NOT NULL DEFAULT 0,
+                is_path BOOLEAN NOT NULL DEFAULT FALSE,
+                PRIMARY KEY (account, parent, segment)
+            );
+        """)
+        c.execute("""
+            CREATE OR REPLACE FUNCTION path_segments_add(v_account INTEGER, v_path TEXT) RETURNS void AS $$
+            DECLARE
+                v_parts TEXT[] := string_to_array(v_path, '.');
+                v_n INTEGER := array_length(v_parts, 1);
+            BEGIN
+                FOR i IN 1..v_n LOOP
+                    INSERT INTO path_segments (account, parent, segment, is_path) VALUES (v_account, array_to_string(v_parts[1:i - 1], '.'), v_parts[i], i = v_n)
+                    ON CONFLICT (account, parent, segment) DO NOTHING;
+                    IF FOUND THEN
+                        IF i > 1 THEN
+                            UPDATE path_segments SET n_children = n_children + 1
+                            WHERE account = v_account AND parent = array_to_string(v_parts[1:i - 2], '.') AND segment = v_parts[i - 1];
+                        END IF;
+                    ELSIF i = v_n THEN
+                        UPDATE path_segments SET is_path = TRUE
+                        WHERE account = v_account AND parent = array_to_string(v_parts[1:i - 1], '.') AND segment = v_parts[i];
+                    END IF;
+                END LOOP;
+            END;
+            $$ LANGUAGE plpgsql;
+        """)
+        # Path is already removed from paths when this is called. Prefixes are checked from the longest one; as soon as
+        # some other path still has the prefix, the shorter prefixes are needed too. Range conditions (instead of LIKE,
+        # which would need escaping) use the index on (account, path text_pattern_ops):
+        c.execute("""
+            CREATE OR REPLACE FUNCTION path_segments_remove(v_account INTEGER, v_path TEXT) RETURNS void AS $$
+            DECLARE
+                v_parts TEXT[] := string_to_array(v_path, '.');
+                v_n INTEGER := array_length(v_parts, 1);
+                v_prefix TEXT;
+            BEGIN
+                FOR i IN REVERSE v_n..1 LOOP
+                    v_prefix := array_to_string(v_parts[1:i], '.');
+                    IF EXISTS (SELECT 1 FROM paths WHERE account = v_account AND path ~>=~ (v_prefix || '.') AND path ~<~ (v_prefix || '/'))
+                        OR (i < v_n AND EXISTS (SELECT 1 FROM paths WHERE account = v_account AND path = v_prefix)) THEN
+                        IF i = v_n THEN
+                            UPDATE path_segments SET is_path = FALSE
+                            WHERE account = v_account AND parent = array_to_string(v_parts[1:i - 1], '.') AND segment = v_parts[i];
+                        END IF;
+                        RETURN;
+                    END IF;
+                    DELETE FROM path_segments WHERE account = v_account AND parent = array_to_string(v_parts[1:i - 1], '.') AND segment = v_parts[i];
+                    IF i > 1 THEN
+                        UPDATE path_segments SET n_children = n_children - 1
+                        WHERE account = v_account AND parent = array_to_string(v_parts[1:i - 2], '.') AND segment = v_parts[i - 1];
+                    END IF;
+                END LOOP;
+            END;
+            $$ LANGUAGE plpgsql;
+        """)
+        c.execute("""
+            CREATE OR REPLACE FUNCTION paths_update_path_segments() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'UPDATE' AND OLD.account = NEW.account AND OLD.path = NEW.path THEN
+                    RETURN NULL;
+                END IF;
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    PERFORM path_segments_remove(OLD.account, OLD.path);
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    PERFORM path_segments_add(NEW.account, NEW.path);
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        """)
+        c.execute("CREATE TRIGGER paths_path_segments AFTER INSERT OR DELETE OR UPDATE OF account, path ON paths FOR EACH ROW EXECUTE PROCEDURE paths_update_path_segments();")
+
+        # existing paths:
+        c.execute("""
+            INSERT INTO path_segments (account, parent, segment, is_path)
+            SELECT p.account, array_to_string(p.parts[1:i - 1], '.'), p.parts[i], BOOL_OR(i = array_length(p.parts, 1))
+            FROM (SELECT account, string_to_array(path, '.') AS parts FROM paths) p, generate_series(1, array_length(p.parts, 1)) AS i
+            GROUP BY 1, 2, 3;
+        """)
+        c.execute("""
+            UPDATE path_segments s
+            SET n_children = c.n_children
+            FROM (SELECT account, parent, COUNT(*) AS n_children FROM path_segments WHERE parent <> '' GROUP BY account, parent) c
+            WHERE c.account = s.account AND c.parent = (CASE WHEN s.parent = '' THEN s.segment ELSE s.parent || '.' || s.segment END);
+        """)
+
+def migration_step_36():
+    """ Re-create continuous aggregates with the number and the sum of values, so that sums and averages over ranges
+        are exact even when values are not evenly spread in time.
+
+        The same warnings apply as with migration step 27 - on a big existing database, drop and re-create the
+        continuous aggregates one by one (waiting for each one to be built), then skip this step:
+          DROP VIEW measurements_aggr_1 CASCADE;
+          CREATE VIEW measurements_aggr_1 WITH (timescaledb.continuous) AS SELECT path, TIME_BUCKET('3 hour'::interval, ts) AS period, AVG(value) AS average, MIN(value) AS minimum, MAX(value) AS maximum, SUM(value) AS total, COUNT(value) AS n_values FROM measurements GROUP BY path, period;
+          ...
+          UPDATE runtime_data SET schema_version = 36;
+    """
+    with db.cursor() as c:
+        for aggr_level in range(0, 7):
+            c.execute(f"DROP VIEW measurements_aggr_{aggr_level} CASCADE;")
+            c.execute(f"""
+                CREATE VIEW measurements_aggr_{aggr_level}
+                WITH (timescaledb.continuous) AS
+                SELECT
+                    path,
+                    TIME_BUCKET('{3 ** aggr_level} hour'::interval, ts) AS period,
+                    AVG(value) AS average,
+                    MIN(value) AS minimum,
+                    MAX(value) AS maximum,
+                    SUM(value) AS total,
+                    COUNT(value) AS n_values
+                FROM
+                    measurements
+                GROUP BY path, period
+            """)
@@ -0,0 +1,74 @@
+"""
+    Downsampling of time series to a given number of points, so that charts get (roughly) one point per pixel instead
+    of all the raw data. Functions return the indexes of the points that should be kept (sorted).
+
+    Note that at most MAX_DATAPOINTS_RETURNED (100k) points per path are downsampled, and at this size pure Python is as
+    fast as NumPy (converting the lists to arrays and per-bucket overhead take as long as the computation itself).
+"""
+import math
+
+
+ALGORITHMS = ['lttb', 'minmax']
+
+
+def downsample(algorithm, ts, vs, max_points):
+    if algorithm == 'lttb':
+        return lttb(ts, vs, max_points)
+    if algorithm == 'minmax':
+        return minmax(ts, vs, max_points)
+    raise ValueError(f"Unknown downsampling algorithm: {algorithm}")
+
+
+def _bucket_bounds(n_buckets, first, last):
+    """ Splits the points between `first` and `last` (exclusive) into `n_buckets` buckets with (almost) equal number of points. """
+    every = (last - first) / n_buckets
+    return [first + int(math.floor(i * every)) for i in range(n_buckets + 1)]
+
+
+def lttb(ts, vs, max_points):
+    """
+        Largest-Triangle-Three-Buckets (Sveinn Steinarsson, 2013): first and last points are always kept, the others are
+        split into (max_points - 2) buckets, and from each bucket the point which forms the largest triangle with the
+        previously selected point and the average of the next bucket is selected.
+    """
+    n = len(ts)
+    if max_points >= n or max_points < 3:
+        return list(range(n))
+    bounds = _bucket_bounds(max_points - 2, 1, n - 1)
+
+    selected = [0]
+    a = 0
+    for i in range(len(bounds) - 1):
+        start, end = bounds[i], bounds[i + 1]
+        # average of the next bucket (the last point if this is the last bucket):
+        next_start, next_end = (bounds[i + 1], bounds[i + 2]) if i + 2 < len(bounds) else (n - 1, n)
+        avg_t = sum(ts[next_start:next_end]) / (next_end - next_start)
+        avg_v = sum(vs[next_start:next_end]) / (next_end - next_start)
+        ta, va = ts[a], vs[a]
+        max_area, a = -1., start
+        for j in range(start, end):
+            area = abs((ta - avg_t) * (vs[j] - va) - (ta - ts[j]) * (avg_v - va))
+            if area > max_area:
+                max_area, a = area, j
+        selected.append(a)
+    selected.append(n - 1)
+    return selected
+
+
+def minmax(ts, vs, max_points):
+    """
+        Splits the points into (max_points / 2) buckets and keeps the minimum and the maximum of each bucket, so that
+        spikes are never lost.
+    """
+    n = len(ts)
+    n_buckets = max_points // 2
+    if max_points >= n or n_buckets < 1:
+        return list(range(n))
+    bounds = _bucket_bounds(n_buckets, 0, n)
+
+    selected = set()
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        bucket = range(start, end)
+        selected.add(min(bucket, key=lambda j: vs[j]))
+        selected.add(max(bucket, key=lambda j: vs[j]))
+    return sorted(selected)
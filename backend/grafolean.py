@@ -75,11 +75,13 @@ async def redoc_html():
     )
 
 
-from datatypes import ValidationError, Permission, Bot
+from datatypes import ValidationError, Permission, Bot, Stats
 import dbutils
 from utils import log
 from auth import JWT, AuthFailedException
-from api import CORS_DOMAINS, accounts_api, admin_api, auth_api, profile_api, users_api, status_api, plugins_api
+from api import (CORS_DOMAINS, accounts_api, admin_api, auth_api, profile_api, users_api, status_api, plugins_api, write_behind_buffer,
+    WRITE_BEHIND_ENABLED, values_changes_coalescer, MQTT_VALUES_COALESCE, mqtt_publisher, MQTT_PUBLISH_CLOSE_TIMEOUT_S,
+)
 import validators
 
 
@@ -93,6 +95,18 @@ app.include_router(profile_api)
 app.include_router(plugins_api)
 
 
+@app.on_event("shutdown")
+def flush_buffers():
+    # make sure that the values which were already accepted (and their stats) are saved before the worker exits, and
+    # that the changes are published (publishing is asynchronous, so we must wait for the queued messages to be sent):
+    if WRITE_BEHIND_ENABLED:
+        write_behind_buffer.shutdown()
+    Stats.flush()
+    if MQTT_VALUES_COALESCE:
+        values_changes_coalescer.flush()
+    mqtt_publisher.close(timeout=MQTT_PUBLISH_CLOSE_TIMEOUT_S)
+
+
 NO_AUTH_ENDPOINTS = [
     ('POST', '/api/persons/signup/new'),
     ('POST', '/api/admin/migratedb'),
@@ -206,7 +220,7 @@ app.add_middleware(
 def handle_invalid_usage(request: Request, error: Exception):
     content_type_header = request.headers.get('content-type', None)
     str_error = error.message if hasattr(error, 'message') else str(error)
-    if not content_type_header or content_type_header != 'application/json':
+    if not content_type_header or content_type_header not in ['application/json', 'application/x-ndjson', 'application/x-grafolean-line-protocol', 'application/msgpack', 'application/x-msgpack']:
         str_error = "{} - maybe Content-Type header was not set to application/json?".format(str_error)
     return Response(content='Input validation failed: {}'.format(str_error), status_code=400)
 
@@ -0,0 +1,178 @@
+"""
+    Trie of paths (split into segments on '.'), which allows finding the paths that match a path filter by walking the
+    tree instead of matching a regex against every path. Matching paths are yielded in sorted order, so the search can
+    stop as soon as enough of them are found.
+"""
+import bisect
+
+
+class _Node(object):
+    __slots__ = ('children', 'path_id', '_entries')
+
+    def __init__(self):
+        self.children = None  # segment -> _Node; most of the nodes are leaves, so dict is only created when needed
+        self.path_id = None  # set if path ends at this node
+        self._entries = None
+
+    def get_entries(self):
+        """
+            Returns the children in the order of paths: for each child there are two entries, its segment (the path
+            which ends at the child) and segment + '.' (the paths below it). These are not the same order as the order of
+            segments (because of characters like '-', which sort before '.'). The list is kept up to date when children
+            are added or removed, so it is only sorted once.
+        """
+        if self._entries is None:
+            self._entries = sorted(entry for segment in (self.children or ()) for entry in (segment, segment + '.'))
+        return self._entries
+
+    def add_child(self, segment):
+        if self.children is None:
+            self.children = {}
+        child = self.children.get(segment)
+        if child is None:
+            child = self.children[segment] = _Node()
+            if self._entries is not None:
+                bisect.insort(self._entries, segment)
+                bisect.insort(self._entries, segment + '.')
+        return child
+
+    def remove_child(self, segment):
+        del self.children[segment]
+        if not self.children:
+            self.children = None
+            self._entries = None
+        elif self._entries is not None:
+            for entry in (segment, segment + '.'):
+                del self._entries[bisect.bisect_left(self._entries, entry)]
+
+
+class PathTrie(object):
+    # NFA state which means that everything below the node matches (the rest of unfinished path filter can be anything):
+    _ALL = -1
+
+    def __init__(self):
+        self._root = _Node()
+        self._paths_by_id = {}
+
+    def __len__(self):
+        return len(self._paths_by_id)
+
+    def __contains__(self, path_id):
+        return path_id in self._paths_by_id
+
+    def add(self, path_id, path):
+        """ Adds a path - or renames it, if path with this id already exists. """
+        existing_path = self._paths_by_id.get(path_id)
+        if existing_path == path:
+            return
+        if existing_path is not None:
+            self.remove(path_id)
+        node = self._root
+        for segment in path.split('.'):
+            node = node.add_child(segment)
+        node.path_id = path_id
+        self._paths_by_id[path_id] = path
+
+    def remove(self, path_id):
+        path = self._paths_by_id.pop(path_id, None)
+        if path is None:
+            return
+        segments = path.split('.')
+        nodes = [self._root]
+        for segment in segments:
+            nodes.append(nodes[-1].children[segment])
+        nodes[-1].path_id = None
+        # remove the nodes which are not needed anymore:
+        for i in range(len(segments), 0, -1):
+            if nodes[i].children or nodes[i].path_id is not None:
+                break
+            nodes[i - 1].remove_child(segments[i - 1])
+
+    def find(self, path_filter, limit, allow_trailing_chars=False):
+        """
+            Returns a list of (at most `limit`) paths that match the path filter, sorted by path, as dicts with `id` and
+            `path`, and True if there are more matching paths. The semantics are the same as those of the regex built
+            by PathFilter._regex_from_filter().
+        """
+        segments = path_filter.split('.')
+        found = []
+        for path_id in self._iter_matching(self._root, frozenset([0]), segments, allow_trailing_chars):
+            if len(found) == limit:
+                return found, True
+            found.append({'id': path_id, 'path': self._paths_by_id[path_id]})
+        return found, False
+
+    def _depends_on_segment(self, state, segments, allow_trailing_chars):
+        """ Returns True if the next state after `state` depends on the segment that is consumed (and not only on the filter). """
+        n = len(segments)
+        if state == self._ALL or state == n:
+            return False
+        if allow_trailing_chars and state == n - 1:
+            return segments[state] not in ('*', '?', '')
+        return segments[state] not in ('*', '?')
+
+    def _next_states(self, states, segment, segments, allow_trailing_chars):
+        """ Returns the states of filter matching (indexes of the next filter segment) after `segment` was consumed. """
+        next_states = set()
+        n = len(segments)
+        for i in states:
+            if i == self._ALL:
+                return frozenset([self._ALL])
+            if i == n:
+                continue
+            f = segments[i]
+            if allow_trailing_chars and i == n - 1:
+                # the last segment of unfinished filter might be only a part of the segment, and anything can follow it:
+                if f in ('*', '?', '') or segment.startswith(f):
+                    return frozenset([self._ALL])
+            elif f == '?':
+                next_states.add(i + 1)
+            elif f == '*':
+                next_states.add(i + 1)  # '*' matches one or more segments
+                next_states.add(i)
+            elif f == segment:
+                next_states.add(i + 1)
+        return frozenset(next_states)
+
+    def _iter_matching(self, node, states, segments, allow_trailing_chars):
+        """ Yields ids of matching paths below the node, in order. Children are only visited when they are needed. """
+        if not node.children:
+            return
+        n = len(segments)
+        if any(self._depends_on_segment(i, segments, allow_trailing_chars) for i in states):
+            shared_states = None
+            if all(i != self._ALL and i < n and segments[i] not in ('*', '?') and not (allow_trailing_chars and i == n - 1) for i in states):
+                # only literal segments can match, no need to check all the children:
+                entries = sorted(entry for segment in set(segments[i] for i in states) if segment in node.children for entry in (segment, segment + '.'))
+            else:
+                entries = node.get_entries()
+        else:
+            # wildcards match any segment, so the states are the same for all of the children:
+            shared_states = self._next_states(states, '', segments, allow_trailing_chars)
+            if not shared_states:
+                return
+            entries = node.get_entries()
+
+        pending_states = {}  # segment -> states, computed for path entry and needed again for subtree entry
+        for entry in entries:
+            is_subtree = entry[-1] == '.'
+            segment = entry[:-1] if is_subtree else entry
+            child = node.children[segment]
+            if is_subtree and not child.children:
+                continue
+            if not is_subtree and child.path_id is None:
+                continue
+            if shared_states is not None:
+                child_states = shared_states
+            else:
+                child_states = pending_states.pop(segment, None) if is_subtree else None
+                if child_states is None:
+                    child_states = self._next_states(states, segment, segments, allow_trailing_chars)
+                    if not is_subtree and child.children:
+                        pending_states[segment] = child_states
+            if not child_states:
+                continue
+            if is_subtree:
+                yield from self._iter_matching(child, child_states, segments, allow_trailing_chars)
+            elif self._ALL in child_states or n in child_states:
+                yield child.path_id
@@ -0,0 +1,19 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pytest
+
+
+class ListeningStub(object):
+    is_listening = True
+
+    def ensure_started(self):
+        pass
+
+
+@pytest.fixture
+def paths_listener(monkeypatch):
+    """ Pretends that the listener for path changes is connected, so that the caches which depend on it are enabled. """
+    import datatypes  # imported here so that env vars can be set (by test modules) before it is imported
+    listener = ListeningStub()
+    monkeypatch.setattr(datatypes, 'paths_listener', listener)
+    return listener
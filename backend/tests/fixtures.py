@@ -38,7 +38,7 @@ from api.common import SuperuserJWTToken
 from dbutils import db, migrate_if_needed
 from utils import log
 from auth import JWT
-from datatypes import clear_all_lru_cache
+from datatypes import clear_all_lru_cache, Stats
 
 
 USERNAME_ADMIN = 'admin'
@@ -71,8 +71,9 @@ def _delete_all_from_db():
         ]:
             log.info(sql)
             c.execute(sql)
-    # don't forget to clear memoization cache:
+    # don't forget to clear memoization cache (and stats which were not saved yet):
     clear_all_lru_cache()
+    Stats._pending.clear()
     SuperuserJWTToken.clear_cache()
 
 
@@ -0,0 +1,80 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import math
+import pytest
+
+import downsampling
+from api.accounts import _downsample_paths_data
+
+
+def sine(n):
+    ts = [1000. + i for i in range(n)]
+    vs = [math.sin(i / 10.) for i in range(n)]
+    return ts, vs
+
+
+@pytest.mark.parametrize("algorithm", downsampling.ALGORITHMS)
+def test_downsample_too_few_points(algorithm):
+    ts, vs = sine(10)
+    assert downsampling.downsample(algorithm, ts, vs, 10) == list(range(10))
+    assert downsampling.downsample(algorithm, ts, vs, 100) == list(range(10))
+    assert downsampling.downsample(algorithm, [], [], 100) == []
+
+
+@pytest.mark.parametrize("algorithm", downsampling.ALGORITHMS)
+def test_downsample_max_points(algorithm):
+    ts, vs = sine(1000)
+    for max_points in [3, 4, 50, 999]:
+        indexes = downsampling.downsample(algorithm, ts, vs, max_points)
+        assert 2 <= len(indexes) <= max_points
+        assert indexes == sorted(set(indexes))
+        assert 0 <= indexes[0] and indexes[-1] < 1000
+
+
+def test_lttb_keeps_first_and_last():
+    ts, vs = sine(1000)
+    indexes = downsampling.lttb(ts, vs, 100)
+    assert len(indexes) == 100
+    assert indexes[0] == 0
+    assert indexes[-1] == 999
+
+
+@pytest.mark.parametrize("algorithm", downsampling.ALGORITHMS)
+def test_downsample_keeps_spikes(algorithm):
+    ts, vs = sine(1000)
+    vs[123] = 100.
+    vs[789] = -100.
+    indexes = downsampling.downsample(algorithm, ts, vs, 20)
+    assert 123 in indexes
+    assert 789 in indexes
+
+
+def test_minmax_buckets():
+    ts = list(range(8))
+    vs = [5, 1, 9, 3, 2, 2, 7, 0]
+    assert downsampling.minmax(ts, vs, 4) == [1, 2, 6, 7]
+
+
+def test_downsample_unknown_algorithm():
+    with pytest.raises(ValueError):
+        downsampling.downsample('avg', [1., 2.], [1., 2.], 3)
+
+
+def test_downsample_paths_data():
+    ts, vs = sine(1000)
+    paths_data = {
+        'aaa.bbb': {
+            'next_data_point': 2000.,
+            'data': [{'t': t, 'v': v} for t, v in zip(ts, vs)],
+        },
+        'aaa.ccc': {
+            'next_data_point': None,
+            'data': [],
+        },
+    }
+    ret = _downsample_paths_data(paths_data, 'lttb', 10)
+    assert ret['aaa.bbb']['next_data_point'] == 2000.
+    assert len(ret['aaa.bbb']['data']) == 10
+    assert ret['aaa.bbb']['data'][0] == {'t': 1000., 'v': 0.}
+    assert all(d in paths_data['aaa.bbb']['data'] for d in ret['aaa.bbb']['data'])
+    assert ret['aaa.ccc'] == {'next_data_point': None, 'data': []}
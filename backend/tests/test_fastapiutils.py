@@ -0,0 +1,69 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gzip
+import json
+
+from fastapi import FastAPI, Request, Response
+from fastapi.testclient import TestClient
+import pytest
+import zstandard
+
+from api import fastapiutils
+from api.fastapiutils import iter_body, read_body
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+
+    @app.post("/body")
+    async def body(request: Request):
+        return Response(content=b''.join([body_part async for body_part in iter_body(request)]))
+
+    @app.post("/json")
+    async def json_body(request: Request):
+        return await read_body(request)
+
+    return TestClient(app)
+
+
+BODY = json.dumps([{'p': 'netflow.1m.ingress.entity.123.if.4', 't': 1330002000 + i, 'v': i} for i in range(1000)]).encode()
+
+
+def test_iter_body_gzip(client):
+    r = client.post('/body', content=gzip.compress(BODY), headers={'Content-Encoding': 'gzip'})
+    assert r.status_code == 200
+    assert r.content == BODY
+
+    # multiple gzip members:
+    r = client.post('/body', content=gzip.compress(BODY[:100]) + gzip.compress(BODY[100:]), headers={'Content-Encoding': 'gzip'})
+    assert r.content == BODY
+
+    r = client.post('/json', content=gzip.compress(BODY), headers={'Content-Encoding': 'gzip'})
+    assert r.json() == json.loads(BODY)
+
+
+def test_iter_body_zstd(client):
+    r = client.post('/body', content=zstandard.ZstdCompressor().compress(BODY), headers={'Content-Encoding': 'zstd'})
+    assert r.status_code == 200
+    assert r.content == BODY
+
+
+def test_iter_body_invalid(client):
+    r = client.post('/body', content=BODY, headers={'Content-Encoding': 'gzip'})
+    assert r.status_code == 400
+    r = client.post('/body', content=gzip.compress(BODY)[:-20], headers={'Content-Encoding': 'gzip'})
+    assert r.status_code == 400
+    r = client.post('/body', content=BODY, headers={'Content-Encoding': 'br'})
+    assert r.status_code == 415
+
+
+def test_iter_body_size_limit(client, monkeypatch):
+    monkeypatch.setattr(fastapiutils, 'MAX_DECOMPRESSED_BODY_SIZE', 1024 * 1024)
+    bomb = gzip.compress(b'0' * (100 * 1024 * 1024))  # ~100kB
+    r = client.post('/body', content=bomb, headers={'Content-Encoding': 'gzip'})
+    assert r.status_code == 413
+
+    # limit applies to compressed bodies only:
+    r = client.post('/body', content=b'0' * (2 * 1024 * 1024))
+    assert r.status_code == 200
@@ -7,6 +7,7 @@ import re
 import sys
 import time
 
+import msgpack
 import pytest
 
 
@@ -19,10 +20,12 @@ from fixtures import (
     person_authorization_header, mqtt_client_factory, MqttMessage, mqtt_message_queue_factory, mqtt_messages, mqtt_wait_for_message,
 )
 
+from api import accounts
 from api.common import SuperuserJWTToken
-from dbutils import TIMESCALE_DB_EPOCH
+from dbutils import TIMESCALE_DB_EPOCH, db
 from utils import log
 from auth import JWT
+from datatypes import Measurement, Path, PathFilter, PathTrieIndex, Stats
 
 
 def setup_module():
@@ -193,6 +196,52 @@ def test_values_put_get_topN(app_client, admin_authorization_header, account_id)
     expected['total'] = actual['total']
     assert expected == actual
 
+    # at the latest timestamp, latest values are used instead of searching measurements:
+    r = app_client.get(f'/api/accounts/{account_id}/topvalues/?f=aaa.bbb.1min.*&n=2&t={1234567890.123 + 150}', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    actual = r.json()
+    assert actual['t'] == 1234567890.123 + 2 * 60.0
+    assert actual['total'] == pytest.approx(sum([550.3 * i + 2 for i in range(10)]))
+    assert actual['list'] == [
+        {'p': 'aaa.bbb.1min.9', 'v': 550.3 * 9 + 2},
+        {'p': 'aaa.bbb.1min.8', 'v': 550.3 * 8 + 2},
+    ]
+
+def test_values_put_get_lastvalues(app_client, admin_authorization_header, account_id):
+    """
+        Latest value of each path is kept up to date (older values don't overwrite it) and can be fetched in bulk.
+    """
+    data = [{'p': f'test.lastvalues.{i}', 't': 1330002000 + 60, 'v': i} for i in range(5)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    data = [{'p': 'test.lastvalues.0', 't': 1330002000, 'v': 100}, {'p': 'test.lastvalues.1', 't': 1330002000 + 120, 'v': 101}]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+
+    r = app_client.get(f'/api/accounts/{account_id}/lastvalues/?p=test.lastvalues.0,test.lastvalues.1,test.lastvalues.nonexistent', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert r.json() == {
+        'paths': {
+            'test.lastvalues.0': {'t': 1330002000.0 + 60, 'v': 0.0},
+            'test.lastvalues.1': {'t': 1330002000.0 + 120, 'v': 101.0},
+        },
+        'limit_reached': False,
+    }
+
+    r = app_client.post(f'/api/accounts/{account_id}/getlastvalues/', json={'f': 'test.lastvalues.*', 'limit': 3}, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert r.json() == {
+        'paths': {
+            'test.lastvalues.0': {'t': 1330002000.0 + 60, 'v': 0.0},
+            'test.lastvalues.1': {'t': 1330002000.0 + 120, 'v': 101.0},
+            'test.lastvalues.2': {'t': 1330002000.0 + 60, 'v': 2.0},
+        },
+        'limit_reached': True,
+    }
+
+    r = app_client.get(f'/api/accounts/{account_id}/lastvalues/', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 400
+
 @pytest.mark.parametrize("value_str,value_float", [
     ['0.000701', 0.000701],
     ['7.01e-04', 0.000701],
@@ -258,6 +307,176 @@ def test_values_put_get_sort_limit(app_client, admin_authorization_header, accou
     actual = r.json()
     assert expected == actual
 
+def test_values_put_batch_duplicates(app_client, admin_authorization_header, account_id):
+    """
+        Put a batch with many paths and with duplicate (path, ts) pairs - the last value should win.
+    """
+    data = [{'p': f'test.values.batch.{i}', 't': 1330002000 + 60, 'v': i} for i in range(50)]
+    data.append({'p': 'test.values.batch.7', 't': 1330002000 + 60, 'v': 777})
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+
+    r = app_client.get(f'/api/accounts/{account_id}/paths/?filter=test.values.batch.?&limit=100', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    assert len(r.json()['paths']['test.values.batch.?']) == 50
+
+    r = app_client.get(f'/api/accounts/{account_id}/values/test.values.batch.7/?t0=1330002000&t1=1330003000', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    assert r.json()['paths']['test.values.batch.7']['data'] == [{'t': 1330002000.0 + 60.0, 'v': 777.0}]
+
+def test_values_put_bulk_copy(app_client, admin_authorization_header, account_id, monkeypatch):
+    """
+        Put values using COPY (force it by lowering the threshold), overwrite some of them.
+    """
+    monkeypatch.setattr(Measurement, 'BULK_COPY_MIN_ROWS', 2)
+    TEST_PATH = 'test.values.put.bulk.copy'
+    data = [{'p': TEST_PATH, 't': 1330002000 + i, 'v': i} for i in range(10)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    data = [{'p': TEST_PATH, 't': 1330002000 + i, 'v': '0.0007010001234567'} for i in range(5)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+
+    r = app_client.get(f'/api/accounts/{account_id}/values/{TEST_PATH}/?t0=1330002000&t1=1330003000', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    expected = [{'t': 1330002000.0 + i, 'v': 0.0007010001234567 if i < 5 else float(i)} for i in range(10)]
+    assert r.json()['paths'][TEST_PATH]['data'] == expected
+
+def test_values_put_ndjson(app_client, admin_authorization_header, account_id, monkeypatch):
+    """
+        Put values as newline-delimited JSON, in multiple chunks.
+    """
+    monkeypatch.setattr(accounts, 'INGEST_CHUNK_SIZE', 3)
+    TEST_PATH = 'test.values.put.ndjson'
+    body = "\n".join(json.dumps({'p': TEST_PATH, 't': 1330002000 + i, 'v': i}) for i in range(10))
+    r = app_client.put(f'/api/accounts/{account_id}/values/', data=body, headers={'Authorization': admin_authorization_header, 'Content-Type': 'application/x-ndjson'})
+    assert r.status_code == 204, r.text
+
+    r = app_client.get(f'/api/accounts/{account_id}/values/{TEST_PATH}/?t0=1330002000&t1=1330003000', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    assert r.json()['paths'][TEST_PATH]['data'] == [{'t': 1330002000.0 + i, 'v': float(i)} for i in range(10)]
+
+    r = app_client.put(f'/api/accounts/{account_id}/values/', data='{"p": "aaa", "t": 1330002000, "v": 1}\n{"p": ', headers={'Authorization': admin_authorization_header, 'Content-Type': 'application/x-ndjson'})
+    assert r.status_code == 400, r.text
+
+def test_values_put_post_line_protocol(app_client, admin_authorization_header, account_id):
+    """
+        Put and post values using line protocol.
+    """
+    TEST_PATH = 'test.values.put.lineprotocol'
+    body = "\n".join(f'{TEST_PATH} {i} {1330002000 + i}' for i in range(10))
+    r = app_client.put(f'/api/accounts/{account_id}/values/', data=body, headers={'Authorization': admin_authorization_header, 'Content-Type': 'application/x-grafolean-line-protocol'})
+    assert r.status_code == 204, r.text
+
+    r = app_client.get(f'/api/accounts/{account_id}/values/{TEST_PATH}/?t0=1330002000&t1=1330003000', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    assert r.json()['paths'][TEST_PATH]['data'] == [{'t': 1330002000.0 + i, 'v': float(i)} for i in range(10)]
+
+    # timestamps are not allowed with POST:
+    r = app_client.post(f'/api/accounts/{account_id}/values/', data=f'{TEST_PATH} 1 1330002000', headers={'Authorization': admin_authorization_header, 'Content-Type': 'application/x-grafolean-line-protocol'})
+    assert r.status_code == 400, r.text
+    r = app_client.post(f'/api/accounts/{account_id}/values/', data=f'{TEST_PATH} 1\n', headers={'Authorization': admin_authorization_header, 'Content-Type': 'application/x-grafolean-line-protocol'})
+    assert r.status_code == 204, r.text
+
+    # JSON bodies sent as text/plain are still parsed as JSON:
+    r = app_client.put(f'/api/accounts/{account_id}/values/', data=json.dumps([{'p': TEST_PATH, 't': 1330002000, 'v': 2}]), headers={'Authorization': admin_authorization_header, 'Content-Type': 'text/plain'})
+    assert r.status_code == 204, r.text
+
+
+def test_values_put_partial(app_client, admin_authorization_header, account_id):
+    """
+        With partial=true, valid values are saved and invalid ones are reported.
+    """
+    TEST_PATH = 'test.values.put.partial'
+    data = [
+        {'p': TEST_PATH, 't': 1330002000, 'v': 1},
+        {'p': TEST_PATH, 't': 1330002001, 'v': 'abc'},
+        {'p': 'system.values', 't': 1330002002, 'v': 3},
+        {'p': TEST_PATH, 't': 1330002003, 'v': 4},
+    ]
+    r = app_client.put(f'/api/accounts/{account_id}/values/?partial=true', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert r.json() == {
+        'accepted': 2,
+        'rejected': [
+            [1, "Invalid MeasuredValue format: abc"],
+            [2, "Invalid path - should not start with 'system.'!"],
+        ],
+    }
+    r = app_client.get(f'/api/accounts/{account_id}/values/{TEST_PATH}/?t0=1330002000&t1=1330003000', headers={'Authorization': admin_authorization_header})
+    assert r.json()['paths'][TEST_PATH]['data'] == [{'t': 1330002000.0, 'v': 1.0}, {'t': 1330002003.0, 'v': 4.0}]
+
+    # indexes of lines are reported for line protocol (and NDJSON):
+    body = f'{TEST_PATH} 5 1330002005\n\nbad line\n{TEST_PATH} x 1330002006\n{TEST_PATH} 7 1330002007\n'
+    r = app_client.put(f'/api/accounts/{account_id}/values/?partial=true', data=body, headers={'Authorization': admin_authorization_header, 'Content-Type': 'application/x-grafolean-line-protocol'})
+    assert r.status_code == 200, r.text
+    assert r.json()['accepted'] == 2
+    assert [i for i, _ in r.json()['rejected']] == [2, 3]
+
+    # without partial=true, the whole batch is rejected:
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 400
+
+
+def test_values_post_malformed(app_client, admin_authorization_header, account_id):
+    """
+        Values which are valid JSON, but are not objects with fields 'p' and 'v', are rejected (not a server error).
+    """
+    TEST_PATH = 'test.values.post.malformed'
+    headers = {'Authorization': admin_authorization_header}
+    ndjson_headers = {'Authorization': admin_authorization_header, 'Content-Type': 'application/x-ndjson'}
+    for body in ['[1, 2]\n', f'{{"p": "{TEST_PATH}"}}\n', '{"v": 1}\n']:
+        r = app_client.post(f'/api/accounts/{account_id}/values/', data=body, headers=ndjson_headers)
+        assert r.status_code == 400, r.text
+    r = app_client.put(f'/api/accounts/{account_id}/values/', data='[1, 2]\n', headers=ndjson_headers)
+    assert r.status_code == 400, r.text
+    for data in [[{'p': TEST_PATH}], [{'v': 1}], ['abc'], {'p': TEST_PATH, 'v': 1}]:
+        r = app_client.post(f'/api/accounts/{account_id}/values/', json=data, headers=headers)
+        assert r.status_code == 400, r.text
+
+    # in partial mode, malformed values are reported as rejected:
+    data = [{'p': TEST_PATH, 'v': 1}, {'p': TEST_PATH}, 'abc', {'p': TEST_PATH, 'v': 'x'}]
+    r = app_client.post(f'/api/accounts/{account_id}/values/?partial=true', json=data, headers=headers)
+    assert r.status_code == 200, r.text
+    assert r.json()['accepted'] == 1
+    assert [i for i, _ in r.json()['rejected']] == [1, 2, 3]
+
+    body = f'{{"p": "{TEST_PATH}", "v": 1}}\n[1, 2]\n{{"v": 1}}\n'
+    r = app_client.post(f'/api/accounts/{account_id}/values/?partial=true', data=body, headers=ndjson_headers)
+    assert r.status_code == 200, r.text
+    assert r.json()['accepted'] == 1
+    assert [i for i, _ in r.json()['rejected']] == [1, 2]
+
+
+def test_values_put_get_msgpack(app_client, admin_authorization_header, account_id):
+    """
+        Put values and get them (raw and aggregated) using MessagePack instead of JSON.
+    """
+    TEST_PATH = 'test.values.put.msgpack'
+    data = [{'p': TEST_PATH, 't': 1330002000 + i, 'v': i} for i in range(10)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', data=msgpack.packb(data), headers={'Authorization': admin_authorization_header, 'Content-Type': 'application/msgpack'})
+    assert r.status_code == 204, r.text
+
+    headers = {'Authorization': admin_authorization_header, 'Content-Type': 'application/msgpack', 'Accept': 'application/msgpack'}
+    r = app_client.post(f'/api/accounts/{account_id}/getvalues/', data=msgpack.packb({'p': TEST_PATH, 't0': 1330002000, 't1': 1330003000}), headers=headers)
+    assert r.status_code == 200
+    assert r.headers['Content-Type'] == 'application/msgpack'
+    assert msgpack.unpackb(r.content)['paths'][TEST_PATH]['data'] == [{'t': 1330002000.0 + i, 'v': float(i)} for i in range(10)]
+
+    r = app_client.post(f'/api/accounts/{account_id}/getaggrvalues/', data=msgpack.packb({'p': TEST_PATH, 't0': 1330002000, 't1': 1330005600, 'a': 0}), headers=headers)
+    assert r.status_code == 200
+    assert r.headers['Content-Type'] == 'application/msgpack'
+    assert len(msgpack.unpackb(r.content)['paths'][TEST_PATH]['data']) == 1
+
+    # without Accept header, response is JSON as usual:
+    r = app_client.get(f'/api/accounts/{account_id}/values/{TEST_PATH}/?t0=1330002000&t1=1330003000', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    assert len(r.json()['paths'][TEST_PATH]['data']) == 10
+
+    r = app_client.put(f'/api/accounts/{account_id}/values/', data=b'\xc1', headers={'Authorization': admin_authorization_header, 'Content-Type': 'application/msgpack'})
+    assert r.status_code == 400
+
+
 def test_values_put_few_get_aggr(app_client, admin_authorization_header, account_id):
     """
         Put a few values, get aggregated value.
@@ -297,6 +516,78 @@ def test_values_put_few_get_aggr(app_client, admin_authorization_header, account
     actual = r.json()
     assert expected == actual
 
+def test_values_get_multiple_paths_limit(app_client, admin_authorization_header, account_id):
+    """
+        Get values of multiple paths (each with its own t0) at once; limit applies to each of the paths separately, for
+        raw and for aggregated data.
+    """
+    data = [{'p': f'test.values.multi.{n}', 't': 1330002000 + i * 3600, 'v': n * 100 + i} for n in range(3) for i in range(5)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+
+    args = {
+        'p': 'test.values.multi.0,test.values.multi.1,test.values.multi.2,test.values.multi.nonexistent',
+        't0': f'1330002000,{1330002000 + 3 * 3600},1330002000,1330002000',
+        't1': 1330002000 + 10 * 3600,
+        'limit': 2,
+    }
+    r = app_client.post(f'/api/accounts/{account_id}/getvalues/', json=args, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert r.json()['paths'] == {
+        'test.values.multi.0': {
+            'next_data_point': 1330002000 + 2 * 3600,
+            'data': [{'t': 1330002000.0, 'v': 0.0}, {'t': 1330002000.0 + 3600, 'v': 1.0}],
+        },
+        'test.values.multi.1': {
+            'next_data_point': None,
+            'data': [{'t': 1330002000.0 + 3 * 3600, 'v': 103.0}, {'t': 1330002000.0 + 4 * 3600, 'v': 104.0}],
+        },
+        'test.values.multi.2': {
+            'next_data_point': 1330002000 + 2 * 3600,
+            'data': [{'t': 1330002000.0, 'v': 200.0}, {'t': 1330002000.0 + 3600, 'v': 201.0}],
+        },
+        'test.values.multi.nonexistent': {
+            'next_data_point': None,
+            'data': [],
+        },
+    }
+
+    args['a'] = 0
+    r = app_client.post(f'/api/accounts/{account_id}/getaggrvalues/', json=args, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    actual = r.json()['paths']
+    # next_data_point marks the start of the next aggregation interval:
+    assert actual['test.values.multi.0']['next_data_point'] == 1330002000 + 2 * 3600
+    assert [d['t'] for d in actual['test.values.multi.0']['data']] == [1330002000.0 + 1800, 1330002000.0 + 3600 + 1800]
+    assert actual['test.values.multi.1']['next_data_point'] is None
+    assert len(actual['test.values.multi.1']['data']) == 2
+
+
+def test_values_get_meta(app_client, admin_authorization_header, account_id):
+    """
+        First / last timestamps and number of values are maintained per path; without t0, the first timestamp is used.
+    """
+    data = [{'p': 'test.values.meta.0', 't': 1330002000 + i * 60, 'v': i} for i in range(5)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    data = [{'p': 'test.values.meta.0', 't': 1330002000 - 60, 'v': 123}]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+
+    r = app_client.get(f'/api/accounts/{account_id}/values/test.values.meta.0/?t1={1330002000 + 3600}&meta=true', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    actual = r.json()
+    assert actual['meta'] == {
+        'test.values.meta.0': {
+            'first_ts': 1330002000.0 - 60,
+            'last_ts': 1330002000.0 + 4 * 60,
+            'row_count_estimate': 6,
+        },
+    }
+    assert len(actual['paths']['test.values.meta.0']['data']) == 6
+    assert actual['paths']['test.values.meta.0']['data'][0] == {'t': 1330002000.0 - 60, 'v': 123.0}
+
+
 @pytest.mark.parametrize("n_values,aggr_level", [
     [10, 0],
     [10, 1],
@@ -351,6 +642,135 @@ def test_values_put_many_get_aggr(app_client, admin_authorization_header, accoun
     r = app_client.delete('/api/accounts/{}/paths/{}'.format(account_id, path_id), headers={'Authorization': admin_authorization_header})
     assert r.status_code == 204
 
+@pytest.mark.parametrize("aggr,expected_v", [
+    ['sum', lambda i: 120. * i + 66.],
+    ['avg', lambda i: 10. * i + 5.5],
+    ['max', lambda i: 10. * i + 11.],
+])
+def test_values_topn_range(app_client, admin_authorization_header, account_id, aggr, expected_v):
+    """
+        Rank paths by values aggregated over a time range.
+    """
+    t_from = TIMESCALE_DB_EPOCH + 10 * (3**5) * 3600
+    data = [{'p': f'test.topn.range.{i}', 't': t_from + k * 600, 'v': i * 10 + k} for i in range(5) for k in range(12)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+
+    # t1 is rounded up to whole hours:
+    r = app_client.get(f'/api/accounts/{account_id}/topvalues/?f=test.topn.range.*&n=2&t0={t_from}&t1={t_from + 2 * 3600 - 100}&aggr={aggr}', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    actual = r.json()
+    assert actual['t0'] == t_from
+    assert actual['t1'] == t_from + 2 * 3600
+    assert actual['aggr'] == aggr
+    assert actual['total'] == pytest.approx(sum(expected_v(i) for i in range(5)))
+    assert actual['list'] == [
+        {'p': 'test.topn.range.4', 'v': pytest.approx(expected_v(4))},
+        {'p': 'test.topn.range.3', 'v': pytest.approx(expected_v(3))},
+    ]
+
+    r = app_client.get(f'/api/accounts/{account_id}/topvalues/?f=test.topn.range.*&t0={t_from}&aggr=median', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 400
+
+@pytest.mark.parametrize("path_filter,expected_index,expected_total", [
+    ('test.explain.1', 'paths_path', 1.),
+    ('test.explain.*', 'paths_account_path_pattern', 20.),
+    ('test.explain.?.1', 'paths_account_path_pattern', 10.),
+])
+def test_path_filter_sql_uses_index(app_client, admin_authorization_header, account_id, path_filter, expected_index, expected_total):
+    """
+        Condition built from the path filter must be able to use a btree index on paths (regex alone can't). Table is
+        almost empty, so seq scan is disabled - otherwise planner would (correctly) prefer it.
+    """
+    data = [{'p': f'test.explain.{i}', 't': 1330002000, 'v': i} for i in range(5)]
+    data.append({'p': 'test.explain.x.1', 't': 1330002000, 'v': 10})
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+
+    pf_sql, pf_params = PathFilter._sql_from_filter(path_filter)
+    with db.cursor() as c:
+        c.execute("SET enable_seqscan = off;")
+        try:
+            c.execute(f"EXPLAIN SELECT id, path FROM paths WHERE account = %s AND {pf_sql};", (account_id, *pf_params,))
+            plan = '\n'.join(line for line, in c.fetchall())
+        finally:
+            c.execute("RESET enable_seqscan;")
+    assert f' using {expected_index} on paths' in plan, plan
+
+    # topN (and its SUM query) use the same condition:
+    r = app_client.get(f'/api/accounts/{account_id}/topvalues/?f={path_filter}&n=2&t=1330002000', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert r.json()['total'] == expected_total
+
+
+def test_paths_get_same_order_from_index_and_db(app_client, admin_authorization_header, account_id, monkeypatch):
+    """
+        Paths are sorted by code points both when they are found in index of paths and in DB (regardless of collation),
+        so that pages are the same.
+    """
+    paths = ['test.order.a-b', 'test.order.a.b', 'test.order.a_b', 'test.order.aB', 'test.order.a']
+    for path in paths:
+        r = app_client.put(f'/api/accounts/{account_id}/values/', json=[{'p': path, 't': 1330002000, 'v': 1}], headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 204, r.text
+
+    for max_paths in [1000000, 0]:
+        monkeypatch.setattr(PathTrieIndex, 'MAX_PATHS', max_paths)
+        r = app_client.get(f'/api/accounts/{account_id}/paths/?filter=test.order.*&limit=3', headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 200, r.text
+        assert [p['path'] for p in r.json()['paths']['test.order.*']] == sorted(paths)[:3]
+
+
+def test_paths_children_get(app_client, admin_authorization_header, account_id):
+    """
+        Paths can be browsed level by level; index of segments is kept up to date when paths are renamed or deleted.
+    """
+    path_ids = {}
+    for path in ['test.children.a.1', 'test.children.a.2', 'test.children.a', 'test.children.b_x.1', 'test.children.b%2ex']:
+        r = app_client.put(f'/api/accounts/{account_id}/values/', json=[{'p': path, 't': 1330002000, 'v': 1}], headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 204, r.text
+        path_ids[path] = Path._get_path_id_from_db(account_id, path)
+
+    r = app_client.get(f'/api/accounts/{account_id}/paths/children/?prefix=test.children&limit=2', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert r.json() == {
+        'prefix': 'test.children',
+        'children': [
+            {'segment': 'a', 'children': 2, 'is_path': True},
+            {'segment': 'b%2ex', 'children': 0, 'is_path': True},
+        ],
+        'limit_reached': True,
+    }
+
+    r = app_client.get(f'/api/accounts/{account_id}/paths/children/', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert {'segment': 'test', 'children': 1, 'is_path': False} in r.json()['children']
+
+    r = app_client.get(f'/api/accounts/{account_id}/paths/children/?prefix=test.nonexistent', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert r.json() == {'prefix': 'test.nonexistent', 'children': [], 'limit_reached': False}
+
+    # rename and delete paths:
+    r = app_client.put(f'/api/accounts/{account_id}/paths/{path_ids["test.children.a.2"]}', json={'path': 'test.children.c.2'}, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    for path in ['test.children.a', 'test.children.b%2ex']:
+        r = app_client.delete(f'/api/accounts/{account_id}/paths/{path_ids[path]}', headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 204, r.text
+    r = app_client.get(f'/api/accounts/{account_id}/paths/children/?prefix=test.children', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert r.json()['children'] == [
+        {'segment': 'a', 'children': 1, 'is_path': False},
+        {'segment': 'b_x', 'children': 1, 'is_path': False},
+        {'segment': 'c', 'children': 1, 'is_path': False},
+    ]
+    r = app_client.delete(f'/api/accounts/{account_id}/paths/{path_ids["test.children.a.1"]}', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    r = app_client.get(f'/api/accounts/{account_id}/paths/children/?prefix=test.children', headers={'Authorization': admin_authorization_header})
+    assert [child['segment'] for child in r.json()['children']] == ['b_x', 'c']
+
+    r = app_client.get(f'/api/accounts/{account_id}/paths/children/?prefix=test.*', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 400, r.text
+
+
 def test_paths_delete_need_auth(app_client, admin_authorization_header, account_id):
     path_id = 1234  # does not exist
     r = app_client.delete('/api/accounts/{}/paths/{}'.format(account_id, path_id))
@@ -1430,11 +1850,12 @@ def test_bot_post_values_mqtt_last_login(app_client, account_id, bot_id, bot_tok
     r = app_client.post('/api/accounts/{}/values/?b={}'.format(account_id, bot_token), json=data)
     assert r.status_code == 204
 
+    Stats.flush()  # stats are otherwise saved (and published) periodically
     expected_mqtt_topics = [
         f'changed/accounts/{account_id}/values/qqqq.wwww',
+        f'changed/accounts/{account_id}/paths',
         f'changed/accounts/{account_id}/values/system.stats.inserted',
         f'changed/accounts/{account_id}/values/system.stats.changed',
-        f'changed/accounts/{account_id}/paths',
     ]
     for expected_mqtt_topic in expected_mqtt_topics:
         mqtt_message = mqtt_messages.get(timeout=3.0)
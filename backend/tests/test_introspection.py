@@ -14,6 +14,7 @@ from fixtures import (
     mqtt_client_factory, MqttMessage, mqtt_message_queue_factory, mqtt_messages,
 )
 from const import SYSTEM_PATH_UPDATED_COUNT
+from datatypes import Stats
 
 
 def setup_module():
@@ -40,6 +41,7 @@ def test_values_put_get_simple(app_client, admin_authorization_header, account_i
     data = [{'p': 'qqqq.wwww', 't': 1234567890.123456, 'v': 111.22}]
     r = app_client.put('/api/accounts/{}/values/'.format(account_id), json=data, headers={'Authorization': admin_authorization_header})
     assert r.status_code == 204, r.text
+    Stats.flush()  # stats are otherwise saved periodically
     end_time = math.ceil(time.time() / 60) * 60
 
     r = app_client.get(f'/api/accounts/{account_id}/values/{SYSTEM_PATH_UPDATED_COUNT}/?t0={start_time}&t1={end_time}', headers={'Authorization': admin_authorization_header})
@@ -78,6 +80,7 @@ def test_values_put_get_simple(app_client, admin_authorization_header, account_i
     data = [{'p': 'qqqq.wwww', 't': 1234567890.123456, 'v': 111.22}, {'p': 'qqqq.aaaa', 't': 1234567222, 'v': 333}]
     r = app_client.put('/api/accounts/{}/values/'.format(account_id), json=data, headers={'Authorization': admin_authorization_header})
     assert r.status_code == 204, r.text
+    Stats.flush()  # stats are otherwise saved periodically
 
     r = app_client.get(f'/api/accounts/{account_id}/values/{SYSTEM_PATH_UPDATED_COUNT}/?t0={start_time}&t1={end_time}', headers={'Authorization': admin_authorization_header})
     assert r.status_code == 200, r.text
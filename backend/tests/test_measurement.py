@@ -1,8 +1,60 @@
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import base64
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import struct
 import pytest
 
-from datatypes import Measurement
+import datatypes
+from datatypes import AggrTileCache, Measurement, ValidationError
+from api.accounts import _iter_values_json, _parse_ndjson_line, _values_post_data, _values_to_columnar
+
+
+class FakeCursor(object):
+    """ Records the executed queries and returns the rows which `fake_db.results(query, params)` returns for them. """
+    def __init__(self, fake_db):
+        self.fake_db = fake_db
+        self.rows = []
+
+    def execute(self, query, params=None):
+        self.fake_db.executed.append((query, params))
+        self.rows = list(self.fake_db.results(query, params))
+
+    def fetchmany(self, n):
+        ret, self.rows = self.rows[:n], self.rows[n:]
+        return ret
+
+    def fetchall(self):
+        ret, self.rows = self.rows, []
+        return ret
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+class FakeDB(object):
+    def __init__(self):
+        self.executed = []  # (query, params)
+        self.results = lambda query, params: []
+
+
+@pytest.fixture
+def fake_db_cursor(monkeypatch):
+    """ Replaces DB cursor with FakeCursor; set `results` of the returned FakeDB to return rows. """
+    fake_db = FakeDB()
+
+    @contextmanager
+    def cursor():
+        yield FakeCursor(fake_db)
+
+    monkeypatch.setattr(datatypes.db, 'cursor', cursor)
+    return fake_db
+
 
 @pytest.mark.parametrize("max_points,n_hours,expected", [
     (100, 120, 1,),
@@ -35,3 +87,342 @@ from datatypes import Measurement
 def test_Measurement_get_aggr_level(max_points, n_hours, expected):
     assert expected == Measurement._get_aggr_level(max_points, n_hours)
 
+
+
+@pytest.mark.parametrize("line,now,expected", [
+    (b'aaa.bbb 12.3 1234567890.123', None, {'p': 'aaa.bbb', 'v': '12.3', 't': '1234567890.123'}),
+    (b'  aaa.bbb\t1e-3  1234567890\r', None, {'p': 'aaa.bbb', 'v': '1e-3', 't': '1234567890'}),
+    (b'aaa.bbb 12.3', 1234567890.5, {'p': 'aaa.bbb', 'v': '12.3', 't': 1234567890.5}),
+    # invalid:
+    (b'aaa.bbb 12.3', None, None),
+    (b'aaa.bbb 12.3 1234567890', 1234567890.5, None),
+    (b'aaa.bbb 12.3 1234567890 123', None, None),
+    ('čšž 12.3 1234567890'.encode('utf-8'), None, None),
+])
+def test_Measurement_parse_line_protocol(line, now, expected):
+    try:
+        assert expected == Measurement.parse_line_protocol(line, 1, now)
+    except ValidationError:
+        assert expected is None
+
+
+@pytest.mark.parametrize("line,now,expected_error", [
+    (b'[1, 2]', None, "Invalid value on line 3: value must be a JSON object"),
+    (b'"a.b"', 1330002000, "Invalid value on line 3: value must be a JSON object"),
+    (b'{"p": "a.b"}', 1330002000, "Invalid value on line 3: value must have fields 'p' and 'v'"),
+    (b'{"v": 1}', 1330002000, "Invalid value on line 3: value must have fields 'p' and 'v'"),
+    (b'{"p": "a.b", "v": 1, "t": 1330002000}', 1330002000, "Invalid value on line 3: Parameter 't' shouldn't be specified with POST"),
+])
+def test_parse_ndjson_line_malformed(line, now, expected_error):
+    with pytest.raises(ValidationError) as ex:
+        _parse_ndjson_line(line, 3, now)
+    assert ex.value.detail == expected_error
+
+
+def test_values_post_data_malformed():
+    json_data = [{'p': 'a.b', 'v': 1}, 'a.b', {'p': 'a.b'}, {'v': 1}, {'p': 'a.c', 'v': 2}]
+    with pytest.raises(ValidationError) as ex:
+        _values_post_data(json_data, 1330002000)
+    assert ex.value.detail == "Invalid value at index 1: value must be a JSON object"
+    with pytest.raises(ValidationError):
+        _values_post_data({'p': 'a.b', 'v': 1}, 1330002000)
+
+    # in partial mode malformed values are rejected separately:
+    rejected = []
+    indexes, data = _values_post_data(json_data, 1330002000, rejected)
+    assert indexes == [0, 4]
+    assert data == [{'p': 'a.b', 'v': 1, 't': 1330002000}, {'p': 'a.c', 'v': 2, 't': 1330002000}]
+    assert rejected == [
+        (1, "value must be a JSON object"),
+        (2, "value must have fields 'p' and 'v'"),
+        (3, "value must have fields 'p' and 'v'"),
+    ]
+
+
+def test_validate_batch():
+    put_data = [
+        {'p': 'a.b', 't': 1234567890, 'v': 1},
+        {'p': 'a.b', 't': '1234567890.5', 'v': '2.5'},
+        {'p': 'a..b', 't': 1234567890, 'v': 1},
+        {'p': 'system.a', 't': 1234567890, 'v': 1},
+        {'p': 'a.b', 't': '12a', 'v': 1},
+        {'p': 'a.b', 't': 1234567890, 'v': 'abc'},
+        {'p': 'a.b', 't': 1234567890},
+        'abc',
+        {'p': 123, 't': 1234567890, 'v': 1},
+    ]
+    valid, errors = Measurement.validate_batch(put_data)
+    assert valid == [
+        (0, 'a.b', 1234567890.0, '1'),
+        (1, 'a.b', 1234567890.5, '2.5'),
+    ]
+    assert [i for i, _ in errors] == [2, 3, 4, 5, 6, 7, 8]
+    assert errors[0][1] == "Invalid PathInputValue format: a..b"
+    assert errors[1][1] == "Invalid path - should not start with 'system.'!"
+    assert errors[2][1] == "Invalid Timestamp format: 12a"
+    assert errors[3][1] == "Invalid MeasuredValue format: abc"
+
+    valid, errors = Measurement.validate_batch(put_data[3:4], allow_system=True)
+    assert len(valid) == 1 and errors == []
+
+
+def test_validate_values():
+    Measurement.validate_values([{'p': 'a.b', 't': 1234567890, 'v': 1}])
+    with pytest.raises(ValidationError):
+        Measurement.validate_values([{'p': 'a.b', 't': 1234567890, 'v': 1}, {'p': 'a.b', 't': 1234567890, 'v': 'x'}])
+
+
+def test_fetch_data_chunks(monkeypatch, fake_db_cursor):
+    """ Data is fetched in batches of paths and split into chunks; extra row marks the next data point. """
+    rows = [(11, datetime.utcfromtimestamp(1330002000 + i), i) for i in range(5)] + \
+        [(12, datetime.utcfromtimestamp(1330002000 + i), i) for i in range(2)]
+    fake_db_cursor.results = lambda query, params: [row for row in rows if row[0] in params[0]]
+    monkeypatch.setattr(datatypes.Path, '_get_path_ids_from_db', lambda account_id, paths: {'a': 11, 'b': 12})
+    monkeypatch.setattr(Measurement, 'FETCH_CHUNK_SIZE', 2)
+
+    paths = ['a', 'b', 'c']
+    args = (1, paths, None, [1330002000] * 3, 1330003000, True, 4)
+    str_paths, chunks = Measurement.fetch_data_chunks(*args)
+    chunks = list(chunks)
+    assert str_paths == paths
+    assert [(p, len(chunk), next_data_point) for p, chunk, next_data_point in chunks] == [
+        ('a', 2, None),
+        ('a', 2, None),
+        ('a', 0, 1330002004.0),
+        ('b', 2, None),
+    ]
+
+    expected = {
+        'a': {'next_data_point': 1330002004.0, 'data': [{'t': 1330002000.0 + i, 'v': float(i)} for i in range(4)]},
+        'b': {'next_data_point': None, 'data': [{'t': 1330002000.0 + i, 'v': float(i)} for i in range(2)]},
+        'c': {'next_data_point': None, 'data': []},
+    }
+    assert Measurement.fetch_data(*args) == expected
+    str_paths, chunks = Measurement.fetch_data_chunks(*args)
+    assert json.loads(''.join(_iter_values_json(str_paths, chunks))) == {'paths': expected}
+
+
+def test_fetch_data_chunks_batches(monkeypatch, fake_db_cursor):
+    """ Paths are fetched in batches (so that DB connection is not held while data is consumed). """
+    fake_db_cursor.results = lambda query, params: [(path_id, datetime.utcfromtimestamp(1330002000 + i), i) for path_id in params[0] for i in range(3)]
+    monkeypatch.setattr(datatypes.Path, '_get_path_ids_from_db', lambda account_id, paths: {p: 11 + i for i, p in enumerate(paths)})
+    monkeypatch.setattr(Measurement, 'FETCH_BATCH_ROWS', 10)
+
+    paths = ['a', 'b', 'c', 'd', 'e']
+    str_paths, chunks = Measurement.fetch_data_chunks(1, paths, None, [1330002000] * 5, 1330003000, True, 4)
+    assert fake_db_cursor.executed == []  # nothing is fetched until the data is consumed
+    assert [p for p, _, _ in chunks] == paths
+    # each path can have 5 rows (limit + 1), so there are at most 2 paths in a batch:
+    assert [params[0] for _, params in fake_db_cursor.executed] == [[11, 12], [13, 14], [15]]
+    assert 'ORDER BY q.ord' in fake_db_cursor.executed[0][0]
+
+
+AGGR_NOW = Measurement.TIMESCALEDB_EPOCH + 1000 * 3600 + 1800  # level 0: 1h intervals
+AGGR_ROWS = {11: [AGGR_NOW - 3600 * i - 1800 for i in range(1, 500)], 12: [AGGR_NOW - 3600 * i - 1800 for i in range(1, 3)]}
+
+
+@pytest.fixture
+def aggr_tile_cache(monkeypatch, fake_db_cursor, paths_listener):
+    """ Aggregated data (AGGR_ROWS) in fake DB; returns the list of (path_id, tile_start) ranges which were queried. """
+    queried_ranges = []
+
+    def results(query, params):
+        if 'UNNEST(%s::INTEGER[], %s::TIMESTAMP[])' in query:  # uncached query
+            path_ids, t_froms, t_to, limit = params
+            return [
+                (path_id, datetime.utcfromtimestamp(period), period % 100, 0, period % 1000)
+                for path_id, t_from in zip(path_ids, t_froms)
+                for period in sorted(AGGR_ROWS[path_id])[:limit]
+                if t_from <= datetime.utcfromtimestamp(period) <= t_to
+            ]
+        queried_ranges.extend(zip(params[0], params[1]))
+        return [
+            (path_id, tile_start, datetime.utcfromtimestamp(period), period % 100, 0, period % 1000)
+            for path_id, tile_start, t_from, t_to in zip(*params)
+            for period in sorted(AGGR_ROWS[path_id])
+            if t_from <= period < t_to
+        ]
+
+    fake_db_cursor.results = results
+    monkeypatch.setattr(datatypes.time, 'time', lambda: AGGR_NOW)
+    monkeypatch.setattr(datatypes.Path, '_get_path_ids_from_db', lambda account_id, paths: {p: {'a': 11, 'b': 12}[p] for p in paths})
+    monkeypatch.setattr(AggrTileCache, 'TILE_BUCKETS', 10)
+    AggrTileCache.clear()
+    yield queried_ranges
+    AggrTileCache.clear()
+
+
+def expected_aggr_data(path_id, t_from, t_to, sort_asc, limit):
+    periods = sorted([t for t in AGGR_ROWS[path_id] if t_from <= t <= t_to], reverse=not sort_asc)
+    return {
+        'next_data_point': periods[limit] if len(periods) > limit else None,
+        'data': [{'t': t + 1800, 'v': t % 100, 'minv': 0., 'maxv': t % 1000} for t in periods[:limit]],
+    }
+
+
+@pytest.mark.parametrize("sort_asc,limit,expected_queried", [
+    (True, 1000, 2 * 9 + 2),
+    (False, 1000, 2 * 9 + 2),
+    (True, 15, 2 + 9 + 1),  # 'b' has only 2 values, so all its tiles (and the tail) are needed
+    (False, 15, 2 + 9 + 1),  # the tail of 'a' (the first in descending order) and a single tile have enough values
+])
+def test_fetch_aggr_data_cached_limit(aggr_tile_cache, sort_asc, limit, expected_queried):
+    """ Only the tiles which are needed to get `limit` rows are fetched from DB. """
+    t_from, t_to = AGGR_NOW - 100 * 3600 - 1800, AGGR_NOW
+    data = Measurement.fetch_data(1, ['a', 'b'], 0, [t_from, t_from], t_to, sort_asc, limit)
+    assert data == {
+        'a': expected_aggr_data(11, t_from, t_to, sort_asc, limit),
+        'b': expected_aggr_data(12, t_from, t_to, sort_asc, limit),
+    }
+    assert len(aggr_tile_cache) == expected_queried
+
+
+def test_fetch_aggr_data_cached(aggr_tile_cache):
+    """ Closed tiles of aggregated data are cached, only the open tail (and missing tiles) are fetched from DB. """
+    t_from, t_to = AGGR_NOW - 100 * 3600 - 1800, AGGR_NOW
+    for sort_asc, limit in [(True, 1000), (False, 1000), (True, 20), (False, 20)]:
+        aggr_tile_cache.clear()
+        data = Measurement.fetch_data(1, ['a', 'b'], 0, [t_from, t_from], t_to, sort_asc, limit)
+        assert data == {
+            'a': expected_aggr_data(11, t_from, t_to, sort_asc, limit),
+            'b': expected_aggr_data(12, t_from, t_to, sort_asc, limit),
+        }
+        # the first time, all the tiles are fetched - after that only the tails (if they are needed):
+        if (sort_asc, limit) == (True, 1000):
+            assert len(aggr_tile_cache) == 2 * 9 + 2
+        elif (sort_asc, limit) == (True, 20):
+            assert aggr_tile_cache == [(12, None)]
+        else:
+            assert aggr_tile_cache == [(11, None), (12, None)]
+
+    # panning to an older range only fetches the tiles which are not cached yet:
+    aggr_tile_cache.clear()
+    t_from, t_to = AGGR_NOW - 150 * 3600, AGGR_NOW - 80 * 3600
+    data = Measurement.fetch_data(1, ['a'], 0, [t_from], t_to, True, 1000)
+    assert data == {'a': expected_aggr_data(11, t_from, t_to, True, 1000)}
+    assert len(aggr_tile_cache) == 5
+    assert all(tile_start is not None for _, tile_start in aggr_tile_cache)
+
+    # tiles of changed paths are evicted:
+    AggrTileCache._on_notify(json.dumps({'op': 'update', 'account': 1, 'ids': [11]}))
+    assert AggrTileCache._entries and all(path_id == 12 for path_id, _, _ in AggrTileCache._entries)
+
+
+def test_fetch_aggr_data_cached_too_many_tiles(aggr_tile_cache, monkeypatch):
+    """ If the range needs too many tiles, cache is not used. """
+    monkeypatch.setattr(AggrTileCache, 'MAX_TILES_PER_REQUEST', 17)
+    t_from, t_to = AGGR_NOW - 100 * 3600 - 1800, AGGR_NOW
+    data = Measurement.fetch_data(1, ['a', 'b'], 0, [t_from, t_from], t_to, True, 1000)
+    assert data == {
+        'a': expected_aggr_data(11, t_from, t_to, True, 1000),
+        'b': expected_aggr_data(12, t_from, t_to, True, 1000),
+    }
+    assert aggr_tile_cache == []
+    assert not AggrTileCache._entries
+
+
+def test_update_paths_meta(fake_db_cursor):
+    """ Timestamps and counts are aggregated per path before they are written to DB with a single query. """
+    Measurement._update_paths_meta([])
+    assert fake_db_cursor.executed == []
+
+    Measurement._update_paths_meta([(11, 1330002005., '1'), (12, 1330002000., '2'), (11, 1330002001., '3'), (11, 1330002009.5, '4')])
+    assert [params for _, params in fake_db_cursor.executed] == [([11, 12], [1330002001., 1330002000.], [1330002009.5, 1330002000.], [3, 1])]
+
+
+def test_update_latest_values(fake_db_cursor):
+    """ Only the newest value of each path is sent to DB (the last one wins if timestamps are the same). """
+    Measurement._update_latest_values([(12, 1330002005., '1'), (11, 1330002000., '2'), (12, 1330002001., '3'), (11, 1330002000., ' 4')])
+    assert [params for _, params in fake_db_cursor.executed] == [([11, 12], [1330002000., 1330002005.], ['4', '1'])]
+
+
+def test_get_oldest_measurement_time(monkeypatch, fake_db_cursor):
+    """ If first_ts of some paths is not known, it is searched for in measurements. """
+    monkeypatch.setattr(datatypes.Path, '_get_path_ids_from_db', lambda account_id, paths: {p: {'a': 11, 'b': 12, 'c': 13}[p] for p in paths})
+    fake_db_cursor.results = lambda query, params: [(datetime.utcfromtimestamp(1330001000),)]
+    paths_meta = {
+        'a': {'first_ts': 1330002000., 'last_ts': 1330002009., 'row_count_estimate': 10},
+        'b': {'first_ts': None, 'last_ts': None, 'row_count_estimate': 0},
+    }
+    assert Measurement.get_oldest_measurement_time(1, ['a', 'b'], paths_meta) == 1330001000.
+    assert fake_db_cursor.executed[-1][1] == ([12],)
+
+    fake_db_cursor.executed.clear()
+    assert Measurement.get_oldest_measurement_time(1, ['a'], {'a': paths_meta['a']}) == 1330002000.
+    assert fake_db_cursor.executed == []
+
+
+def test_iter_values_json_meta():
+    meta = {'a': {'first_ts': 1330002000., 'last_ts': 1330002009., 'row_count_estimate': 10}}
+    chunks = [('a', [{'t': 1330002000., 'v': 1.}], None)]
+    assert json.loads(''.join(_iter_values_json(['a', 'b'], chunks, meta))) == {
+        'paths': {
+            'a': {'next_data_point': None, 'data': [{'t': 1330002000., 'v': 1.}]},
+            'b': {'next_data_point': None, 'data': []},
+        },
+        'meta': meta,
+    }
+
+
+@pytest.mark.parametrize("t_from,t_to,expected", [
+    (0, 0, []),
+    (0, 1, [(0, 0, 1)]),
+    (0, 3, [(1, 0, 3)]),
+    (0, 5, [(1, 0, 3), (0, 3, 5)]),
+    (2, 10, [(0, 2, 3), (1, 3, 9), (0, 9, 10)]),
+    (8, 28, [(0, 8, 9), (2, 9, 27), (0, 27, 28)]),
+    (0, 729 * 2 + 1, [(6, 0, 729 * 2), (0, 729 * 2, 729 * 2 + 1)]),
+])
+def test_get_aggr_ranges(t_from, t_to, expected):
+    """ Time range is covered using the coarsest aggregation levels possible (times are in hours from TimescaleDB epoch). """
+    epoch = Measurement.TIMESCALEDB_EPOCH
+    actual = Measurement.get_aggr_ranges(epoch + t_from * 3600, epoch + t_to * 3600)
+    assert actual == [(l, epoch + start * 3600, epoch + end * 3600) for l, start, end in expected]
+
+
+def test_fetch_topn_range_query(monkeypatch):
+    """ Subqueries for all the needed aggregation levels are merged into a single query. """
+
+    executed = []
+
+    class FakeCursor(object):
+        def execute(self, query, params):
+            assert query.count('%s') == len(params)
+            executed.append((query, params))
+
+        def fetchall(self):
+            return [('a.b', 20, 30), ('a.c', 10, 30)]
+
+    @contextmanager
+    def cursor():
+        yield FakeCursor()
+
+    monkeypatch.setattr(datatypes.db, 'cursor', cursor)
+    epoch = Measurement.TIMESCALEDB_EPOCH
+    ret = Measurement.fetch_topn_range(1, 'a.*', epoch + 2 * 3600 + 100, epoch + 9 * 3600 + 100, 'sum', 2)
+    assert ret == (epoch + 2 * 3600, epoch + 10 * 3600, 30., [{'p': 'a.b', 'v': 20.}, {'p': 'a.c', 'v': 10.}])
+    query, params = executed[0]
+    assert 'measurements_aggr_0' in query and 'measurements_aggr_1' in query and 'measurements_aggr_2' not in query
+    assert 'SUM(a.total)' in query
+    assert params[-1] == 2
+
+
+def test_values_to_columnar():
+    paths_data = {
+        'regular': {'next_data_point': 1330002300.0, 'data': [{'t': 1330002000.0 + i * 60, 'v': i / 3} for i in range(5)]},
+        'irregular': {'next_data_point': None, 'data': [{'t': 1330002000.0, 'v': 1.0}, {'t': 1330002001.5, 'v': 2.0}, {'t': 1330002010.0, 'v': 3.0}]},
+        'aggr': {'next_data_point': None, 'data': [{'t': 1330002000.0 + i * 3600, 'v': 2.0, 'minv': 1.0, 'maxv': 3.0} for i in range(2)]},
+        'empty': {'next_data_point': None, 'data': []},
+    }
+    assert _values_to_columnar(paths_data, precision=2) == {
+        'regular': {'next_data_point': 1330002300.0, 't_start': 1330002000.0, 't_step': 60.0, 'n': 5, 'v': [0.0, 0.33, 0.67, 1.0, 1.33]},
+        'irregular': {'next_data_point': None, 't': [1330002000.0, 1330002001.5, 1330002010.0], 'v': [1.0, 2.0, 3.0]},
+        'aggr': {'next_data_point': None, 't_start': 1330002000.0, 't_step': 3600.0, 'n': 2, 'v': [2.0, 2.0], 'minv': [1.0, 1.0], 'maxv': [3.0, 3.0]},
+        'empty': {'next_data_point': None, 't': [], 'v': []},
+    }
+
+    columnar = _values_to_columnar(paths_data, binary=True)
+    assert struct.unpack('<3d', base64.b64decode(columnar['irregular']['t'])) == (1330002000.0, 1330002001.5, 1330002010.0)
+    assert struct.unpack('<5d', base64.b64decode(columnar['regular']['v'])) == tuple(i / 3 for i in range(5))
+    columnar = _values_to_columnar(paths_data, binary=True, as_bytes=True)
+    assert struct.unpack('<3d', columnar['irregular']['v']) == (1.0, 2.0, 3.0)
@@ -0,0 +1,97 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import threading
+import pytest
+
+from api import common
+from api.common import MqttPublisher, ValuesChangesCoalescer
+
+
+def test_MqttPublisher_drops_when_queue_full(monkeypatch):
+    publisher = MqttPublisher(max_queue_size=2)
+    monkeypatch.setattr(publisher, '_ensure_started', lambda: None)  # no broker - messages just stay in the queue
+
+    publisher.publish_multiple([('changed/a', '1'), ('changed/b', '2'), ('changed/c', '3')])
+    assert publisher._n_dropped == 1
+    assert publisher._queue.get_nowait() == ('changed/a', '1')
+    assert publisher._queue.get_nowait() == ('changed/b', '2')
+
+
+@pytest.fixture
+def fake_broker(monkeypatch):
+    """ Replaces paho client with a fake one which acknowledges publishes (QoS 1) asynchronously. """
+    broker = {'delivered': [], 'calls': []}
+
+    class FakeMessageInfo(object):
+        rc = common.paho.MQTT_ERR_SUCCESS
+
+        def __init__(self):
+            self._published = threading.Event()
+
+        def is_published(self):
+            return self._published.is_set()
+
+        def wait_for_publish(self, timeout=None):
+            self._published.wait(timeout)
+
+    class FakeClient(object):
+        def __init__(self, client_id):
+            pass
+
+        def username_pw_set(self, username, password):
+            pass
+
+        def connect(self, hostname, port, keepalive):
+            broker['calls'].append('connect')
+
+        def loop_start(self):
+            self.on_connect(self, None, None, 0)
+
+        def publish(self, topic, payload, qos, retain):
+            info = FakeMessageInfo()
+
+            def ack():
+                broker['delivered'].append((topic, payload))
+                info._published.set()
+            threading.Timer(0.1, ack).start()
+            return info
+
+        def disconnect(self):
+            broker['calls'].append(f'disconnect ({len(broker["delivered"])} delivered)')
+
+        def loop_stop(self):
+            broker['calls'].append('loop_stop')
+
+    monkeypatch.setattr(common.paho, 'Client', FakeClient)
+    monkeypatch.setattr(common.SuperuserJWTToken, 'get_valid_token', lambda superuser_identifier: 'token')
+    return broker
+
+
+def test_MqttPublisher_close_delivers_queued(fake_broker):
+    publisher = MqttPublisher(max_queue_size=10)
+    publisher.publish_multiple([('changed/a', '1'), ('changed/b', '2')])
+    publisher.close(timeout=5)
+    assert fake_broker['delivered'] == [('changed/a', '1'), ('changed/b', '2')]
+    # client disconnects only after the messages were acknowledged:
+    assert fake_broker['calls'] == ['connect', 'disconnect (2 delivered)', 'loop_stop']
+
+    publisher.publish_multiple([('changed/c', '3')])  # closed publisher doesn't accept messages anymore
+    assert publisher._queue.empty()
+
+
+def test_ValuesChangesCoalescer_keeps_latest(monkeypatch):
+    published = []
+    monkeypatch.setattr(common, 'mqtt_publish_changed_multiple_payloads', lambda topics_with_payloads: published.extend(topics_with_payloads))
+    coalescer = ValuesChangesCoalescer(window_ms=60000, prefix_levels=1)
+    monkeypatch.setattr(coalescer, '_ensure_started', lambda: None)
+
+    coalescer.add(1, [{'p': 'a.x', 'v': 1, 't': 20}, {'p': 'a.x', 'v': 2, 't': 10}, {'p': 'b.y', 'v': 3, 't': '10'}])
+    coalescer.add(1, [{'p': 'a.x', 'v': 4, 't': '30.5'}])
+    coalescer.flush()
+    assert sorted(published) == [
+        ('accounts/1/valuesbatch/a', {'a.x': {'v': 4, 't': '30.5'}}),
+        ('accounts/1/valuesbatch/b', {'b.y': {'v': 3, 't': '10'}}),
+    ]
+    published.clear()
+    coalescer.flush()
+    assert published == []
@@ -36,3 +36,17 @@ def test_PathFilter_input_validation(input, expected_valid):
 def test_PathFilter_regex_from_filter(path_filter_str, expected):
     assert PathFilter._regex_from_filter(path_filter_str) == expected
 
+
+@pytest.mark.parametrize("path_filter_str,allow_trailing_chars,expected_sql,expected_params", [
+    ("asdf.123", False, "p.path = %s", ["asdf.123"]),
+    ("asdf.123.*", False, "p.path LIKE %s AND p.path ~ %s", ["asdf.123.%", "^asdf[.]123[.][^.]+([.][^.]+)*$"]),
+    ("asdf.?.x_y.*", False, "p.path LIKE %s AND p.path ~ %s", ["asdf.%", "^asdf[.][^.]+[.]x_y[.][^.]+([.][^.]+)*$"]),
+    ("a_b.*", False, "p.path LIKE %s AND p.path ~ %s", ["a\\_b.%", "^a_b[.][^.]+([.][^.]+)*$"]),
+    ("*.asdf", False, "p.path ~ %s", ["^[^.]+([.][^.]+)*[.]asdf$"]),
+    ("asdf.12", True, "p.path LIKE %s", ["asdf.12%"]),
+    ("asdf.", True, "p.path LIKE %s", ["asdf.%"]),
+    ("asdf.?", True, "p.path LIKE %s AND p.path ~ %s", ["asdf.%", "^asdf[.][^.]+.*$"]),
+    ("", True, "TRUE", []),
+])
+def test_PathFilter_sql_from_filter(path_filter_str, allow_trailing_chars, expected_sql, expected_params):
+    assert PathFilter._sql_from_filter(path_filter_str, allow_trailing_chars, column='p.path') == (expected_sql, expected_params)
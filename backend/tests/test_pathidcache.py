@@ -0,0 +1,56 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import json
+import pytest
+
+import datatypes
+from datatypes import AggrTileCache, PathIdCache, PathTrieIndex
+
+
+@pytest.fixture
+def path_id_cache(monkeypatch, paths_listener):
+    monkeypatch.setattr(PathIdCache, 'MAX_SIZE', 3)
+    PathIdCache.clear()
+    yield PathIdCache
+    PathIdCache.clear()
+
+
+def test_PathIdCache_lru(path_id_cache):
+    generation = path_id_cache.get_generation()
+    path_id_cache.put(1, {'a.1': 11, 'a.2': 12, 'a.3': 13}, generation)
+    assert path_id_cache.get(1, 'a.1') == 11  # 'a.1' is now the most recently used
+    path_id_cache.put(1, {'a.4': 14}, generation)
+    assert path_id_cache.get(1, 'a.2') is None
+    assert path_id_cache.get(1, 'a.1') == 11
+    assert path_id_cache.get(2, 'a.1') is None  # different account
+
+
+def test_PathIdCache_evict_on_notification(path_id_cache):
+    path_id_cache.put(1, {'a.1': 11, 'a.2': 12}, path_id_cache.get_generation())
+    path_id_cache._on_notify(json.dumps({'op': 'insert', 'account': 1, 'ids': [11]}))
+    assert path_id_cache.get(1, 'a.1') == 11
+    path_id_cache._on_notify(json.dumps({'op': 'delete', 'account': 1, 'ids': [11]}))
+    assert path_id_cache.get(1, 'a.1') is None
+    assert path_id_cache.get(1, 'a.2') == 12
+
+
+def test_PathIdCache_stale_put_ignored(path_id_cache):
+    generation = path_id_cache.get_generation()
+    path_id_cache.evict([11])  # path was changed while we were reading it from DB
+    path_id_cache.put(1, {'a.1': 11}, generation)
+    assert path_id_cache.get(1, 'a.1') is None
+
+
+def test_PathIdCache_disabled_when_not_listening(path_id_cache, paths_listener):
+    path_id_cache.put(1, {'a.1': 11}, path_id_cache.get_generation())
+    paths_listener.is_listening = False
+    assert path_id_cache.get(1, 'a.1') is None
+
+
+def test_paths_listener_shared():
+    """ All caches which depend on path changes share a single listener (and DB connection). """
+    assert datatypes.paths_listener._subscribers == [
+        (PathIdCache._on_notify, PathIdCache.clear),
+        (PathTrieIndex._on_notify, PathTrieIndex.clear),
+        (AggrTileCache._on_notify, AggrTileCache.clear),
+    ]
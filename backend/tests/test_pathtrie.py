@@ -0,0 +1,208 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from contextlib import contextmanager
+import json
+import random
+import re
+import pytest
+
+import datatypes
+from datatypes import PathFilter, PathTrieIndex
+from pathtrie import PathTrie
+
+
+def random_paths(n):
+    rnd = random.Random(42)
+    segments = ['a', 'b', 'b-x', 'bc', 'c_1', 'X', '1', '10', '2', 'b%2ec']
+    paths = set()
+    while len(paths) < n:
+        paths.add('.'.join(rnd.choice(segments) for _ in range(rnd.randint(1, 5))))
+    return sorted(paths)
+
+
+@pytest.fixture(scope='module')
+def paths_and_trie():
+    paths = random_paths(2000)
+    trie = PathTrie()
+    for path_id, path in enumerate(paths):
+        trie.add(path_id, path)
+    return paths, trie
+
+
+@pytest.mark.parametrize("path_filter,allow_trailing_chars", [
+    ('*', False),
+    ('?', False),
+    ('a.*', False),
+    ('*.b', False),
+    ('?.?', False),
+    ('a.*.b.*', False),
+    ('b.b-x', False),
+    ('a.?.*.1', False),
+    ('*.a.*', False),
+    ('', True),
+    ('a.', True),
+    ('a.b', True),
+    ('b-', True),
+    ('*.', True),
+    ('?.b', True),
+    ('a.*.1', True),
+    ('*.b', True),
+])
+def test_PathTrie_find_same_as_regex(paths_and_trie, path_filter, allow_trailing_chars):
+    """ Results (and their order) must be the same as if regex was matched against every path. """
+    paths, trie = paths_and_trie
+    regex = re.compile(PathFilter._regex_from_filter(path_filter, allow_trailing_chars))
+    expected = [p for p in paths if regex.match(p)]
+    for limit in [5, 10000]:
+        found, limit_reached = trie.find(path_filter, limit, allow_trailing_chars)
+        assert [p['path'] for p in found] == expected[:limit]
+        assert all(paths[p['id']] == p['path'] for p in found)
+        assert limit_reached == (len(expected) > limit)
+
+
+def test_PathTrie_add_rename_remove():
+    trie = PathTrie()
+    trie.add(1, 'a.b.c')
+    trie.add(2, 'a.b')
+    trie.add(3, 'a.bb')
+    assert trie.find('a.*', 10) == ([{'id': 2, 'path': 'a.b'}, {'id': 1, 'path': 'a.b.c'}, {'id': 3, 'path': 'a.bb'}], False)
+    trie.add(1, 'a.x.c')
+    assert trie.find('a.?.c', 10) == ([{'id': 1, 'path': 'a.x.c'}], False)
+    trie.remove(1)
+    trie.remove(1)
+    trie.remove(2)
+    assert len(trie) == 1
+    assert trie.find('*', 10) == ([{'id': 3, 'path': 'a.bb'}], False)
+    trie.remove(3)
+    assert trie._root.children is None
+
+
+def test_PathTrie_find_is_lazy(monkeypatch):
+    """ Only as many children are visited as are needed to find `limit` + 1 paths. """
+    trie = PathTrie()
+    for i in range(10000):
+        trie.add(i, f'a.{i}.x')
+        trie.add(10000 + i, f'a.{i}.y')
+    trie.find('a.*', 1)  # entries of the nodes are sorted on first use and then kept
+
+    calls = []
+    original_next_states = trie._next_states
+    monkeypatch.setattr(trie, '_next_states', lambda *args: calls.append(args) or original_next_states(*args))
+    assert trie.find('a.?.x', 3) == ([{'id': 0, 'path': 'a.0.x'}, {'id': 1, 'path': 'a.1.x'}, {'id': 10, 'path': 'a.10.x'}], True)
+    assert len(calls) < 10
+    calls.clear()
+    assert len(trie.find('a.*', 5)[0]) == 5
+    assert len(calls) < 10
+
+
+def test_PathTrie_entries_kept_in_order():
+    trie = PathTrie()
+    for path_id, path in enumerate(['a.b', 'a.b-x', 'a.c']):
+        trie.add(path_id, path)
+    node = trie._root.children['a']
+    assert node.get_entries() == ['b', 'b-x', 'b-x.', 'b.', 'c', 'c.']
+    trie.add(3, 'a.b_y')
+    trie.remove(2)
+    assert node.get_entries() == ['b', 'b-x', 'b-x.', 'b.', 'b_y', 'b_y.']
+
+
+@pytest.fixture
+def fake_paths_db(monkeypatch, paths_listener):
+    """ Paths table (account, id, path) in memory; counts the queries. """
+    paths_db = {'rows': [(1, 11, 'a.b'), (1, 12, 'a.c'), (2, 21, 'a.d')], 'queries': 0}
+
+    class FakeCursor(object):
+        def execute(self, query, params):
+            paths_db['queries'] += 1
+            if 'ANY' in query:
+                account_id, path_ids = params
+                self.res = [(path_id, path) for a, path_id, path in paths_db['rows'] if a == account_id and path_id in path_ids]
+            else:
+                account_id, limit = params
+                self.res = [(path_id, path) for a, path_id, path in paths_db['rows'] if a == account_id][:limit]
+
+        def fetchall(self):
+            return self.res
+
+    @contextmanager
+    def cursor():
+        yield FakeCursor()
+
+    monkeypatch.setattr(datatypes.db, 'cursor', cursor)
+    PathTrieIndex.clear()
+    yield paths_db
+    PathTrieIndex.clear()
+
+
+def test_PathTrieIndex_lazy_build(fake_paths_db):
+    assert PathTrieIndex.find_matching_paths(1, 'a.*', 10) == ([{'id': 11, 'path': 'a.b'}, {'id': 12, 'path': 'a.c'}], False)
+    assert PathTrieIndex.find_matching_paths(1, 'a.?', 1) == ([{'id': 11, 'path': 'a.b'}], True)
+    assert PathTrieIndex.find_matching_paths(2, 'a.*', 10) == ([{'id': 21, 'path': 'a.d'}], False)
+    assert fake_paths_db['queries'] == 2  # once per account
+
+
+def test_PathTrieIndex_local_updates(fake_paths_db):
+    PathTrieIndex.find_matching_paths(1, 'a.*', 10)
+    PathTrieIndex.update(1, {13: 'a.a', 11: None, 12: 'a.cc'})
+    assert PathTrieIndex.find_matching_paths(1, 'a.*', 10) == ([{'id': 13, 'path': 'a.a'}, {'id': 12, 'path': 'a.cc'}], False)
+    assert fake_paths_db['queries'] == 1
+
+
+def test_PathTrieIndex_notifications(fake_paths_db):
+    PathTrieIndex.find_matching_paths(1, 'a.*', 10)
+    fake_paths_db['rows'] = [(1, 11, 'a.b'), (1, 12, 'a.x'), (1, 14, 'a.e')]
+    PathTrieIndex._on_notify(json.dumps({'op': 'insert', 'account': 1, 'ids': [11, 14]}))  # 11 is already known
+    PathTrieIndex._on_notify(json.dumps({'op': 'update', 'account': 1, 'ids': [12]}))
+    PathTrieIndex._on_notify(json.dumps({'op': 'delete', 'account': 1, 'ids': [11]}))
+    PathTrieIndex._on_notify(json.dumps({'op': 'insert', 'account': 2, 'ids': [22]}))  # account 2 is not indexed
+    assert PathTrieIndex.find_matching_paths(1, 'a.*', 10) == ([{'id': 14, 'path': 'a.e'}, {'id': 12, 'path': 'a.x'}], False)
+    assert fake_paths_db['queries'] == 3
+
+
+def test_PathTrieIndex_stale_build_not_kept(fake_paths_db, monkeypatch):
+    """ If paths change while the trie is being built, it is only used once. """
+    original_cursor = datatypes.db.cursor
+
+    @contextmanager
+    def cursor():
+        PathTrieIndex.update(1, {15: 'a.f'})
+        with original_cursor() as c:
+            yield c
+
+    monkeypatch.setattr(datatypes.db, 'cursor', cursor)
+    PathTrieIndex.find_matching_paths(1, 'a.*', 10)
+    PathTrieIndex.find_matching_paths(1, 'a.*', 10)
+    assert fake_paths_db['queries'] == 2
+
+
+def test_PathTrieIndex_single_build(fake_paths_db, monkeypatch):
+    """ While the trie of an account is being built, other requests for the same account don't build it again. """
+    original_cursor = datatypes.db.cursor
+    concurrent = []
+
+    @contextmanager
+    def cursor():
+        if not concurrent:
+            concurrent.append(PathTrieIndex.find_matching_paths(1, 'a.*', 10))
+        with original_cursor() as c:
+            yield c
+
+    monkeypatch.setattr(datatypes.db, 'cursor', cursor)
+    assert PathTrieIndex.find_matching_paths(1, 'a.*', 10) == ([{'id': 11, 'path': 'a.b'}, {'id': 12, 'path': 'a.c'}], False)
+    assert concurrent == [None]  # caller falls back to DB
+    assert fake_paths_db['queries'] == 1
+    assert PathTrieIndex.find_matching_paths(1, 'a.*', 10) == ([{'id': 11, 'path': 'a.b'}, {'id': 12, 'path': 'a.c'}], False)
+    assert fake_paths_db['queries'] == 1
+
+
+def test_PathTrieIndex_too_large(fake_paths_db, monkeypatch):
+    monkeypatch.setattr(PathTrieIndex, 'MAX_PATHS', 1)
+    assert PathTrieIndex.find_matching_paths(1, 'a.*', 10) is None
+    assert PathTrieIndex.find_matching_paths(1, 'a.*', 10) is None
+    assert fake_paths_db['queries'] == 1
+    # accounts are evicted when there are too many paths in total:
+    assert PathTrieIndex.find_matching_paths(2, 'a.*', 10) == ([{'id': 21, 'path': 'a.d'}], False)
+    fake_paths_db['rows'].append((3, 31, 'b'))
+    assert PathTrieIndex.find_matching_paths(3, '?', 10) == ([{'id': 31, 'path': 'b'}], False)
+    assert list(PathTrieIndex._tries.keys()) == [3]
+
@@ -0,0 +1,96 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fastapi import HTTPException
+import pytest
+import threading
+
+from api import ratelimits
+from api.ratelimits import RateLimiter, check_rate_limits
+from datatypes import RateLimitBucket
+
+
+@pytest.fixture
+def shared_buckets(monkeypatch):
+    """ Replaces the buckets in DB with a dict (without refilling), and counts the accesses. """
+    buckets = {'_calls': 0}
+
+    def take(account_id, bucket, n, rate_per_s, capacity, force=False):
+        buckets['_calls'] += 1
+        tokens = buckets.setdefault((account_id, bucket), capacity)
+        taken = n if (force or tokens > 0) else 0
+        buckets[(account_id, bucket)] = tokens - taken
+        return taken, tokens - taken
+
+    monkeypatch.setattr(RateLimitBucket, 'take', take)
+    return buckets
+
+
+def test_RateLimiter_lease(shared_buckets):
+    limiter = RateLimiter('values', rate_per_s=10, capacity=100)
+    assert limiter.consume(1, 5)
+    assert shared_buckets[(1, 'values')] == 100 - 5 - 10  # took a lease of 10% of capacity
+    for _ in range(5):
+        assert limiter.consume(1, 2)
+    assert shared_buckets['_calls'] == 1  # everything was spent from the lease
+    assert limiter.consume(2, 5)  # other accounts have their own buckets
+    assert shared_buckets[(1, 'values')] == 85
+
+
+def test_RateLimiter_debt_blocks_without_db(shared_buckets):
+    limiter = RateLimiter('values', rate_per_s=10, capacity=100)
+    assert limiter.consume(1, 150)  # bucket was not empty, so request is allowed, but it goes into debt
+    assert shared_buckets[(1, 'values')] == -50  # lease was returned
+    assert limiter.blocked_for_s(1) > 5
+    n_calls = shared_buckets['_calls']
+    assert not limiter.consume(1, 1)
+    assert not limiter.consume(1, 0)
+    assert shared_buckets['_calls'] == n_calls
+
+
+def test_RateLimiter_charge(shared_buckets):
+    limiter = RateLimiter('new_paths', rate_per_s=1, capacity=10)
+    limiter.charge(1, 5)
+    assert limiter.consume(1, 0)
+    limiter.charge(1, 10)
+    assert shared_buckets[(1, 'new_paths')] == -5
+    assert not limiter.consume(1, 0)
+
+
+def test_RateLimiter_disabled(shared_buckets):
+    limiter = RateLimiter('values', rate_per_s=0, capacity=0)
+    assert limiter.consume(1, 1000000)
+    assert shared_buckets['_calls'] == 0
+
+
+def test_check_rate_limits(shared_buckets, monkeypatch):
+    monkeypatch.setattr(ratelimits, 'values_rate_limiter', RateLimiter('values', rate_per_s=10, capacity=100))
+    check_rate_limits(1, 200)
+    with pytest.raises(HTTPException) as ex:
+        check_rate_limits(1, 0)
+    assert ex.value.status_code == 429
+    assert int(ex.value.headers['Retry-After']) >= 10
+
+
+def test_RateLimiter_accounts_dont_wait_for_each_other(shared_buckets, monkeypatch):
+    take_orig = RateLimitBucket.take
+    db_slow = threading.Event()
+    in_db = threading.Event()
+
+    def take(account_id, *args, **kwargs):
+        if account_id == 1:
+            in_db.set()
+            db_slow.wait(5)
+        return take_orig(account_id, *args, **kwargs)
+
+    monkeypatch.setattr(RateLimitBucket, 'take', take)
+    limiter = RateLimiter('values', rate_per_s=10, capacity=100)
+    t = threading.Thread(target=limiter.consume, args=(1, 5))
+    t.start()
+    try:
+        assert in_db.wait(5)
+        assert limiter.consume(2, 5)  # doesn't wait for account 1 to get its tokens from DB
+        assert not db_slow.is_set()
+    finally:
+        db_slow.set()
+        t.join()
+    assert shared_buckets[(1, 'values')] == 85
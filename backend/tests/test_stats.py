@@ -0,0 +1,94 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from contextlib import contextmanager
+from decimal import Decimal
+import pytest
+
+import datatypes
+from datatypes import Measurement, Stats
+
+
+def test_Stats_aggregated_in_memory(monkeypatch):
+    saved, published = [], []
+    monkeypatch.setattr(Stats, 'FLUSH_INTERVAL_S', 3600)
+    monkeypatch.setattr(Stats, '_ensure_flusher_started', lambda: None)
+    monkeypatch.setattr(Stats, '_save', lambda account_id, pending: saved.append((account_id, dict(pending))) or [('topic', {'v': 1.0, 't': 60})])
+    monkeypatch.setattr(Stats, 'on_flushed', published.append)
+    Stats._pending.clear()
+
+    Stats.update_account_stats(1, {'system.stats.updated': {'v': 3, 't': 60}, 'system.stats.changed': {'v': 3, 't': 60}})
+    Stats.update_account_stats(1, {'system.stats.updated': {'v': 2, 't': 60}})
+    Stats.update_account_stats(2, {'system.stats.updated': {'v': 1, 't': 60}})
+    Stats.update_account_stats(1, {'system.stats.updated': {'v': 1, 't': 120}})
+    assert saved == []
+
+    Stats.flush()
+    assert sorted(saved) == [
+        (1, {
+            ('system.stats.updated', 60): 5.0,
+            ('system.stats.changed', 60): 3.0,
+            ('system.stats.updated', 120): 1.0,
+        }),
+        (2, {('system.stats.updated', 60): 1.0}),
+    ]
+    assert published == [[('topic', {'v': 1.0, 't': 60}), ('topic', {'v': 1.0, 't': 60})]]
+
+    Stats.flush()  # nothing to save
+    assert len(saved) == 2
+
+
+def test_Stats_flush_saves_accounts_separately(monkeypatch):
+    saved, published = [], []
+
+    def save(account_id, pending):
+        if account_id == 1:
+            raise Exception("Account was removed")
+        saved.append(account_id)
+        return [(f'accounts/{account_id}/values/system.stats.updated', {'v': 1.0, 't': 60})]
+
+    monkeypatch.setattr(Stats, 'FLUSH_INTERVAL_S', 3600)
+    monkeypatch.setattr(Stats, '_ensure_flusher_started', lambda: None)
+    monkeypatch.setattr(Stats, '_save', save)
+    monkeypatch.setattr(Stats, 'on_flushed', published.append)
+    Stats._pending.clear()
+
+    Stats.update_account_stats(1, {'system.stats.updated': {'v': 1, 't': 60}})
+    Stats.update_account_stats(2, {'system.stats.updated': {'v': 1, 't': 60}})
+    Stats.flush()
+    assert saved == [2]
+    assert published == [[('accounts/2/values/system.stats.updated', {'v': 1.0, 't': 60})]]
+
+
+@pytest.fixture
+def saved_stats_rows(monkeypatch):
+    """ Fakes saving of stats to DB; returns a dict which collects the rows passed to Measurement helpers. """
+    collected = {}
+
+    class FakePath(object):
+        def __init__(self, path_id):
+            self.force_id = path_id
+
+    @contextmanager
+    def cursor():
+        yield None
+
+    def execute_values(c, query, rows, template, page_size, fetch):
+        # every row was already saved once before, so values are added to the existing ones:
+        return [(path_id, ts, Decimal(value) + 10) for path_id, ts, value in rows]
+
+    monkeypatch.setattr(datatypes.db, 'cursor', cursor)
+    monkeypatch.setattr(datatypes.psycopg2.extras, 'execute_values', execute_values)
+    monkeypatch.setattr(datatypes.Path, 'forge_from_paths', lambda paths, account_id, allow_system: {p: FakePath({'system.stats.updated': 11, 'system.stats.changed': 12}[p]) for p in paths})
+    monkeypatch.setattr(Measurement, '_update_paths_meta', lambda rows: collected.setdefault('paths_meta', []).extend(rows))
+    monkeypatch.setattr(Measurement, '_update_latest_values', lambda rows: collected.setdefault('latest_values', []).extend(rows))
+    return collected
+
+
+def test_Stats_save_updates_paths_meta_and_latest_values(saved_stats_rows):
+    topics_with_payloads = Stats._save(1, {('system.stats.updated', 60): 5.0, ('system.stats.changed', 120): 3.0})
+    assert sorted(topics_with_payloads) == [
+        ('accounts/1/values/system.stats.changed', {'v': 13.0, 't': 120}),
+        ('accounts/1/values/system.stats.updated', {'v': 15.0, 't': 60}),
+    ]
+    assert sorted(saved_stats_rows['paths_meta']) == [(11, 60, '15.0'), (12, 120, '13.0')]
+    assert sorted(saved_stats_rows['latest_values']) == [(11, 60, '15.0'), (12, 120, '13.0')]
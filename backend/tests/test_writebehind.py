@@ -0,0 +1,117 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pytest
+
+from api.writebehind import WriteBehindBuffer
+from datatypes import Measurement
+
+
+@pytest.fixture
+def saved(monkeypatch):
+    """ Replaces DB access with lists, so that we can see what would be saved. """
+    saved = {'upserts': [], 'flushed': [], 'new_paths': [], 'paths': set(), 'n_failures': 0, 'db_down': False, 'upsert_down': False}
+
+    def prepare_rows(account_id, data):
+        if saved['db_down'] or any(x['v'] == 'fail' for x in data):
+            saved['n_failures'] += 1
+            raise Exception("DB error")
+        newly_created_paths = sorted(set((account_id, x['p']) for x in data) - saved['paths'])
+        saved['paths'].update(newly_created_paths)
+        return {(account_id, x['p'], x['t']): x['v'] for x in data}, newly_created_paths
+
+    def upsert_rows(rows):
+        if saved['upsert_down']:
+            raise Exception("DB error")
+        saved['upserts'].append(rows)
+
+    monkeypatch.setattr(Measurement, 'prepare_rows', prepare_rows)
+    monkeypatch.setattr(Measurement, 'upsert_rows', upsert_rows)
+    return saved
+
+
+@pytest.fixture
+def buffer(saved):
+    def on_flushed(account_id, data, stats_count_path, newly_created_paths):
+        saved['flushed'].append((account_id, stats_count_path, len(data)))
+        saved['new_paths'].extend(newly_created_paths)
+    b = WriteBehindBuffer(max_rows=5, flush_rows=100, flush_interval_ms=60000, on_flushed=on_flushed, max_retries=2)
+    yield b
+    b.shutdown()
+
+
+def test_WriteBehindBuffer_merges_requests(buffer, saved):
+    assert buffer.enqueue(1, [{'p': 'a', 't': 1, 'v': 1}], 'stats.put')
+    assert buffer.enqueue(2, [{'p': 'a', 't': 1, 'v': 2}], 'stats.put')
+    assert buffer.enqueue(1, [{'p': 'b', 't': 1, 'v': 3}], 'stats.put')
+    buffer.flush()
+    assert len(saved['upserts']) == 1  # everything was saved in a single upsert
+    assert saved['upserts'][0] == {(1, 'a', 1): 1, (2, 'a', 1): 2, (1, 'b', 1): 3}
+    assert saved['flushed'] == [(1, 'stats.put', 2), (2, 'stats.put', 1)]
+
+
+def test_WriteBehindBuffer_backpressure(buffer, saved):
+    assert buffer.enqueue(1, [{'p': 'a', 't': t, 'v': 1} for t in range(4)], 'stats.put')
+    assert not buffer.enqueue(1, [{'p': 'a', 't': t, 'v': 1} for t in range(2)], 'stats.put')
+    buffer.flush()
+    assert buffer.enqueue(1, [{'p': 'a', 't': t, 'v': 1} for t in range(2)], 'stats.put')
+
+
+def test_WriteBehindBuffer_failure_isolated(buffer, saved):
+    assert buffer.enqueue(1, [{'p': 'a', 't': 1, 'v': 'fail'}], 'stats.put')
+    assert buffer.enqueue(2, [{'p': 'a', 't': 1, 'v': 2}], 'stats.put')
+    buffer.flush()
+    assert saved['upserts'] == [{(2, 'a', 1): 2}]
+    assert saved['flushed'] == [(2, 'stats.put', 1)]
+
+
+def test_WriteBehindBuffer_failed_values_retried(buffer, saved):
+    assert buffer.enqueue(1, [{'p': 'a', 't': 1, 'v': 1}], 'stats.put')
+    saved['db_down'] = True
+    buffer.flush()
+    assert saved['flushed'] == []
+    saved['db_down'] = False
+    assert buffer.enqueue(1, [{'p': 'b', 't': 1, 'v': 2}], 'stats.put')
+    buffer.flush()
+    # requeued values are merged with the new ones of the same account:
+    assert saved['upserts'] == [{(1, 'a', 1): 1, (1, 'b', 1): 2}]
+    assert saved['flushed'] == [(1, 'stats.put', 2)]
+
+
+def test_WriteBehindBuffer_retry_reports_new_paths(buffer, saved):
+    assert buffer.enqueue(1, [{'p': 'a', 't': 1, 'v': 1}], 'stats.put')
+    saved['upsert_down'] = True  # paths get created, but values are not saved
+    buffer.flush()
+    assert saved['flushed'] == []
+    saved['upsert_down'] = False
+    assert buffer.enqueue(1, [{'p': 'b', 't': 1, 'v': 2}], 'stats.put')
+    buffer.flush()
+    assert saved['flushed'] == [(1, 'stats.put', 2)]
+    assert saved['new_paths'] == [(1, 'a'), (1, 'b')]
+
+
+def test_WriteBehindBuffer_retries_bounded(buffer, saved):
+    assert buffer.enqueue(1, [{'p': 'a', 't': 1, 'v': 'fail'}], 'stats.put')
+    for _ in range(5):
+        buffer.flush()
+    assert saved['n_failures'] == 2 * 3  # merged and separate save, initial attempt + 2 retries
+    assert buffer._n_rows == 0
+
+
+def test_WriteBehindBuffer_retry_needs_room(buffer, saved, monkeypatch):
+    assert buffer.enqueue(1, [{'p': 'a', 't': t, 'v': 'fail'} for t in range(3)], 'stats.put')
+    # fill the buffer while the failing values are being saved:
+    original_save = buffer._save
+    def save(groups, new_paths):
+        monkeypatch.setattr(buffer, '_save', original_save)
+        buffer.enqueue(2, [{'p': 'a', 't': t, 'v': 1} for t in range(3)], 'stats.put')
+        return original_save(groups, new_paths)
+    monkeypatch.setattr(buffer, '_save', save)
+    buffer.flush()
+    assert buffer._n_rows == 3
+    assert [e[0] for e in buffer._entries] == [2]
+
+
+def test_WriteBehindBuffer_shutdown_flushes(buffer, saved):
+    assert buffer.enqueue(1, [{'p': 'a', 't': 1, 'v': 1}], 'stats.put')
+    buffer.shutdown()
+    assert saved['flushed'] == [(1, 'stats.put', 1)]